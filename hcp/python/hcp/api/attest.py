@@ -131,11 +131,20 @@ def initiate(api, output, requests_verify = True, requests_cert = False,
         fp.write(json.dumps(jr))
     return True
 
-def quote(initial, output, dictionarylockout = False):
+# If 'eventlog' is set, it's the path to the TPM's binary event log (usually
+# /sys/kernel/security/tpm0/binary_bios_measurements), which is included with
+# the quote so that the attestsvc can replay it.
+def quote(initial, output, dictionarylockout = False, eventlog = None):
     with open(initial, 'r') as fp:
         initjson = fp.read()
     init = json.loads(initjson)
     with tempfile.TemporaryDirectory() as tempdir:
+        extras = []
+        if eventlog:
+            with open(eventlog, 'rb') as src, \
+                    open(f"{tempdir}/quote.eventlog", 'wb') as dst:
+                dst.write(src.read())
+            extras.append('quote.eventlog')
         with open(f"{tempdir}/nonce", 'w') as fp:
             fp.write(init['nonce'].strip())
         if dictionarylockout:
@@ -176,7 +185,7 @@ def quote(initial, output, dictionarylockout = False):
             sr(['tar', '-zcf', output,
                 '-C', tempdir,
                 'ek.pub', 'ak.pub', 'ak.ctx',
-                'quote.out', 'quote.sig', 'quote.pcr']):
+                'quote.out', 'quote.sig', 'quote.pcr'] + extras):
             return True
     return False
 
@@ -343,7 +352,10 @@ if __name__ == '__main__':
     """
     quote_help_initial = 'path to attestation context, as returned from \'initiate\''
     quote_help_output = 'path for the resulting quote file'
+    quote_help_eventlog = 'path to the TPM event log, to include with the quote'
     parser_a = subparsers.add_parser('quote', help=quote_help, epilog=quote_epilog)
+    parser_a.add_argument('--eventlog', metavar='<PATH>',
+                        default=None, help=quote_help_eventlog)
     parser_a.add_argument('initial', help=quote_help_initial)
     parser_a.add_argument('output', help=quote_help_output)
     parser_a.set_defaults(func='quote')
@@ -425,7 +437,8 @@ if __name__ == '__main__':
                               requests_cert = requests_cert,
                               timeout = args.timeout)
         elif args.func == 'quote':
-            result = quote(args.initial, args.output)
+            result = quote(args.initial, args.output,
+                           eventlog = args.eventlog)
         elif args.func == 'complete':
             result = complete(args.api, args.initial,
                               args.quote, args.output,
@@ -7,7 +7,11 @@
 #               -F profile=<jsonstring> \
 #               <enrollsvc-URL>/v1/add
 #
-# query:   curl -v -G -d ekpubhash=<hexstring> \
+# add_batch: curl -v -F ekpub=@</path/to/ek1.pub> -F profile=<jsonstring1> \
+#                 -F ekpub=@</path/to/ek2.pub> -F profile=<jsonstring2> \
+#                 <enrollsvc-URL>/v1/add_batch
+#
+# query:   curl -v -G -d ekpubhash=<hexstring> [-H "If-None-Match: <etag>"] \
 #               <enrollsvc-URL>/v1/query
 #
 # delete:  curl -v -F ekpubhash=<hexstring> \
@@ -16,7 +20,24 @@
 # reenroll: curl -v -F ekpubhash=<hexstring> \
 #               <enrollsvc-URL>/v1/reenroll
 #
+# find:    curl -v -G -d hostname_regex=<regex> \
+#               <enrollsvc-URL>/v1/find
+#
+# select:  curl -v -G -d realm=<realm> -d certgen=<type> \
+#               <enrollsvc-URL>/v1/select
+#
+# changes: curl -v -G -d since=<seq> -d wait=<secs> \
+#               <enrollsvc-URL>/v1/changes
+#
+# export:  curl -v -G -d ekpubhash=<hexstring> -o <output.tar.gz> \
+#               <enrollsvc-URL>/v1/export
+#
+# import:  curl -v -H 'Content-Type: application/gzip' \
+#               -T <input.tar.gz> -X POST <enrollsvc-URL>/v1/import
+#
 # janitor: curl -v -G <enrollsvc-URL>/v1/janitor
+#
+# janitor status: curl -v -G <enrollsvc-URL>/v1/janitor/status
 
 import json
 import requests
@@ -24,6 +45,7 @@ import os
 import sys
 import argparse
 import time
+import tarfile
 
 loglevel = 0
 def set_loglevel(v):
@@ -121,6 +143,41 @@ def enroll_add(api, ekpub, profile = None, requests_verify = True,
     debug(f" - jr: {jr}")
     return True, jr
 
+# 'items' is a list of (ekpub, profile) 2-tuples, where 'ekpub' is a path and
+# 'profile' is a JSON string or None. The returned JSON has a 'results' array
+# with an entry per item (in the same order), each containing the item's
+# 'ekpubhash' and its 'status' (201 on success, 409 if already enrolled, ...).
+def enroll_add_batch(api, items, requests_verify = True,
+                     requests_cert = False, retries = 0, timeout = 120):
+    debug(f"enroll_add_batch:")
+    debug(f"  api={api}")
+    debug(f"  items={items}")
+    debug(f"  requests_verify={requests_verify}")
+    debug(f"  requests_cert={requests_cert}")
+    form_data = []
+    for ekpub, profile in items:
+        with open(ekpub, 'rb') as fp:
+            form_data.append(('ekpub', ('ek.pub', fp.read())))
+        form_data.append(('profile', (None, profile if profile else '')))
+    myrequest = lambda: requests.post(api + '/v1/add_batch',
+                                      files = form_data,
+                                      auth = auth,
+                                      verify = requests_verify,
+                                      cert = requests_cert,
+                                      timeout = timeout)
+    response = requester_loop(myrequest, retries = retries)
+    debug(f" - response: {response}")
+    if response.status_code != 200:
+        err(f"Error, 'add_batch' response status code was {response.status_code}")
+        return False, None
+    try:
+        jr = json.loads(response.content)
+    except Exception as e:
+        err(f"Error, JSON decoding of 'add_batch' response failed: {e}")
+        return False, None
+    debug(f" - jr: {jr}")
+    return True, jr
+
 def enroll_reenroll(api, ekpubhash, requests_verify = True,
                     requests_cert = False, retries = 0, timeout = 120):
     form_data = { 'ekpubhash': (None, ekpubhash) }
@@ -147,14 +204,25 @@ def enroll_reenroll(api, ekpubhash, requests_verify = True,
     debug(f" - jr: {jr}")
     return True, jr
 
+# Query responses carry an ETag, so the last response for each distinct query
+# is remembered and the query is made conditional (If-None-Match). If nothing
+# has changed, the server replies 304 and the remembered response is reused.
+QUERY_CACHE_SIZE = 100
+query_cache = {}
+
 def do_query_or_delete(api, ekpubhash, is_delete, nofiles,
                        requests_verify = True, requests_cert = False,
-                       retries = 0, timeout = 120):
+                       retries = 0, timeout = 120, limit = None,
+                       cursor = None):
     form_data = {
         'ekpubhash': (None, ekpubhash)
     }
     if nofiles:
         form_data['nofiles'] = (None, True)
+    if limit:
+        form_data['limit'] = (None, str(limit))
+    if cursor:
+        form_data['cursor'] = (None, cursor)
     if is_delete:
         debug("'delete' handler about to call API")
         debug(f" - url: {api + '/v1/delete'}")
@@ -167,16 +235,29 @@ def do_query_or_delete(api, ekpubhash, is_delete, nofiles,
                                           timeout = timeout)
         response = requester_loop(myrequest, retries = retries)
     else:
+        cachekey = (api, ekpubhash, nofiles, limit, cursor)
+        cached = query_cache.get(cachekey)
+        headers = { 'If-None-Match': cached[0] } if cached else {}
         debug("'query' handler about to call API")
         debug(f" - url: {api + '/v1/query'}")
         debug(f" - params: {form_data}")
+        debug(f" - headers: {headers}")
         myrequest = lambda: requests.get(api + '/v1/query',
                                          params = form_data,
+                                         headers = headers,
                                          auth = auth,
                                          verify = requests_verify,
                                          cert = requests_cert,
                                          timeout = timeout)
         response = requester_loop(myrequest, retries = retries)
+        if response.status_code == 304 and cached:
+            debug(f" - response: {response} (unchanged)")
+            return True, json.loads(cached[1])
+        if response.status_code == 200 and 'ETag' in response.headers:
+            if len(query_cache) >= QUERY_CACHE_SIZE:
+                query_cache.pop(next(iter(query_cache)))
+            query_cache[cachekey] = (response.headers['ETag'],
+                                     response.content)
     debug(f" - response: {response}")
     debug(f" - response.content: {response.content}")
     if response.status_code != 200:
@@ -196,11 +277,208 @@ def enroll_query(api, ekpubhash, nofiles, **kwargs):
 def enroll_delete(api, ekpubhash, nofiles, **kwargs):
     return do_query_or_delete(api, ekpubhash, True, nofiles, **kwargs)
 
-def enroll_janitor(api, requests_verify = True, requests_cert = False,
+# Iterator versions of query and delete. These fetch (or delete) 'page_size'
+# entries per API call, following the 'next' cursor until the matches are
+# exhausted, and yield the entries one at a time. So the memory used (in the
+# client and the server) doesn't depend on how many entries match. An
+# exception is raised if any of the API calls fails.
+def do_query_or_delete_iter(api, ekpubhash, is_delete, nofiles,
+                            page_size = 1000, **kwargs):
+    cursor = None
+    while True:
+        result, jr = do_query_or_delete(api, ekpubhash, is_delete, nofiles,
+                                        limit = page_size, cursor = cursor,
+                                        **kwargs)
+        if not result:
+            raise Exception(f"'{'delete' if is_delete else 'query'}' failed")
+        for entry in jr['entries']:
+            yield entry
+        if 'next' not in jr:
+            return
+        cursor = jr['next']
+
+def enroll_query_iter(api, ekpubhash, nofiles, **kwargs):
+    return do_query_or_delete_iter(api, ekpubhash, False, nofiles, **kwargs)
+
+def enroll_delete_iter(api, ekpubhash, nofiles, **kwargs):
+    return do_query_or_delete_iter(api, ekpubhash, True, nofiles, **kwargs)
+
+def enroll_find(api, hostname_regex = None, hostname_prefix = None,
+                requests_verify = True, requests_cert = False,
+                retries = 0, timeout = 120):
+    form_data = {}
+    if hostname_regex is not None:
+        form_data['hostname_regex'] = hostname_regex
+    elif hostname_prefix is not None:
+        form_data['hostname_prefix'] = hostname_prefix
+    debug("'find' handler about to call API")
+    debug(f" - url: {api + '/v1/find'}")
+    debug(f" - params: {form_data}")
+    myrequest = lambda: requests.get(api + '/v1/find',
+                                     params = form_data,
+                                     auth = auth,
+                                     verify = requests_verify,
+                                     cert = requests_cert,
+                                     timeout = timeout)
+    response = requester_loop(myrequest, retries = retries)
+    debug(f" - response: {response}")
+    debug(f" - response.content: {response.content}")
+    if response.status_code != 200:
+        err(f"Error, 'find' response status code was {response.status_code}")
+        return False, None
+    try:
+        jr = json.loads(response.content)
+    except Exception as e:
+        log(f"Error, JSON decoding of 'find' response failed: {e}")
+        return False, None
+    debug(f" - jr: {jr}")
+    return True, jr
+
+# 'conditions' is a list of (field, value) 2-tuples (e.g. ('realm', 'X'),
+# ('certgen', 'pkinit-kdc'), ('ktgen.api', 'https://...')), all of which must
+# match. The JSON has an 'entries' array of objects with 'ekpubhash' and
+# 'hostname', and a 'next' cursor if there are more than 'limit'.
+def enroll_select(api, conditions, limit = None, cursor = None,
+                  requests_verify = True, requests_cert = False,
+                  retries = 0, timeout = 120):
+    form_data = list(conditions)
+    if limit:
+        form_data.append(('limit', limit))
+    if cursor:
+        form_data.append(('cursor', cursor))
+    debug("'select' handler about to call API")
+    debug(f" - url: {api + '/v1/select'}")
+    debug(f" - params: {form_data}")
+    myrequest = lambda: requests.get(api + '/v1/select',
+                                     params = form_data,
+                                     auth = auth,
+                                     verify = requests_verify,
+                                     cert = requests_cert,
+                                     timeout = timeout)
+    response = requester_loop(myrequest, retries = retries)
+    debug(f" - response: {response}")
+    debug(f" - response.content: {response.content}")
+    if response.status_code != 200:
+        err(f"Error, 'select' response status code was {response.status_code}")
+        return False, None
+    try:
+        jr = json.loads(response.content)
+    except Exception as e:
+        log(f"Error, JSON decoding of 'select' response failed: {e}")
+        return False, None
+    debug(f" - jr: {jr}")
+    return True, jr
+
+# Retrieve the changes (adds, deletes, reenrolls) made to the enrollment DB
+# after sequence number 'since'. With 'wait', the server holds the request
+# for up to that many seconds if there are no changes yet (long-poll). The
+# JSON has the 'changes', and a 'next' value to pass as 'since' next time. If
+# it has 'reset' set, changes have been lost (the server's journal was
+# trimmed), so anything cached from the enrollment DB should be discarded.
+def enroll_changes(api, since = 0, wait = 0, limit = None,
+                   requests_verify = True, requests_cert = False,
                    retries = 0, timeout = 120):
+    form_data = { 'since': since, 'wait': wait }
+    if limit:
+        form_data['limit'] = limit
+    debug("'changes' handler about to call API")
+    debug(f" - url: {api + '/v1/changes'}")
+    debug(f" - params: {form_data}")
+    myrequest = lambda: requests.get(api + '/v1/changes',
+                                     params = form_data,
+                                     auth = auth,
+                                     verify = requests_verify,
+                                     cert = requests_cert,
+                                     timeout = timeout + wait)
+    response = requester_loop(myrequest, retries = retries)
+    debug(f" - response: {response}")
+    debug(f" - response.content: {response.content}")
+    if response.status_code != 200:
+        err(f"Error, 'changes' response status code was {response.status_code}")
+        return False, None
+    try:
+        jr = json.loads(response.content)
+    except Exception as e:
+        log(f"Error, JSON decoding of 'changes' response failed: {e}")
+        return False, None
+    debug(f" - jr: {jr}")
+    return True, jr
+
+# Write a snapshot of the enrollments matching 'ekpubhash' (a prefix, empty
+# for all of them) to 'output', as a .tar.gz (see '/v1/export'). The archive
+# is streamed to disk as it arrives. The returned JSON has the 'seq' that the
+# snapshot is consistent with (see enroll_changes()).
+def enroll_export(api, output, ekpubhash = '', requests_verify = True,
+                  requests_cert = False, retries = 0, timeout = 120):
+    form_data = { 'ekpubhash': ekpubhash }
+    debug("'export' handler about to call API")
+    debug(f" - url: {api + '/v1/export'}")
+    debug(f" - params: {form_data}")
+    myrequest = lambda: requests.get(api + '/v1/export',
+                                     params = form_data,
+                                     auth = auth,
+                                     verify = requests_verify,
+                                     cert = requests_cert,
+                                     timeout = timeout,
+                                     stream = True)
+    response = requester_loop(myrequest, retries = retries)
+    debug(f" - response: {response}")
+    if response.status_code != 200:
+        err(f"Error, 'export' response status code was {response.status_code}")
+        return False, None
+    with open(output, 'wb') as fp:
+        for chunk in response.iter_content(chunk_size = 65536):
+            fp.write(chunk)
+    with tarfile.open(output, mode = 'r|gz') as tar:
+        member = tar.next()
+        if not member or member.name != 'SNAPSHOT':
+            err(f"Error, 'export' archive has no SNAPSHOT")
+            return False, None
+        jr = json.loads(tar.extractfile(member).read())
+    debug(f" - jr: {jr}")
+    return True, jr
+
+# Load the enrollments in 'input' (a .tar.gz produced by enroll_export()).
+# The archive is streamed to the server from disk. The returned JSON has the
+# number of entries 'added', those that already existed ('exists') or that
+# were 'rejected' (with 'errors' giving details for some of them).
+def enroll_import(api, input, requests_verify = True,
+                  requests_cert = False, retries = 0, timeout = 120):
+    debug("'import' handler about to call API")
+    debug(f" - url: {api + '/v1/import'}")
+    debug(f" - input: {input}")
+    def myrequest():
+        with open(input, 'rb') as fp:
+            return requests.post(api + '/v1/import',
+                                 data = fp,
+                                 headers = {
+                                     'Content-Type': 'application/gzip' },
+                                 auth = auth,
+                                 verify = requests_verify,
+                                 cert = requests_cert,
+                                 timeout = timeout)
+    response = requester_loop(myrequest, retries = retries)
+    debug(f" - response: {response}")
+    debug(f" - response.content: {response.content}")
+    if response.status_code != 200:
+        err(f"Error, 'import' response status code was {response.status_code}")
+        return False, None
+    try:
+        jr = json.loads(response.content)
+    except Exception as e:
+        log(f"Error, JSON decoding of 'import' response failed: {e}")
+        return False, None
+    debug(f" - jr: {jr}")
+    return True, jr
+
+def enroll_janitor(api, requests_verify = True, requests_cert = False,
+                   retries = 0, timeout = 120, full = False, status = False):
+    url = api + ('/v1/janitor/status' if status else '/v1/janitor')
+    params = { 'full': True } if full and not status else {}
     debug("'janitor' handler about to call API")
-    debug(f" - url: {api + '/v1/janitor'}")
-    myrequest = lambda: requests.get(api + '/v1/janitor',
+    debug(f" - url: {url}")
+    myrequest = lambda: requests.get(url,
+                                     params = params,
                                      auth = auth,
                                      verify = requests_verify,
                                      cert = requests_cert,
@@ -289,6 +567,25 @@ if __name__ == '__main__':
     parser_a.add_argument('--profile', help=add_help_profile, required=False)
     parser_a.set_defaults(func='add')
 
+    add_batch_help = 'Enroll many TPMs in one request'
+    add_batch_epilog = """
+    The 'add-batch' subcommand invokes the '/v1/add_batch' handler of the
+    Enrollment Service's management API, to enroll many TPMs with one API call
+    per '--chunk' TPMs (rather than one per TPM). The 'manifest' file lists the
+    TPMs to enroll, one JSON object per line, each with an 'ekpub' field (the
+    path to the EK public key file, as for 'add') and optionally a 'profile'
+    field (the enrollment profile, either as a JSON object or as a JSON
+    string). The output has a result for each line of the manifest, with a
+    'status' of 201 for success or 409 if the TPM was already enrolled.
+    """
+    add_batch_help_manifest = 'path to the (JSON lines) list of TPMs to enroll'
+    add_batch_help_chunk = 'max number of TPMs per API call'
+    parser_b = subparsers.add_parser('add-batch', help=add_batch_help, epilog=add_batch_epilog)
+    parser_b.add_argument('manifest', help=add_batch_help_manifest)
+    parser_b.add_argument('--chunk', type=int, metavar='<num>', default=100,
+                          help=add_batch_help_chunk)
+    parser_b.set_defaults(func='add-batch')
+
     reenroll_help = 'Re-enroll a TPM/host based on hash(EKpub)'
     reenroll_epilog = """
     The 'reenroll' subcommand invokes the '/v1/reenroll' handler of the Enrollment
@@ -311,13 +608,18 @@ if __name__ == '__main__':
     entries (respectively) will be returned. To query a specific entry, the query
     parameter should contain enough of the ekpubhash to uniquely distinguish it from
     all others. (Usually, this is significantly fewer characters than the full
-    ekpubhash value.)
+    ekpubhash value.) With '--page-size', the entries are retrieved that many at
+    a time and output one per line (JSON lines), rather than as one array, so
+    that arbitrarily large result sets can be handled.
     """
     query_help_ekpubhash = 'hexidecimal prefix (empty to return all enrollments)'
     query_help_nofiles = 'do not return file listings, just hostname and ekpubhash'
+    query_help_page_size = 'fetch this many entries per API call, and output one per line'
     parser_q = subparsers.add_parser('query', help=query_help, epilog=query_epilog)
     parser_q.add_argument('ekpubhash', help=query_help_ekpubhash)
     parser_q.add_argument('--nofiles', action='store_true', help=query_help_nofiles)
+    parser_q.add_argument('--page-size', type=int, metavar='<num>', default=None,
+                          help=query_help_page_size)
     parser_q.set_defaults(func='query')
 
     delete_help = 'Delete enrollments based on prefix-search of hash(EKpub)'
@@ -334,17 +636,107 @@ if __name__ == '__main__':
     parser_d = subparsers.add_parser('delete', help=delete_help, epilog=delete_epilog)
     parser_d.add_argument('ekpubhash', help=delete_help_ekpubhash)
     parser_d.add_argument('--nofiles', action='store_true', help=query_help_nofiles)
+    parser_d.add_argument('--page-size', type=int, metavar='<num>', default=None,
+                          help=query_help_page_size)
     parser_d.set_defaults(func='delete')
 
+    find_help = 'Find enrollments by hostname (regex or prefix)'
+    find_epilog = """
+    The 'find' subcommand invokes the '/v1/find' handler of the Enrollment
+    Service's management API, to retrieve the hostname and ekpubhash of all
+    enrollment entries whose hostname matches. By default the argument is a
+    regular expression, which is searched for anywhere in the hostname (so use
+    '^' and '$' to anchor it). With '--prefix', the argument is instead a literal
+    hostname prefix.
+    """
+    find_help_hostname = 'hostname regex (or prefix, with --prefix)'
+    find_help_prefix = 'treat the argument as a hostname prefix, not a regex'
+    parser_f = subparsers.add_parser('find', help=find_help, epilog=find_epilog)
+    parser_f.add_argument('hostname', help=find_help_hostname)
+    parser_f.add_argument('--prefix', action='store_true', help=find_help_prefix)
+    parser_f.set_defaults(func='find')
+
+    select_help = 'Select enrollments by (indexed) profile fields'
+    select_epilog = """
+    The 'select' subcommand invokes the '/v1/select' handler of the Enrollment
+    Service's management API, to retrieve the hostname and ekpubhash of all
+    enrollment entries whose profiles match all of the given conditions. Each
+    condition has the form 'field=value', where the field is one of those
+    indexed by the enrollment DB; 'hostname', 'realm', 'certgen' (matching any
+    of the profile's certgen types) or 'ktgen.api'. E.g.
+        select realm=HCPHACKING.XYZ certgen=pkinit-kdc
+    """
+    select_help_conditions = 'field=value conditions, all of which must match'
+    parser_s = subparsers.add_parser('select', help=select_help, epilog=select_epilog)
+    parser_s.add_argument('conditions', nargs='+', help=select_help_conditions)
+    parser_s.set_defaults(func='select')
+
+    changes_help = 'Retrieve changes made to the enrollment DB'
+    changes_epilog = """
+    The 'changes' subcommand invokes the '/v1/changes' handler of the Enrollment
+    Service's management API, to retrieve the journal of changes (adds, deletes
+    and reenrolls) made to the enrollment DB after a given sequence number. With
+    '--wait', the server waits up to that many seconds for a change to occur if
+    there are none yet. With '--follow', changes are output one per line (JSON
+    lines) as they occur, until interrupted.
+    """
+    changes_help_since = 'sequence number to retrieve changes after'
+    changes_help_wait = 'number of seconds to wait for a change'
+    changes_help_follow = 'keep waiting for (and outputting) changes'
+    parser_c = subparsers.add_parser('changes', help=changes_help, epilog=changes_epilog)
+    parser_c.add_argument('--since', type=int, metavar='<seq>', default=0,
+                          help=changes_help_since)
+    parser_c.add_argument('--wait', type=int, metavar='<secs>', default=0,
+                          help=changes_help_wait)
+    parser_c.add_argument('--follow', action='store_true', help=changes_help_follow)
+    parser_c.set_defaults(func='changes')
+
+    export_help = 'Export enrollments to a .tar.gz snapshot'
+    export_epilog = """
+    The 'export' subcommand invokes the '/v1/export' handler of the Enrollment
+    Service's management API, to retrieve a consistent snapshot of the
+    enrollments matching an ekpubhash prefix (all of them, by default), as a
+    .tar.gz archive that is written to 'output'. The output is the archive's
+    SNAPSHOT object, whose 'seq' can be passed to 'changes --since' to catch
+    up on changes made after the snapshot.
+    """
+    export_help_output = 'path to write the .tar.gz archive to'
+    export_help_ekpubhash = 'hexidecimal prefix of the enrollments to export'
+    parser_e = subparsers.add_parser('export', help=export_help, epilog=export_epilog)
+    parser_e.add_argument('output', help=export_help_output)
+    parser_e.add_argument('--ekpubhash', metavar='<hex>', default='',
+                          help=export_help_ekpubhash)
+    parser_e.set_defaults(func='export')
+
+    import_help = 'Import enrollments from a .tar.gz snapshot'
+    import_epilog = """
+    The 'import' subcommand invokes the '/v1/import' handler of the Enrollment
+    Service's management API, to load the enrollments in an archive produced
+    by 'export'. Enrollments that already exist are left as they are. The
+    output reports how many enrollments were added, already existed, or were
+    rejected.
+    """
+    import_help_input = 'path to the .tar.gz archive to import'
+    parser_i = subparsers.add_parser('import', help=import_help, epilog=import_epilog)
+    parser_i.add_argument('input', help=import_help_input)
+    parser_i.set_defaults(func='import')
+
     janitor_help = 'Scrub the enrollment DB to fix known issues, and rebuild hn2ek'
     janitor_epilog = """
     The 'janitor' subcommand invokes the '/v1/janitor' handler of the Enrollment
     Service's management API, to clean up known glitches that may be present in the
     enrollment DB (usually created by enrollment bugs
     that have since been fixed). It also rebuilds the reverse-lookup table, hn2ek,
-    from first principles.
+    from first principles. The janitor runs in the background on the server, and
+    by default only looks at the parts of the DB that have changed since it last
+    ran, use '--full' to have it look at everything. The output is the janitor's
+    status, use '--status' to only retrieve that (e.g. to monitor progress).
     """
+    janitor_help_full = 'check the entire DB, not just what has changed'
+    janitor_help_status = 'only report the janitor\'s status and progress'
     parser_j = subparsers.add_parser('janitor', help=janitor_help, epilog=janitor_epilog)
+    parser_j.add_argument('--full', action='store_true', help=janitor_help_full)
+    parser_j.add_argument('--status', action='store_true', help=janitor_help_status)
     parser_j.set_defaults(func='janitor')
 
     # Process the command-line
@@ -376,11 +768,42 @@ if __name__ == '__main__':
                                    requests_verify = requests_verify,
                                    requests_cert = requests_cert,
                                    timeout = args.timeout)
+        elif args.func == 'add-batch':
+            items = []
+            with open(args.manifest, 'r') as fp:
+                for line in fp:
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    profile = item.get('profile')
+                    if profile is not None and not isinstance(profile, str):
+                        profile = json.dumps(profile)
+                    items.append((item['ekpub'], profile))
+            result, j = True, { 'results': [] }
+            while result and len(items) > 0:
+                chunk = items[:args.chunk]
+                items = items[args.chunk:]
+                result, jchunk = enroll_add_batch(args.api, chunk,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+                if result:
+                    j['results'] += jchunk['results']
         elif args.func == 'reenroll':
             result, j = enroll_reenroll(args.api, args.ekpubhash,
                                    requests_verify = requests_verify,
                                    requests_cert = requests_cert,
                                    timeout = args.timeout)
+        elif args.func in [ 'query', 'delete' ] and args.page_size:
+            # Output as we go, rather than accumulating everything into 'j'
+            result, j = True, None
+            for entry in do_query_or_delete_iter(args.api, args.ekpubhash,
+                                   args.func == 'delete', args.nofiles,
+                                   page_size = args.page_size,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout):
+                print(json.dumps(entry))
         elif args.func == 'query':
             result, j = enroll_query(args.api, args.ekpubhash, args.nofiles,
                                    requests_verify = requests_verify,
@@ -391,11 +814,77 @@ if __name__ == '__main__':
                                    requests_verify = requests_verify,
                                    requests_cert = requests_cert,
                                    timeout = args.timeout)
+        elif args.func == 'find':
+            if args.prefix:
+                result, j = enroll_find(args.api,
+                                   hostname_prefix = args.hostname,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+            else:
+                result, j = enroll_find(args.api,
+                                   hostname_regex = args.hostname,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+        elif args.func == 'select':
+            conditions = []
+            for condition in args.conditions:
+                if '=' not in condition:
+                    raise Exception(f"bad condition (not field=value): {condition}")
+                conditions.append(tuple(condition.split('=', 1)))
+            # Follow the cursor until all the matches are in
+            result, j = True, { 'entries': [] }
+            cursor = None
+            while result:
+                result, js = enroll_select(args.api, conditions,
+                                   cursor = cursor,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+                if result:
+                    j['entries'] += js['entries']
+                    if 'next' not in js:
+                        break
+                    cursor = js['next']
+        elif args.func == 'changes' and args.follow:
+            result, j = True, None
+            since = args.since
+            while result:
+                result, jc = enroll_changes(args.api, since = since,
+                                   wait = args.wait if args.wait else 30,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+                if result:
+                    if 'reset' in jc:
+                        print(json.dumps({ 'reset': True }), flush = True)
+                    for change in jc['changes']:
+                        print(json.dumps(change), flush = True)
+                    since = jc['next']
+        elif args.func == 'changes':
+            result, j = enroll_changes(args.api, since = args.since,
+                                   wait = args.wait,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+        elif args.func == 'export':
+            result, j = enroll_export(args.api, args.output, args.ekpubhash,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
+        elif args.func == 'import':
+            result, j = enroll_import(args.api, args.input,
+                                   requests_verify = requests_verify,
+                                   requests_cert = requests_cert,
+                                   timeout = args.timeout)
         elif args.func == 'janitor':
             result, j = enroll_janitor(args.api,
                                    requests_verify = requests_verify,
                                    requests_cert = requests_cert,
-                                   timeout = args.timeout)
+                                   timeout = args.timeout,
+                                   full = args.full,
+                                   status = args.status)
         else:
             raise Exception("BUG")
     except Exception as e:
@@ -13,8 +13,14 @@ import requests
 import tempfile
 import glob
 import shutil
+import threading
+from collections import OrderedDict
 import hcp.flask.attestsvc as attestsvc
 from hcp.backend.common import *
+import hcp.backend.index as index
+from hcp.backend.pcrpolicy import Policies, PolicyError
+from hcp.backend.issuance import IssuanceCache
+from hcp.backend.keypool import pool_from_config
 import hcp.api.kdc as kapi
 from hcp.common import hcp_config_extract
 
@@ -25,16 +31,16 @@ requests_cert = hcp_config_extract('.backend.clientcert', must_exist = True)
 
 domain = hcp_config_extract('.vars.domain', must_exist = True)
 
-def add_secret(enrollpath, _input, output):
+def add_secret(ekpath, _input, output):
     c = subprocess.run(['/hcp/safeboot/api_seal',
-                        f"{enrollpath}/ek.pub",
+                        ekpath,
                         '/tmp/www-data-signer',
                         _input,
                         output])
     if c.returncode != 0:
         raise Exception("failed to seal secret")
 
-def add_public(enrollpath, _input, output):
+def add_public(_input, output):
     c = subprocess.run(['/hcp/safeboot/api_seal',
                         '-s',
                         '/tmp/www-data-signer',
@@ -46,16 +52,130 @@ def add_public(enrollpath, _input, output):
 class UnenrolledTPM(Exception):
     pass
 
+# Profiles (or the lack of an enrollment) are cached per uwsgi process, and
+# the enrollsvc's change journal (in the index that lives alongside the
+# enrollment DB) tells us precisely which entries to evict. If the journal is
+# unavailable, we don't cache. What's cached per enrollment is its profile
+# reference (see profile_ref()); the shared profile blobs it refers to are
+# cached separately (see profile_blob()).
+# TODO: configure
+PROFILE_CACHE_SIZE=100000
+_profile_cache = OrderedDict()
+_profile_cache_seq = None
+_profile_cache_lock = threading.Lock()
+
+def _profile_cache_sync():
+    global _profile_cache_seq
+    with index.transaction(immediate = False) as conn:
+        if _profile_cache_seq is None:
+            _profile_cache.clear()
+            _profile_cache_seq = index.journal_last(conn)
+            return
+        while True:
+            changes, reset = index.journal_since(conn, _profile_cache_seq)
+            if reset:
+                _profile_cache.clear()
+                _profile_cache_seq = index.journal_last(conn)
+                return
+            if not changes:
+                return
+            for change in changes:
+                _profile_cache.pop(change['ekpubhash'], None)
+                if issued:
+                    issued.invalidate(change['ekpubhash'])
+            _profile_cache_seq = changes[-1]['seq']
+
+# Returns the enrollment's profile (which the caller may modify), or None if
+# the TPM isn't enrolled.
+def get_profile(ekpubhash, enrollpath):
+    global _profile_cache_seq
+    with _profile_cache_lock:
+        try:
+            _profile_cache_sync()
+        except Exception as e:
+            attestsvc.debug(f"WARNING: profile cache disabled: {e}")
+            _profile_cache.clear()
+            _profile_cache_seq = None
+            return profile_load(enrollpath)
+        if ekpubhash in _profile_cache:
+            _profile_cache.move_to_end(ekpubhash)
+            return profile_merge(_profile_cache[ekpubhash])
+        ref = profile_ref(enrollpath)
+        _profile_cache[ekpubhash] = ref
+        if len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last = False)
+        return profile_merge(ref)
+
+# PCR policies, see hcp/backend/pcrpolicy.py. The named policies and golden
+# images come from '.backend.pcr_policies' and '.backend.pcr_golden' in the
+# HCP config. A profile picks its policy with 'pcr_policy' (a name, or an
+# inline policy), and otherwise '.backend.pcr_policy' (a name) applies. With
+# none of those, any platform state is accepted.
+pcr_policies = Policies(policies = backend_config('pcr_policies', default = {}),
+                        golden = backend_config('pcr_golden', default = {}),
+                        default = backend_config('pcr_policy'))
+
+# Issued credentials are cached, see hcp/backend/issuance.py. The cache lives
+# in '.backend.issuance_cache' (null disables it), and a credential is renewed
+# once '.backend.issuance_renewal' (a fraction) of its lifetime has passed.
+# Certificates live for the profile's 'days', keytabs don't expire as such, so
+# they're renewed as if they live for KEYTAB_LIFETIME seconds (in case the
+# principals have been rekeyed in the meantime).
+# TODO: configure
+KEYTAB_LIFETIME = 86400
+_issuance_root = backend_config('issuance_cache',
+                                default = '/tmp/www-data-issued')
+issued = IssuanceCache(_issuance_root,
+                       renewal = backend_config('issuance_renewal',
+                                                default = 0.5)) \
+    if _issuance_root else None
+
+# The keys for issued certificates come from a pool of pre-generated ones, see
+# hcp/backend/keypool.py, which lives in '.backend.keypool' (null disables it)
+# and holds up to '.backend.keypool_size' keys of each type, refilled when it
+# falls below '.backend.keypool_low'. If the pool is empty, hxtool generates
+# the key.
+CERT_KEY_TYPE = 'rsa-2048'
+keypool = pool_from_config()
+
+# Returns the cache stamp for the enrollment (see IssuanceCache.stamp()), or
+# None if the cache isn't to be used.
+def issuance_stamp(ekpubhash, profile):
+    if not issued:
+        return None
+    try:
+        with index.transaction(immediate = False) as conn:
+            seq = index.journal_latest(conn, ekpubhash)
+    except Exception as e:
+        attestsvc.debug(f"WARNING: issuance cache bypassed: {e}")
+        return None
+    return issued.stamp(seq, profile)
+
+# 'events' is the verified event log, if the host sent one, for policy clauses
+# that require particular events (see hcp/backend/pcrpolicy.py).
+def my_check_pcrs(ekpubhash, pcrs, events = None):
+    enrollpath = ekpubhash2path(ekpubhash)
+    profile = get_profile(ekpubhash, enrollpath)
+    if profile is None:
+        raise UnenrolledTPM(f"attestation of un-enrolled TPM: {ekpubhash}")
+    try:
+        policy = pcr_policies.lookup(profile.get('pcr_policy'))
+    except PolicyError as e:
+        # Fail closed
+        return f"bad PCR policy: {e}"
+    if policy and not policy.evaluate(pcrs, events):
+        return f"PCR policy '{policy.name}' not satisfied"
+    return None
+
 def my_get_assets(ekpubhash, outdir):
     enrollpath = ekpubhash2path(ekpubhash)
-    if not os.path.isdir(enrollpath):
+    profile = get_profile(ekpubhash, enrollpath)
+    if profile is None:
         raise UnenrolledTPM(f"attestation of un-enrolled TPM: {ekpubhash}")
-    profile = {}
-    if os.path.isfile(f"{enrollpath}/profile"):
-        with open(f"{enrollpath}/profile") as fp:
-            profile = json.loads(fp.read())
+    stamp = issuance_stamp(ekpubhash, profile)
     result = []
     with tempfile.TemporaryDirectory() as tempdir:
+        ekpath = ek_sealing_path(enrollpath, tempdir)
         certgen = profile['certgen'] if 'certgen' in profile else []
         realm = profile['realm'] if 'realm' in profile else None
         krb5conf = profile['krb5conf'] if 'krb5conf' in profile else None
@@ -63,16 +183,33 @@ def my_get_assets(ekpubhash, outdir):
         if ktgen:
             ktgenapi = ktgen.pop('api')
         hxcmd = [ 'hxtool', 'issue-certificate',
-                  '--generate-key=rsa', '--key-bits=2048',
                   f"--lifetime={str(profile['days'])}d" ]
-        def do_cert(filename, arguments):
-            cmd = hxcmd.copy() + arguments + \
-                [ f"--certificate=FILE:{tempdir}/{filename}" ]
-            c = subprocess.run(cmd)
-            if c.returncode != 0:
-                raise Exception(f"hxtool failed: {cmd}")
-            add_secret(enrollpath, f"{tempdir}/{filename}", f"{outdir}/{filename}")
+        # Seals the credential 'filename' from the cache, or from 'generate'
+        # (which writes it to the path it's given) if it isn't cached.
+        def do_secret(filename, lifetime, generate):
+            path = issued.get(ekpubhash, stamp, filename) if stamp else None
+            if not path:
+                path = f"{tempdir}/{filename}"
+                generate(path)
+                if stamp:
+                    try:
+                        issued.put(ekpubhash, stamp, filename, path, lifetime)
+                    except OSError as e:
+                        attestsvc.debug(f"WARNING: caching {filename} failed: {e}")
+            add_secret(ekpath, path, f"{outdir}/{filename}")
             result.append([f"{filename}", False])
+        def do_cert(filename, arguments):
+            def generate(path):
+                keyargs = [ '--generate-key=rsa', '--key-bits=2048' ]
+                keypath = f"{tempdir}/{filename}.key"
+                if keypool and keypool.take(CERT_KEY_TYPE, keypath):
+                    keyargs = [ f"--certificate-private-key=FILE:{keypath}" ]
+                cmd = hxcmd.copy() + keyargs + arguments + \
+                    [ f"--certificate=FILE:{path}" ]
+                c = subprocess.run(cmd)
+                if c.returncode != 0:
+                    raise Exception(f"hxtool failed: {cmd}")
+            do_secret(filename, int(profile['days']) * 86400, generate)
         for certtype in certgen:
             if certtype == 'https-server':
                 hostnames = profile['https-server-hostnames'] if \
@@ -150,7 +287,7 @@ def my_get_assets(ekpubhash, outdir):
                         domain = krb5conf['domain'],
                         dotdomain = krb5conf['dotdomain'],
                         kdchost = krb5conf['kdchost']))
-            add_public(enrollpath, f"{tempdir}/krb5.conf",
+            add_public(f"{tempdir}/krb5.conf",
                        f"{outdir}/krb5.conf")
             result.append([f"krb5.conf", True])
         if ktgen:
@@ -162,18 +299,18 @@ def my_get_assets(ekpubhash, outdir):
                     princs = [ princs ]
                 if not isinstance(princs, list):
                     raise Exception(f"ktgen[{name}] should be a str or list")
-                retcode, _ = kapi.kdc_ext_keytab(ktgenapi, princs, False,
-                                                 f"{tempdir}/keytab-{name}",
-                                                 requests_verify = requests_verify,
-                                                 requests_cert = requests_cert)
-                if not retcode:
-                    raise Exception(f"ktgen[{name}] failed")
-                add_secret(enrollpath, f"{tempdir}/keytab-{name}",
-                           f"{outdir}/keytab-{name}")
-                result.append([f"keytab-{name}", False])
+                def generate(path):
+                    retcode, _ = kapi.kdc_ext_keytab(ktgenapi, princs, False,
+                                                     path,
+                                                     requests_verify = requests_verify,
+                                                     requests_cert = requests_cert)
+                    if not retcode:
+                        raise Exception(f"ktgen[{name}] failed")
+                do_secret(f"keytab-{name}", KEYTAB_LIFETIME, generate)
         return result
 
 # Connect our hooks to the attestsvc
+attestsvc.backend_check_pcrs = my_check_pcrs
 attestsvc.backend_get_assets = my_get_assets
 attestsvc.backend_exception_unenrolled = UnenrolledTPM
 
@@ -1,12 +1,417 @@
+import os
+import json
+import copy
+import shutil
+import struct
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+import tpm2.ekpub
+from hcp.common import hcp_config_extract
+
+# The root of the enrollment DB, shared (via the 'backend' volume) between the
+# enrollsvc and the attestsvc. (The environment variable is for running
+# against some other DB, e.g. the benchmark in hcp/tool/enrollbench.py.)
+dbroot = os.environ.get('HCP_BACKEND_DBROOT', '/backend/db')
+
+# The backend's settings, from the '.backend' section of the HCP config (if
+# there is one, otherwise the default).
+def backend_config(field, default = None):
+    if 'HCP_CONFIG_FILE' not in os.environ:
+        return default
+    return hcp_config_extract(f".backend.{field}", or_default = True,
+                              default = default)
+
 # This will generate a glob-compatible wildcard string for any ekpubhash
 # inputs that are less than 32 bytes (64 hex characters).
 def ekpubhash2path(ekpubhash):
     if len(ekpubhash) < 2:
-        return f"/backend/db/{ekpubhash[0:2]}*/*/*"
+        return f"{dbroot}/{ekpubhash[0:2]}*/*/*"
     if len(ekpubhash) < 4:
-        return f"/backend/db/{ekpubhash[0:2]}/{ekpubhash[0:4]}*/*"
+        return f"{dbroot}/{ekpubhash[0:2]}/{ekpubhash[0:4]}*/*"
     if len(ekpubhash) < 64:
-        return f"/backend/db/{ekpubhash[0:2]}/{ekpubhash[0:4]}/{ekpubhash}*"
+        return f"{dbroot}/{ekpubhash[0:2]}/{ekpubhash[0:4]}/{ekpubhash}*"
     if len(ekpubhash) > 64:
         raise Exception('ekpubhash greater than 64 characters')
-    return f"/backend/db/{ekpubhash[0:2]}/{ekpubhash[0:4]}/{ekpubhash}"
+    return f"{dbroot}/{ekpubhash[0:2]}/{ekpubhash[0:4]}/{ekpubhash}"
+
+# Each enrollment is stored in one of two formats, at the path given by
+# ekpubhash2path() (the "enrollpath");
+# - "dirs": a directory at the enrollpath, holding one file per field
+#   ('ek.pub', 'ekpubhash', 'profile.ref', ...),
+# - "packed": a single record file at the enrollpath plus '.rec', holding all
+#   the fields, written atomically. Reading an entry is one open() and
+#   read(), and it costs one inode rather than one per field.
+# The format used for new enrollments is recorded in the DB itself (the
+# 'formatpath' file, absent meaning "dirs"), so the enrollsvc and attestsvc
+# agree on it. The readers below take an enrollpath and handle either format,
+# so a DB can be in the middle of being migrated (see
+# hcp/backend/migrate.py).
+formatpath = f"{dbroot}/.format"
+DB_FORMATS = [ 'dirs', 'packed' ]
+
+# The record format is versioned; a magic string, a version byte and a field
+# count, then each field as a (length-prefixed) name and (length-prefixed)
+# content. All big-endian.
+RECORD_MAGIC = b'HCPENR'
+RECORD_VERSION = 1
+
+class EntryError(Exception):
+    pass
+
+def db_format():
+    try:
+        with open(formatpath, 'r') as fp:
+            fmt = fp.read().strip()
+    except FileNotFoundError:
+        return 'dirs'
+    if fmt not in DB_FORMATS:
+        raise EntryError(f"unrecognized DB format: {fmt}")
+    return fmt
+
+def record_path(enrollpath):
+    return f"{enrollpath}.rec"
+
+def record_pack(files):
+    b = RECORD_MAGIC + struct.pack('>BH', RECORD_VERSION, len(files))
+    for name in sorted(files):
+        n = name.encode()
+        b += struct.pack('>H', len(n)) + n + \
+            struct.pack('>I', len(files[name])) + files[name]
+    return b
+
+def record_unpack(b):
+    if b[0:len(RECORD_MAGIC)] != RECORD_MAGIC:
+        raise EntryError('not an enrollment record')
+    offset = len(RECORD_MAGIC)
+    (version, count) = struct.unpack('>BH', b[offset:offset + 3])
+    if version != RECORD_VERSION:
+        raise EntryError(f"unsupported record version: {version}")
+    offset += 3
+    files = {}
+    try:
+        for _ in range(count):
+            (nlen,) = struct.unpack('>H', b[offset:offset + 2])
+            name = b[offset + 2:offset + 2 + nlen].decode()
+            offset += 2 + nlen
+            (dlen,) = struct.unpack('>I', b[offset:offset + 4])
+            files[name] = b[offset + 4:offset + 4 + dlen]
+            offset += 4 + dlen
+    except struct.error:
+        raise EntryError('truncated enrollment record')
+    return files
+
+# Returns the enrollment's fields as a dict of name to (bytes) content, or
+# None if it isn't enrolled.
+def entry_files(enrollpath):
+    try:
+        names = os.listdir(enrollpath)
+    except FileNotFoundError:
+        try:
+            with open(record_path(enrollpath), 'rb') as fp:
+                return record_unpack(fp.read())
+        except FileNotFoundError:
+            return None
+    files = {}
+    for name in names:
+        with open(f"{enrollpath}/{name}", 'rb') as fp:
+            files[name] = fp.read()
+    return files
+
+# Returns the (sorted) names of the enrollment's fields, or None.
+def entry_names(enrollpath):
+    try:
+        return sorted(os.listdir(enrollpath))
+    except FileNotFoundError:
+        files = entry_files(enrollpath)
+        return sorted(files) if files is not None else None
+
+# Returns the content of one of the enrollment's fields. Raises
+# FileNotFoundError if it (or the enrollment) doesn't exist.
+def entry_read(enrollpath, name):
+    try:
+        with open(f"{enrollpath}/{name}", 'rb') as fp:
+            return fp.read()
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    try:
+        with open(record_path(enrollpath), 'rb') as fp:
+            files = record_unpack(fp.read())
+    except FileNotFoundError:
+        raise FileNotFoundError(2, 'No such enrollment', enrollpath)
+    if name not in files:
+        raise FileNotFoundError(2, 'No such field', f"{enrollpath}/{name}")
+    return files[name]
+
+# Returns the filesystem path of the enrollment (a directory or a record), or
+# None if it isn't enrolled.
+def entry_path(enrollpath):
+    if os.path.isdir(enrollpath):
+        return enrollpath
+    if os.path.isfile(record_path(enrollpath)):
+        return record_path(enrollpath)
+    return None
+
+def entry_exists(enrollpath):
+    return entry_path(enrollpath) is not None
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_dirs(dirs):
+    for d in sorted(dirs):
+        fsync_path(d)
+
+# Writes 'data' (bytes) to 'path' atomically; it's written to a temporary file
+# alongside (a dot-file, with a random name, so concurrent writers don't
+# collide) and renamed into place. The file is created with 'mode'. With
+# 'sync', its content is fsync()d before the rename (the rename itself is only
+# durable once the directory is fsync()d, which is left to the caller).
+def write_atomic(path, data, mode = 0o600, sync = False):
+    tmppath = f"{os.path.dirname(path)}/.{secrets.token_hex(8)}.tmp"
+    fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.rename(tmppath, path)
+    except:
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+
+# A background thread that runs 'target' in each process. A thread started
+# before uwsgi forks its workers wouldn't survive the fork, so it's started by
+# the first call to started() in each process (which the users call on every
+# use). 'reset', if given, is called first, to replace the state (locks, etc)
+# inherited from the parent.
+class ProcessThread:
+    def __init__(self, target, reset = None):
+        self.target = target
+        self.reset = reset
+        self.pid = None
+
+    def started(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        if self.reset:
+            self.reset()
+        threading.Thread(target = self.target, daemon = True).start()
+
+# Installs the enrollment staged in the 'stagedir' directory at 'enrollpath',
+# in format 'fmt' (the DB's format, by default). The entry is assembled under
+# a '.tmp' name and renamed into place, so it appears atomically. The caller
+# must ensure no other install of the same enrollpath is in progress, so any
+# '.tmp' that already exists is debris from one that was interrupted. Raises
+# OSError on failure (having cleaned up).
+#
+# With 'sync', the entry's content is fsync()d before it is renamed into
+# place, so that it can't be torn by a crash. The rename itself is only
+# durable once the directories it changed are fsync()d, and that's left to the
+# caller (so that it can be done once for many entries), so the set of those
+# directories is returned.
+def entry_install(enrollpath, stagedir, fmt = None, sync = False):
+    if not fmt:
+        fmt = db_format()
+    parent = os.path.dirname(enrollpath)
+    changed = { parent }
+    if not os.path.isdir(parent):
+        changed |= { os.path.dirname(parent), dbroot }
+    if fmt == 'packed':
+        tmppath = f"{record_path(enrollpath)}.tmp"
+        try:
+            files = {}
+            for name in os.listdir(stagedir):
+                with open(f"{stagedir}/{name}", 'rb') as fp:
+                    files[name] = fp.read()
+            os.makedirs(parent, exist_ok = True)
+            with open(tmppath, 'wb') as fp:
+                fp.write(record_pack(files))
+                if sync:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            os.rename(tmppath, record_path(enrollpath))
+        except OSError:
+            try:
+                os.remove(tmppath)
+            except FileNotFoundError:
+                pass
+            raise
+        return changed
+    tmppath = f"{enrollpath}.tmp"
+    try:
+        if os.path.isdir(tmppath):
+            shutil.rmtree(tmppath)
+        os.makedirs(tmppath)
+        for name in os.listdir(stagedir):
+            shutil.move(f"{stagedir}/{name}", f"{tmppath}/{name}")
+            if sync:
+                fsync_path(f"{tmppath}/{name}")
+        if sync:
+            fsync_path(tmppath)
+        os.rename(tmppath, enrollpath)
+    except OSError:
+        shutil.rmtree(tmppath, ignore_errors = True)
+        raise
+    return changed
+
+# api_seal/tpm2-send seal to the EKpub in TPM2B_PUBLIC form. That's what the
+# HCP client enrolls ('tpm2 createek' output), but an 'ek.pub' that was
+# enrolled as PEM has to be converted, so that's done once, at enrollment
+# time, and the result stored alongside 'ek.pub' as 'ek.tpm2b', so that
+# sealing assets to the EK (on every attestation) doesn't have to redo it.
+# (An 'ek.pub' that's already TPM2B_PUBLIC gets no 'ek.tpm2b', it would only
+# be a copy.) Returns True if it wrote 'ek.tpm2b', False if there was nothing
+# to convert or the EKpub couldn't be converted (in which case sealing falls
+# back to using 'ek.pub' directly).
+def ek_precompute(enrollpath):
+    with open(f"{enrollpath}/ek.pub", 'rb') as fp:
+        ekpub = fp.read()
+    if tpm2.ekpub.is_tpm2b_public(ekpub):
+        return False
+    try:
+        tpm2b = tpm2.ekpub.to_tpm2b_public(ekpub)
+    except Exception:
+        return False
+    with open(f"{enrollpath}/ek.tpm2b", 'wb') as fp:
+        fp.write(tpm2b)
+    return True
+
+# The path of the EKpub to seal to, preferring the precomputed TPM2B_PUBLIC
+# form. For a packed enrollment, the EKpub is written out to 'tempdir'.
+def ek_sealing_path(enrollpath, tempdir):
+    for name in [ 'ek.tpm2b', 'ek.pub' ]:
+        if os.path.isfile(f"{enrollpath}/{name}"):
+            return f"{enrollpath}/{name}"
+    files = entry_files(enrollpath)
+    if files is None:
+        raise FileNotFoundError(2, 'No such enrollment', enrollpath)
+    name = 'ek.tpm2b' if 'ek.tpm2b' in files else 'ek.pub'
+    with open(f"{tempdir}/{name}", 'wb') as fp:
+        fp.write(files[name])
+    return f"{tempdir}/{name}"
+
+# Enrollment profiles are stored content-addressed. Most hosts are enrolled
+# with the same profile template, differing only in their hostname, so rather
+# than each enrollment having its own 'profile' file, the host-specific
+# fields (PROFILE_HOST_FIELDS) are split out and the rest of the profile is
+# stored once, as a canonical JSON blob named by its sha256, in 'profilespath'.
+# The enrollment gets a 'profile.ref' file instead, holding the blob's digest
+# and the host-specific fields (the 'override'). Enrollments that predate this
+# (or whose profile isn't a JSON object) still have a 'profile' file, and the
+# readers below handle both.
+profilespath = f"{dbroot}/.profiles"
+
+# TODO: configure
+PROFILE_HOST_FIELDS = [ 'hostname' ]
+
+def profile_canonical(profile):
+    return json.dumps(profile, sort_keys = True, separators = (',', ':'))
+
+# Converts the 'profile' file in 'enrollpath' (if there is one) to a
+# 'profile.ref', storing the shared part of the profile if it isn't already
+# stored. The blob's content is always synced, and the set of directories
+# that need syncing to make it durable (for a caller that syncs the entry,
+# see entry_install()) is returned. (That includes the profile store when the
+# blob was already there, as it may have been stored by an add that didn't
+# sync.)
+def profile_store(enrollpath):
+    try:
+        with open(f"{enrollpath}/profile", 'r') as fp:
+            profile = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return set()
+    if not isinstance(profile, dict):
+        return set()
+    changed = { profilespath }
+    override = {}
+    for field in PROFILE_HOST_FIELDS:
+        if field in profile:
+            override[field] = profile.pop(field)
+    blob = profile_canonical(profile)
+    digest = hashlib.sha256(blob.encode()).hexdigest()
+    blobpath = f"{profilespath}/{digest}"
+    if not os.path.isfile(blobpath):
+        if not os.path.isdir(profilespath):
+            os.makedirs(profilespath, exist_ok = True)
+            changed.add(dbroot)
+        # (Blobs are only written once, so always syncing them is cheap.)
+        write_atomic(blobpath, blob.encode(), mode = 0o644, sync = True)
+    with open(f"{enrollpath}/profile.ref", 'w') as fp:
+        json.dump({ 'sha256': digest, 'override': override }, fp)
+    os.remove(f"{enrollpath}/profile")
+    return changed
+
+# Returns a 2-tuple of (digest, override) for the enrollment's profile. For a
+# 'profile' file (rather than a 'profile.ref'), the digest is None and the
+# override is the whole profile. Returns (None, {}) if there's no profile,
+# and None if the enrollment doesn't exist.
+def profile_ref(enrollpath):
+    if os.path.isdir(enrollpath):
+        # Only read the file we need
+        files = {}
+        for name in [ 'profile.ref', 'profile' ]:
+            try:
+                with open(f"{enrollpath}/{name}", 'rb') as fp:
+                    files[name] = fp.read()
+                break
+            except FileNotFoundError:
+                pass
+    else:
+        files = entry_files(enrollpath)
+        if files is None:
+            return None
+    if 'profile.ref' in files:
+        ref = json.loads(files['profile.ref'])
+        return ref['sha256'], ref['override']
+    if 'profile' in files:
+        return None, json.loads(files['profile'])
+    return None, {}
+
+# The profile blobs are immutable (named by their content), so each process
+# parses each of them once, and keeps the most recently used ones. The result
+# is shared, callers mustn't modify it (profile_merge() gives them a copy).
+# TODO: configure
+PROFILE_BLOB_CACHE_SIZE = 1000
+_profile_blobs = OrderedDict()
+_profile_blobs_lock = threading.Lock()
+
+def profile_blob(digest):
+    with _profile_blobs_lock:
+        if digest in _profile_blobs:
+            _profile_blobs.move_to_end(digest)
+            return _profile_blobs[digest]
+    with open(f"{profilespath}/{digest}", 'r') as fp:
+        blob = json.load(fp)
+    with _profile_blobs_lock:
+        _profile_blobs[digest] = blob
+        if len(_profile_blobs) > PROFILE_BLOB_CACHE_SIZE:
+            _profile_blobs.popitem(last = False)
+    return blob
+
+# Returns the (full) profile for 'ref' (as returned by profile_ref()), which
+# the caller may modify, or None if 'ref' is None.
+def profile_merge(ref):
+    if ref is None:
+        return None
+    digest, override = ref
+    if digest is None:
+        return copy.deepcopy(override)
+    profile = copy.deepcopy(profile_blob(digest))
+    profile.update(copy.deepcopy(override))
+    return profile
+
+# Returns the enrollment's (full) profile, or None if the enrollment doesn't
+# exist.
+def profile_load(enrollpath):
+    return profile_merge(profile_ref(enrollpath))
@@ -15,71 +15,256 @@ import glob
 import shutil
 import hcp.flask.enrollsvc as enrollsvc
 from hcp.backend.common import *
+import hcp.backend.index as index
+import hcp.backend.janitor as janitor
+import hcp.backend.reaper as reaper
+from hcp.backend.groupcommit import GroupCommitter
 
 app = enrollsvc.app
 
-def my_add(tempdir):
+# Durability of adds, configured by '.backend.durability' in the HCP config;
+# - { "mode": "none" } (the default): an add is acknowledged once it's in
+#   place, but nothing is fsync()d, so a crash can lose it or leave it torn,
+# - { "mode": "group", "window_ms": <n> }: an add is only acknowledged once
+#   it's on disk. Adds that arrive within 'window_ms' of each other (default
+#   5) are committed as a group; each entry's content is synced, then the
+#   directories they were renamed into are synced once for the whole group,
+#   then the index. A bigger window means fewer (directory and index) syncs
+#   under load, at the cost of latency. (An add_batch is always one group.)
+durability = backend_config('durability', default = {})
+DURABILITY_MODE = durability.get('mode', 'none')
+DURABILITY_WINDOW = durability.get('window_ms', 5) / 1000
+if DURABILITY_MODE not in [ 'none', 'group' ]:
+    raise Exception(f"unrecognized durability mode: {DURABILITY_MODE}")
+
+# Moves the enrollment staged in 'tempdir' into the DB and adds it to the
+# index, as part of the caller's index transaction. Returns the same 2-tuple
+# as my_add. With 'dirs' (a set), the entry's content is synced and the
+# directories that need syncing to make it durable are added to 'dirs'.
+def add_one(conn, tempdir, dirs = None):
     # TBD: there's not a lot of error handling ...
     with open(f"{tempdir}/ekpubhash", 'r') as fp:
         ekpubhash = fp.read()
     enrollpath = ekpubhash2path(ekpubhash)
     result = {'ekpubhash': ekpubhash}
-    if os.path.isdir(enrollpath):
+    if index.exists(conn, ekpubhash) or entry_exists(enrollpath):
         result['error'] = 'TPM EK already enrolled'
         return result, 409
-    c = subprocess.run(['mkdir', '-p', f"{enrollpath}.tmp"])
-    for f in glob.iglob('*', root_dir = tempdir):
-        shutil.move(f"{tempdir}/{f}", f"{enrollpath}.tmp/")
-    c = subprocess.run(['mv', f"{enrollpath}.tmp", enrollpath])
+    ek_precompute(tempdir)
+    stored = profile_store(tempdir)
+    files = sorted(os.listdir(tempdir))
+    hostname = index.profile_hostname(tempdir)
+    attrs = index.profile_attrs(tempdir)
+    # The enrollment appears atomically, in the DB's format. We hold the
+    # index's write lock, so no other add of it is in progress (as
+    # entry_install() requires).
+    try:
+        changed = entry_install(enrollpath, tempdir, sync = dirs is not None)
+        if dirs is not None:
+            dirs |= changed | stored
+    except OSError as e:
+        result['error'] = f"failed to move enrollment into place: {e}"
+        return result, 500
+    index.add(conn, ekpubhash, files, hostname, attrs)
+    index.journal(conn, 'add', ekpubhash)
     # Success
     return result, 201
 
+# All the enrollments go in under a single index transaction (and so a single
+# commit). A failure of one entry doesn't prevent the others. Returns a list
+# of the 2-tuples from add_one(). The index transaction is held across the
+# moves into place, so that the index and the directory tree can't get out
+# of step (and so that concurrent adds of the same EK are serialized).
+def add_many(tempdirs, durable = False):
+    results = []
+    dirs = set() if durable else None
+    with index.transaction(durable = durable) as conn:
+        for tempdir in tempdirs:
+            try:
+                results.append(add_one(conn, tempdir, dirs = dirs))
+            except Exception as e:
+                results.append(({ 'error': f"{e}" }, 500))
+        if durable:
+            # Before the index commits, so that the index never refers to an
+            # entry that isn't durable.
+            fsync_dirs(dirs)
+    return results
+
+add_committer = GroupCommitter(lambda tempdirs: add_many(tempdirs, True),
+                               DURABILITY_WINDOW)
+
+def my_add(tempdir):
+    if DURABILITY_MODE == 'group':
+        return add_committer.submit(tempdir)
+    return add_many([ tempdir ])[0]
+
+def my_add_batch(tempdirs):
+    respjson = { "results": [] }
+    for result, resultcode in add_many(tempdirs,
+                                       durable = DURABILITY_MODE == 'group'):
+        result['status'] = resultcode
+        respjson['results'].append(result)
+    return respjson, 200
+
 # Same function for query, delete, and reenroll
-def my_qdr(op, ekpubhash, nofiles):
+def my_qdr(op, ekpubhash, nofiles, limit = None, cursor = None):
     respjson = { "entries": [] }
     prefix = ekpubhash
     did_anything = False
-    for match in glob.iglob(ekpubhash2path(prefix)):
-        did_anything = True
-        c = subprocess.run(['basename', match],
-                           stdout = subprocess.PIPE, text = True)
-        matchhash = c.stdout.strip()
-        newentry = {
-            'ekpubhash': matchhash
-        }
-        if not nofiles:
-            newentry['files'] = []
-            for f in glob.iglob("*", root_dir = match):
-                newentry['files'].append(f)
-        respjson['entries'].append(newentry)
-        if op == 'delete':
-            c = subprocess.run(['rm', '-rf', match])
-            if c.returncode != 0:
-                return respjson, 500
-        elif op == 'reenroll':
-            pass # no work required
-        elif op != 'query':
-            raise Exception('unrecognized op')
+    failed = False
+    with index.transaction(immediate = op != 'query') as conn:
+        # Fetch one more than the limit, to know whether there is a next page.
+        # (And don't modify the table while a range scan is running over it.)
+        matches = list(index.query(conn, prefix, after = cursor,
+                                   limit = limit + 1 if limit else None))
+        if limit and len(matches) > limit:
+            matches.pop()
+            respjson['next'] = matches[-1][0]
+        for matchhash, files in matches:
+            did_anything = True
+            newentry = {
+                'ekpubhash': matchhash
+            }
+            if not nofiles:
+                newentry['files'] = files
+            respjson['entries'].append(newentry)
+            if op == 'delete':
+                # The entry is moved to the trash (atomically), and the reaper
+                # reclaims it later, so this doesn't depend on the entry's
+                # size.
+                try:
+                    reaper.trash(ekpubhash2path(matchhash))
+                except FileNotFoundError:
+                    # Already gone from the tree, so just drop it from the
+                    # index
+                    pass
+                except OSError as e:
+                    # Commit the deletions that did succeed
+                    respjson['error'] = f"failed to delete {matchhash}: {e}"
+                    failed = True
+                    break
+                index.delete(conn, matchhash)
+                index.journal(conn, 'delete', matchhash)
+            elif op == 'reenroll':
+                # Nothing changes in the DB, but consumers of the journal
+                # need to know
+                index.journal(conn, 'reenroll', matchhash)
+            elif op != 'query':
+                raise Exception('unrecognized op')
+    if op == 'delete' and did_anything:
+        reaper.kick()
+    if failed:
+        return respjson, 500
     return respjson, 200 if op == 'query' or did_anything else 404
 
-def my_query(ekpubhash, nofiles):
-    return my_qdr('query', ekpubhash, nofiles)
+def my_query(ekpubhash, nofiles, **kwargs):
+    return my_qdr('query', ekpubhash, nofiles, **kwargs)
 
-def my_delete(ekpubhash, nofiles):
-    return my_qdr('delete', ekpubhash, nofiles)
+def my_delete(ekpubhash, nofiles, **kwargs):
+    return my_qdr('delete', ekpubhash, nofiles, **kwargs)
 
 def my_reenroll(ekpubhash, nofiles):
     return my_qdr('reenroll', ekpubhash, nofiles)
 
-def my_janitor():
-    return {}, 200
+def my_generation():
+    with index.transaction(immediate = False) as conn:
+        return index.generation(conn)
+
+def my_find(hostname_regex, hostname_prefix):
+    respjson = { "entries": [] }
+    with index.transaction(immediate = False) as conn:
+        for hostname, ekpubhash in index.find(conn, regex = hostname_regex,
+                                              prefix = hostname_prefix):
+            respjson['entries'].append({
+                'hostname': hostname,
+                'ekpubhash': ekpubhash
+            })
+    return respjson, 200
+
+def my_select(conditions, limit, cursor):
+    for field, _ in conditions:
+        if field not in index.INDEXED_FIELDS:
+            return { 'error': f"unindexed field: {field}",
+                     'fields': list(index.INDEXED_FIELDS) }, 400
+    respjson = { "entries": [] }
+    with index.transaction(immediate = False) as conn:
+        matches = list(index.select(conn, conditions, after = cursor,
+                                    limit = limit + 1))
+    if len(matches) > limit:
+        matches.pop()
+        respjson['next'] = matches[-1][0]
+    for ekpubhash, hostname in matches:
+        respjson['entries'].append({
+            'ekpubhash': ekpubhash,
+            'hostname': hostname
+        })
+    return respjson, 200
+
+def my_changes(since, limit):
+    with index.transaction(immediate = False) as conn:
+        changes, reset = index.journal_since(conn, since, limit = limit)
+        last = index.journal_last(conn)
+    respjson = {
+        'changes': changes,
+        'next': changes[-1]['seq'] if changes else max(since, 0),
+        'last': last
+    }
+    if reset:
+        respjson['reset'] = True
+        if not changes:
+            respjson['next'] = last
+    return respjson, 200
+
+# Returns a 2-tuple of (seq, entries), where 'seq' is the sequence number of
+# the last change (in the change journal) included in the snapshot, and
+# 'entries' is a generator of (ekpubhash, files) 2-tuples for each entry
+# matching 'prefix' in the snapshot, 'files' being a list of (name, data)
+# 2-tuples. Entries that are deleted while the generator is being consumed are
+# skipped (someone who wants an exact replica can follow the change journal
+# from 'seq').
+def _export(prefix):
+    with index.snapshot() as conn:
+        yield index.journal_last(conn)
+        for ekpubhash, _ in index.query(conn, prefix):
+            enrollpath = ekpubhash2path(ekpubhash)
+            contents = entry_files(enrollpath)
+            if contents is None:
+                continue
+            files = []
+            for name in sorted(contents):
+                if name == 'profile.ref':
+                    # Exported as a self-contained 'profile', as the
+                    # importing DB mightn't have the shared part.
+                    files.append(('profile', profile_canonical(
+                        profile_load(enrollpath)).encode()))
+                    continue
+                files.append((name, contents[name]))
+            yield ekpubhash, files
+
+def my_export(prefix):
+    entries = _export(prefix)
+    seq = next(entries)
+    return seq, entries
+
+def my_janitor(full):
+    return janitor.start(full = full), 200
+
+def my_janitor_status():
+    return janitor.get_status(), 200
 
 # Connect our hooks to the enrollsvc
 enrollsvc.backend_add = my_add
+enrollsvc.backend_add_batch = my_add_batch
 enrollsvc.backend_query = my_query
 enrollsvc.backend_delete = my_delete
 enrollsvc.backend_reenroll = my_reenroll
+enrollsvc.backend_generation = my_generation
+enrollsvc.backend_find = my_find
+enrollsvc.backend_select = my_select
+enrollsvc.backend_changes = my_changes
+enrollsvc.backend_export = my_export
 enrollsvc.backend_janitor = my_janitor
+enrollsvc.backend_janitor_status = my_janitor_status
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,47 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import time
+import threading
+
+# Group commit. Requests that arrive (in different threads) within 'window'
+# seconds of each other are committed together, by a single call to
+# 'commit_fn' with the list of their items, which returns a list of results
+# (one per item, in the same order). Each submit() returns its own result once
+# the whole batch has been committed. The first request to arrive when no
+# batch is forming becomes the batch's leader; it waits out the window, then
+# commits the batch on behalf of everyone in it. If 'commit_fn' raises, every
+# request in the batch gets the exception.
+class GroupCommitter:
+    def __init__(self, commit_fn, window):
+        self.commit_fn = commit_fn
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = []
+        self.forming = False
+
+    def submit(self, item):
+        slot = { 'item': item, 'done': threading.Event() }
+        with self.lock:
+            self.pending.append(slot)
+            leader = not self.forming
+            self.forming = True
+        if leader:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+                self.forming = False
+            try:
+                results = self.commit_fn([ s['item'] for s in batch ])
+                for s, result in zip(batch, results):
+                    s['result'] = result
+            except Exception as e:
+                for s in batch:
+                    s['error'] = e
+            for s in batch:
+                s['done'].set()
+        else:
+            slot['done'].wait()
+        if 'error' in slot:
+            raise slot['error']
+        return slot['result']
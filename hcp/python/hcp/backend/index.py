@@ -0,0 +1,432 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import os
+import sys
+import json
+import time
+import re
+import sqlite3
+import threading
+import bisect
+from contextlib import contextmanager
+from hcp.backend.common import *
+
+# The enrollment DB is a directory tree under 'dbroot', with each enrollment
+# living at ekpubhash2path(ekpubhash). Walking that tree with glob() to answer
+# prefix queries gets very expensive once there are a lot of enrollments, so
+# we also maintain an ordered index of the enrolled ekpubhash values (and the
+# files registered with each) in a SQLite DB alongside the tree. A prefix
+# query is then a range scan on the primary key.
+#
+# The index also carries the hostname from each enrollment's profile, which
+# gives us the reverse (hostname-to-ekpubhash, or "hn2ek") lookup, and a
+# 'generation' counter that is bumped by every change to the index. Selected
+# profile fields (INDEXED_FIELDS) are also indexed, in the 'attrs' table, so
+# that entries can be selected by them (see select()).
+#
+# Finally, the same DB holds the change journal; an append-only record of
+# every add, delete and reenroll, with monotonically increasing sequence
+# numbers, for consumers (caches, replicas, the attestsvc) to follow. Unlike
+# the rest of the index, the journal can't be regenerated from the tree, so
+# rebuilds leave it (and the generation) alone.
+#
+# The directory tree remains authoritative. The index is rebuilt from the tree
+# whenever it is missing or its schema doesn't match SCHEMA_VERSION, and
+# rebuild() can be run by hand (python3 -m hcp.backend.index) if it is ever
+# suspected of being out of sync.
+#
+# The index file is a dot-file so that it doesn't show up in any glob() of
+# the tree.
+
+indexpath = f"{dbroot}/.index.sqlite"
+
+SCHEMA_VERSION = 4
+
+# Each uwsgi worker thread gets its own connection.
+_local = threading.local()
+
+def _create(conn):
+    conn.execute('DROP TABLE IF EXISTS entries')
+    conn.execute('''CREATE TABLE entries (
+                        ekpubhash TEXT PRIMARY KEY,
+                        files TEXT NOT NULL,
+                        hostname TEXT
+                    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX entries_hostname ON entries (hostname)')
+    conn.execute('DROP TABLE IF EXISTS attrs')
+    conn.execute('''CREATE TABLE attrs (
+                        field TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        ekpubhash TEXT NOT NULL,
+                        PRIMARY KEY (field, value, ekpubhash)
+                    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX attrs_ekpubhash ON attrs (ekpubhash)')
+    # The generation survives rebuilds, so that it never goes backwards.
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL
+                    ) WITHOUT ROWID''')
+    conn.execute('''INSERT OR IGNORE INTO meta (key, value)
+                    VALUES ('generation', 0)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS changes (
+                        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                        op TEXT NOT NULL,
+                        ekpubhash TEXT NOT NULL,
+                        time INTEGER NOT NULL
+                    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS changes_ekpubhash
+                    ON changes (ekpubhash, seq)''')
+
+def _connect():
+    conn = sqlite3.connect(indexpath, timeout = 60, isolation_level = None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        conn.execute('BEGIN EXCLUSIVE')
+        try:
+            # Someone else may have beaten us to it
+            if conn.execute('PRAGMA user_version').fetchone()[0] != \
+                    SCHEMA_VERSION:
+                _create(conn)
+                _populate(conn)
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    return conn
+
+def connection():
+    conn = getattr(_local, 'conn', None)
+    if not conn:
+        conn = _connect()
+        _local.conn = conn
+    return conn
+
+# Usage;
+#     with transaction() as conn:
+#         ...
+# The transaction commits if the block completes and rolls back if it raises.
+# Writers should use the default ('immediate'), which takes the write lock up
+# front and so serializes against other writers (in other threads and other
+# uwsgi processes). Readers can pass immediate=False to get a consistent
+# snapshot without blocking writers.
+#
+# Commits are normally only durable once the WAL is checkpointed (the index
+# can be rebuilt from the tree, so losing the last few commits in a crash is
+# tolerable). With durable=True, the commit is synced to disk before it
+# returns.
+@contextmanager
+def transaction(immediate = True, durable = False):
+    conn = connection()
+    if durable:
+        conn.execute('PRAGMA synchronous=FULL')
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        if durable:
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+# Usage;
+#     with snapshot() as conn:
+#         ...
+# A read transaction on a connection of its own, for long-running readers
+# (e.g. a streaming response) that shouldn't tie up the thread's connection.
+# The view of the index is fixed for the duration.
+@contextmanager
+def snapshot():
+    conn = _connect()
+    conn.execute('BEGIN')
+    try:
+        # (The snapshot is only established by the first read)
+        conn.execute('SELECT COUNT(*) FROM meta').fetchone()
+        yield conn
+    finally:
+        conn.execute('ROLLBACK')
+        conn.close()
+
+# Returns the [lower,upper) bounds for a range scan of 'prefix'. (ekpubhash
+# values are lower-case hex, so anything that sorts after the prefix followed
+# by the highest code-point is outside the prefix.)
+def _prefix_range(prefix):
+    if len(prefix) > 64:
+        raise Exception('ekpubhash greater than 64 characters')
+    return prefix, prefix + '\U0010ffff'
+
+def exists(conn, ekpubhash):
+    c = conn.execute('SELECT 1 FROM entries WHERE ekpubhash = ?',
+                     (ekpubhash,))
+    return c.fetchone() is not None
+
+# Yields (ekpubhash, files) 2-tuples, in ekpubhash order, for all entries
+# matching 'prefix'. An empty prefix matches everything. If 'after' is set,
+# only entries that sort after it are returned, and if 'limit' is set, no more
+# than that many are returned. (Together these give keyset pagination.)
+def query(conn, prefix, after = None, limit = None):
+    lower, upper = _prefix_range(prefix)
+    sql = 'SELECT ekpubhash, files FROM entries WHERE ekpubhash < ?'
+    sqlargs = [ upper ]
+    if after is not None and after >= lower:
+        sql += ' AND ekpubhash > ?'
+        sqlargs.append(after)
+    else:
+        sql += ' AND ekpubhash >= ?'
+        sqlargs.append(lower)
+    sql += ' ORDER BY ekpubhash'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        sqlargs.append(limit)
+    c = conn.execute(sql, sqlargs)
+    for ekpubhash, files in c:
+        yield ekpubhash, json.loads(files)
+
+# Returns a (files, hostname) 2-tuple for the entry, or None if there's no
+# such entry.
+def lookup(conn, ekpubhash):
+    c = conn.execute('SELECT files, hostname FROM entries WHERE ekpubhash = ?',
+                     (ekpubhash,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return json.loads(row[0]), row[1]
+
+# Returns the entry's indexed (field, value) pairs, sorted.
+def attrs(conn, ekpubhash):
+    c = conn.execute('''SELECT field, value FROM attrs WHERE ekpubhash = ?
+                        ORDER BY field, value''', (ekpubhash,))
+    return [ tuple(row) for row in c ]
+
+# 'attrs' is the entry's indexed (field, value) pairs, see profile_attrs().
+def add(conn, ekpubhash, files, hostname = None, attrs = ()):
+    conn.execute('''INSERT INTO entries (ekpubhash, files, hostname)
+                    VALUES (?, ?, ?)''',
+                 (ekpubhash, json.dumps(files), hostname))
+    conn.executemany('''INSERT OR IGNORE INTO attrs (field, value, ekpubhash)
+                        VALUES (?, ?, ?)''',
+                     [ (field, value, ekpubhash) for field, value in attrs ])
+    _bump(conn)
+
+def delete(conn, ekpubhash):
+    conn.execute('DELETE FROM entries WHERE ekpubhash = ?', (ekpubhash,))
+    conn.execute('DELETE FROM attrs WHERE ekpubhash = ?', (ekpubhash,))
+    _bump(conn)
+
+# Yields (ekpubhash, hostname) 2-tuples, in ekpubhash order, for the entries
+# that match all of 'conditions', a list of (field, value) 2-tuples. 'after'
+# and 'limit' paginate, as with query(). Each condition is a lookup in the
+# attrs table's primary key, so this doesn't scan the entries.
+def select(conn, conditions, after = None, limit = None):
+    sqls = []
+    sqlargs = []
+    for field, value in conditions:
+        if field not in INDEXED_FIELDS:
+            raise Exception(f"unindexed field: {field}")
+        sql = 'SELECT ekpubhash FROM attrs WHERE field = ? AND value = ?'
+        sqlargs += [ field, value ]
+        if after is not None:
+            sql += ' AND ekpubhash > ?'
+            sqlargs.append(after)
+        sqls.append(sql)
+    sql = f"""SELECT m.ekpubhash, e.hostname
+              FROM ({' INTERSECT '.join(sqls)}) AS m
+              JOIN entries AS e ON e.ekpubhash = m.ekpubhash
+              ORDER BY m.ekpubhash"""
+    if limit is not None:
+        sql += ' LIMIT ?'
+        sqlargs.append(limit)
+    for row in conn.execute(sql, sqlargs):
+        yield row[0], row[1]
+
+def generation(conn):
+    c = conn.execute("SELECT value FROM meta WHERE key = 'generation'")
+    return c.fetchone()[0]
+
+def _bump(conn):
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+# Append a change ('add', 'delete' or 'reenroll') to the journal, as part of
+# the caller's transaction.
+def journal(conn, op, ekpubhash):
+    conn.execute('INSERT INTO changes (op, ekpubhash, time) VALUES (?, ?, ?)',
+                 (op, ekpubhash, int(time.time())))
+
+# Returns the sequence number of the most recent change (0 if there have been
+# none).
+def journal_last(conn):
+    c = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+    row = c.fetchone()
+    return row[0] if row else 0
+
+# Returns the sequence number of the most recent change to 'ekpubhash', or
+# None if there's none in the journal.
+def journal_latest(conn, ekpubhash):
+    c = conn.execute('SELECT MAX(seq) FROM changes WHERE ekpubhash = ?',
+                     (ekpubhash,))
+    return c.fetchone()[0]
+
+# Returns a 2-tuple of (changes, reset), where 'changes' is a list of up to
+# 'limit' changes (as dicts) with sequence numbers greater than 'since', in
+# order. If 'reset' is True, the journal has been trimmed past 'since', so
+# changes have been lost and the caller should discard anything it derived
+# from the journal and start again.
+def journal_since(conn, since, limit = 1000):
+    c = conn.execute('SELECT MIN(seq) FROM changes')
+    first = c.fetchone()[0]
+    reset = first is not None and since < first - 1
+    if first is None:
+        reset = since < journal_last(conn)
+    c = conn.execute('''SELECT seq, op, ekpubhash, time FROM changes
+                        WHERE seq > ? ORDER BY seq LIMIT ?''', (since, limit))
+    changes = [ { 'seq': seq, 'op': op, 'ekpubhash': ekpubhash, 'time': t }
+                for seq, op, ekpubhash, t in c ]
+    return changes, reset
+
+# Discard all but the most recent 'keep' changes from the journal.
+def journal_trim(conn, keep):
+    conn.execute('DELETE FROM changes WHERE seq <= ?',
+                 (journal_last(conn) - keep,))
+
+# Returns the hostname from the profile in an enrollment (or in the tempdir
+# of an enrollment that is being added), or None if it has no profile or the
+# profile has no hostname.
+def profile_hostname(enrollpath):
+    # The hostname is a host-specific field, so for a 'profile.ref' it's in
+    # the override and the shared blob needn't be read.
+    try:
+        ref = profile_ref(enrollpath)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if ref is None or not isinstance(ref[1], dict):
+        return None
+    hostname = ref[1].get('hostname')
+    return hostname if isinstance(hostname, str) else None
+
+# The profile fields that are indexed, and how to get their value(s) from a
+# profile. (A field can have many values, e.g. one per certgen type.)
+def _field_values(v):
+    if isinstance(v, str):
+        return [ v ]
+    if isinstance(v, list):
+        return [ x for x in v if isinstance(x, str) ]
+    return []
+
+INDEXED_FIELDS = {
+    'hostname': lambda p: _field_values(p.get('hostname')),
+    'realm': lambda p: _field_values(p.get('realm')),
+    'certgen': lambda p: _field_values(p.get('certgen')),
+    'ktgen.api': lambda p: _field_values(p['ktgen'].get('api'))
+                     if isinstance(p.get('ktgen'), dict) else [],
+}
+
+# Returns the sorted (field, value) pairs to index for the enrollment at
+# 'enrollpath'.
+def profile_attrs(enrollpath):
+    try:
+        profile = profile_merge(profile_ref(enrollpath))
+    except (KeyError, TypeError, ValueError, OSError, EntryError):
+        return []
+    if not isinstance(profile, dict):
+        return []
+    result = set()
+    for field, values in INDEXED_FIELDS.items():
+        for value in values(profile):
+            result.add((field, value))
+    return sorted(result)
+
+# The hn2ek table is served from memory. Each uwsgi process keeps a copy,
+# sorted by hostname, and reloads it from the index when the generation has
+# moved on (which happens when this or any other process adds or deletes an
+# enrollment).
+_hn2ek_lock = threading.Lock()
+_hn2ek_generation = None
+_hn2ek_hostnames = []
+_hn2ek_ekpubhashes = []
+
+def _hn2ek_refresh(conn):
+    global _hn2ek_generation, _hn2ek_hostnames, _hn2ek_ekpubhashes
+    gen = generation(conn)
+    with _hn2ek_lock:
+        if gen == _hn2ek_generation:
+            return _hn2ek_hostnames, _hn2ek_ekpubhashes
+        c = conn.execute('''SELECT hostname, ekpubhash FROM entries
+                            WHERE hostname IS NOT NULL
+                            ORDER BY hostname, ekpubhash''')
+        hostnames = []
+        ekpubhashes = []
+        for hostname, ekpubhash in c:
+            hostnames.append(hostname)
+            ekpubhashes.append(ekpubhash)
+        _hn2ek_generation = gen
+        _hn2ek_hostnames = hostnames
+        _hn2ek_ekpubhashes = ekpubhashes
+        return hostnames, ekpubhashes
+
+# Yields (hostname, ekpubhash) 2-tuples, in hostname order, for all entries
+# whose hostname matches. If 'regex' is set, it is searched for (re.search())
+# in each hostname, otherwise 'prefix' is used for a prefix match (an empty
+# prefix matches every entry that has a hostname).
+def find(conn, regex = None, prefix = ''):
+    hostnames, ekpubhashes = _hn2ek_refresh(conn)
+    if regex is not None:
+        r = re.compile(regex)
+        for i, hostname in enumerate(hostnames):
+            if r.search(hostname):
+                yield hostname, ekpubhashes[i]
+        return
+    i = bisect.bisect_left(hostnames, prefix)
+    while i < len(hostnames) and hostnames[i].startswith(prefix):
+        yield hostnames[i], ekpubhashes[i]
+        i += 1
+
+# Returns the ekpubhash of the enrollment that a name in an 'xx/xxxx'
+# directory holds (in either format), else None.
+def tree_entry(name):
+    if name.endswith('.rec'):
+        name = name[:-4]
+    return name if len(name) == 64 else None
+
+# Generator for all (ekpubhash, enrollpath) pairs present in the directory
+# tree. In-progress (or abandoned) '.tmp' enrollments are skipped.
+def walk_tree():
+    def subdirs(path, namelen):
+        try:
+            with os.scandir(path) as it:
+                names = sorted(e.name for e in it
+                               if e.is_dir() and len(e.name) == namelen)
+        except FileNotFoundError:
+            return []
+        return names
+    for l1 in subdirs(dbroot, 2):
+        for l2 in subdirs(f"{dbroot}/{l1}", 4):
+            l2path = f"{dbroot}/{l1}/{l2}"
+            # (An entry can briefly be in both formats while it's being
+            # migrated.)
+            hashes = set(tree_entry(name) for name in os.listdir(l2path))
+            hashes.discard(None)
+            for ekpubhash in sorted(hashes):
+                yield ekpubhash, f"{l2path}/{ekpubhash}"
+
+def _populate(conn):
+    for ekpubhash, enrollpath in walk_tree():
+        names = entry_names(enrollpath)
+        if names is not None:
+            add(conn, ekpubhash, names, profile_hostname(enrollpath),
+                profile_attrs(enrollpath))
+
+# Discard the index and regenerate it from the directory tree.
+def rebuild():
+    with transaction() as conn:
+        _create(conn)
+        _populate(conn)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+if __name__ == '__main__':
+    rebuild()
+    with transaction(immediate = False) as conn:
+        num = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+    print(f"Rebuilt {indexpath}: {num} entries", file = sys.stderr)
@@ -0,0 +1,92 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import os
+import json
+import time
+import shutil
+import hashlib
+from hcp.backend.common import profile_canonical, write_atomic
+
+# The attestsvc's cache of issued credentials (certificates and keytabs), so
+# that a host re-attesting on its usual period gets the credentials it was
+# issued last time, rather than new ones, until they're due for renewal. (The
+# credentials are still sealed to the EK on every attestation, the cache is
+# only of what goes into the sealing.) The cache is on disk, so it's shared by
+# all the workers;
+#
+#     <root>/<ekpubhash>/<stamp>/<asset>         the credential
+#     <root>/<ekpubhash>/<stamp>/<asset>.meta    { "issued": t, "expires": t }
+#
+# where the directories are 0700 and the files 0600. A credential is renewed
+# (i.e. not returned from the cache) once 'renewal' (a fraction) of its
+# lifetime has passed.
+#
+# The 'stamp' identifies the state of the enrollment that the credentials were
+# issued for; the latest change to it in the enrollsvc's journal (so reenroll
+# and delete invalidate) and its profile (so a profile change does too). On a
+# new stamp nothing older is used, and the old stamps are removed when the
+# first credential for the new one is stored. The attestsvc also removes an
+# enrollment's credentials as soon as it sees a change in the journal.
+
+class IssuanceCache:
+    def __init__(self, root, renewal = 0.5):
+        self.root = root
+        self.renewal = renewal
+
+    # 'seq' is the sequence number of the enrollment's latest change (or
+    # None), 'profile' is its (unmodified) profile.
+    def stamp(self, seq, profile):
+        return hashlib.sha256(
+            f"{seq}\0{profile_canonical(profile)}".encode()).hexdigest()[0:32]
+
+    def _dir(self, ekpubhash, stamp = None):
+        if not ekpubhash or '/' in ekpubhash or ekpubhash.startswith('.'):
+            raise ValueError(f"bad ekpubhash: {ekpubhash}")
+        if stamp is None:
+            return f"{self.root}/{ekpubhash}"
+        return f"{self.root}/{ekpubhash}/{stamp}"
+
+    # Asset names come from the profile, only simple names are cached.
+    def _cacheable(self, name):
+        return name and '/' not in name and not name.startswith('.')
+
+    # Returns the path of the cached credential, or None if there isn't one
+    # or it's due for renewal.
+    def get(self, ekpubhash, stamp, name):
+        if not self._cacheable(name):
+            return None
+        path = f"{self._dir(ekpubhash, stamp)}/{name}"
+        try:
+            with open(f"{path}.meta", 'r') as fp:
+                meta = json.load(fp)
+            renew = meta['issued'] + \
+                self.renewal * (meta['expires'] - meta['issued'])
+            if time.time() >= renew or not os.path.isfile(path):
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return path
+
+    # Stores the credential at 'src' (valid for 'lifetime' seconds). Raises
+    # OSError if it can't.
+    def put(self, ekpubhash, stamp, name, src, lifetime):
+        if not self._cacheable(name):
+            return
+        base = self._dir(ekpubhash)
+        path = f"{base}/{stamp}/{name}"
+        for d in [ self.root, base, f"{base}/{stamp}" ]:
+            try:
+                os.mkdir(d, mode = 0o700)
+            except FileExistsError:
+                pass
+        with open(src, 'rb') as fp:
+            write_atomic(path, fp.read())
+        now = time.time()
+        write_atomic(f"{path}.meta", json.dumps({
+            'issued': now,
+            'expires': now + lifetime }).encode())
+        for old in os.listdir(base):
+            if old != stamp:
+                shutil.rmtree(f"{base}/{old}", ignore_errors = True)
+
+    def invalidate(self, ekpubhash):
+        shutil.rmtree(self._dir(ekpubhash), ignore_errors = True)
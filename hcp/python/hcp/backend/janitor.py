@@ -0,0 +1,258 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+from hcp.backend.common import *
+import hcp.backend.index as index
+import hcp.backend.reaper as reaper
+
+# The enrollsvc janitor. It walks the enrollment DB looking for (and fixing,
+# where it can) known issues;
+# - '.tmp' enrollments left behind by an add that was interrupted are removed,
+# - entries whose 'ekpubhash' or 'ek.pub' don't match the entry's name are
+#   reported,
+# - entries that predate the precomputation of EK-derived material (see
+#   ek_precompute()) get it,
+# - entries with a 'profile' file have it moved to the content-addressed
+#   profile store (see profile_store()),
+# - the reaper is kicked, in case deleted entries were left in the trash,
+# - the index (and so the hn2ek table) is reconciled with the tree.
+#
+# The DB can be huge, so the janitor runs as a background thread in whichever
+# uwsgi worker started it (a lock file ensures there's only ever one, across
+# all workers), and it is incremental; the mtime of every 'xx/xxxx' directory
+# is recorded when it is scanned, and later runs skip directories whose mtime
+# hasn't changed (unless a 'full' run is requested). Progress is checkpointed
+# after each 'xx' directory, so a run that is interrupted (the worker being
+# restarted, say) picks up where it left off the next time the janitor runs.
+
+lockpath = f"{dbroot}/.janitor.lock"
+statuspath = f"{dbroot}/.janitor.json"
+
+# Cap on the number of problems reported in the status
+MAX_PROBLEMS = 100
+
+# The number of changes to keep in the change journal, older ones are trimmed
+# at the end of each janitor run
+JOURNAL_KEEP = 1000000
+
+def _mtimes_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS janitor_dirs (
+                        path TEXT PRIMARY KEY,
+                        mtime INTEGER NOT NULL
+                    ) WITHOUT ROWID''')
+
+def load_status():
+    try:
+        with open(statuspath, 'r') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_status(status):
+    write_atomic(statuspath, json.dumps(status).encode(), mode = 0o644)
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except FileNotFoundError:
+        return []
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _verify(ekpubhash, enrollpath):
+    try:
+        if entry_read(enrollpath, 'ekpubhash').decode().strip() != ekpubhash:
+            return 'ekpubhash file mismatch'
+        if hashlib.sha256(entry_read(enrollpath, 'ek.pub')).hexdigest() != \
+                ekpubhash:
+            return 'ek.pub hash mismatch'
+    except FileNotFoundError as e:
+        return f"missing file: {os.path.basename(e.filename)}"
+    except EntryError as e:
+        return f"{e}"
+    return None
+
+# Scan one 'xx/xxxx' directory. This is done under the index's write lock, so
+# no add is in progress, meaning any '.tmp' enrollment is stale.
+def _scan_l2(conn, l2path, l2, status):
+    names = _listdir(l2path)
+    intree = {}
+    unreadable = set()
+    fmt = db_format()
+    for name in names:
+        if name.endswith('.tmp'):
+            if os.path.isdir(f"{l2path}/{name}"):
+                shutil.rmtree(f"{l2path}/{name}", ignore_errors = True)
+            else:
+                os.remove(f"{l2path}/{name}")
+            status['tmp_removed'] += 1
+            continue
+        name = index.tree_entry(name)
+        if not name or name in intree or name in unreadable:
+            continue
+        enrollpath = f"{l2path}/{name}"
+        if os.path.isdir(enrollpath) and \
+                os.path.isfile(record_path(enrollpath)):
+            # A migration was interrupted between creating the entry in one
+            # format and removing it in the other. Keep the DB's format.
+            if fmt == 'packed':
+                shutil.rmtree(enrollpath)
+            else:
+                os.remove(record_path(enrollpath))
+        status['entries_checked'] += 1
+        problem = _verify(name, enrollpath)
+        if problem:
+            status['problems_found'] += 1
+            if len(status['problems']) < MAX_PROBLEMS:
+                status['problems'].append({ 'ekpubhash': name,
+                                            'problem': problem })
+        elif os.path.isdir(enrollpath):
+            # (Packed entries get these when they're migrated.)
+            if not os.path.isfile(f"{enrollpath}/ek.tpm2b") and \
+                    ek_precompute(enrollpath):
+                status['ek_precomputed'] += 1
+            if os.path.isfile(f"{enrollpath}/profile"):
+                profile_store(enrollpath)
+                if not os.path.isfile(f"{enrollpath}/profile"):
+                    status['profiles_stored'] = \
+                        status.get('profiles_stored', 0) + 1
+        try:
+            intree[name] = (entry_names(enrollpath),
+                            index.profile_hostname(enrollpath),
+                            index.profile_attrs(enrollpath))
+        except EntryError:
+            # (Already reported as a problem.) Leave the index as it is.
+            unreadable.add(name)
+    inindex = [ h for h, _ in index.query(conn, l2) ]
+    for h in inindex:
+        if h not in intree and h not in unreadable:
+            index.delete(conn, h)
+            index.journal(conn, 'delete', h)
+            status['index_fixed'] += 1
+    for h, (files, hostname, attrs) in intree.items():
+        current = index.lookup(conn, h)
+        if current == (files, hostname) and index.attrs(conn, h) == attrs:
+            continue
+        if current:
+            index.delete(conn, h)
+        index.add(conn, h, files, hostname, attrs)
+        index.journal(conn, 'add', h)
+        status['index_fixed'] += 1
+
+def _run(lockfp, full):
+    status = load_status()
+    resume = status.get('position') if status.get('state') == 'running' \
+        else None
+    if not resume:
+        status = {
+            'started': int(time.time()),
+            'full': full,
+            'dirs_scanned': 0,
+            'dirs_skipped': 0,
+            'entries_checked': 0,
+            'tmp_removed': 0,
+            'ek_precomputed': 0,
+            'profiles_stored': 0,
+            'index_fixed': 0,
+            'problems_found': 0,
+            'problems': [],
+            'last_completed': status.get('last_completed')
+        }
+    full = status['full']
+    status['state'] = 'running'
+    status['pid'] = os.getpid()
+    _save_status(status)
+    try:
+        with index.transaction() as conn:
+            _mtimes_table(conn)
+        for l1 in [ f"{i:02x}" for i in range(256) ]:
+            if resume and l1 <= resume:
+                continue
+            l1path = f"{dbroot}/{l1}"
+            l2s = [ l2 for l2 in _listdir(l1path)
+                    if len(l2) == 4 and l2.startswith(l1) ]
+            for l2 in l2s:
+                l2path = f"{l1path}/{l2}"
+                with index.transaction() as conn:
+                    c = conn.execute('''SELECT mtime FROM janitor_dirs
+                                        WHERE path = ?''', (l2,))
+                    row = c.fetchone()
+                    if not full and row and row[0] == _mtime(l2path):
+                        status['dirs_skipped'] += 1
+                        continue
+                    _scan_l2(conn, l2path, l2, status)
+                    status['dirs_scanned'] += 1
+                    conn.execute('''INSERT OR REPLACE INTO janitor_dirs
+                                    (path, mtime) VALUES (?, ?)''',
+                                 (l2, _mtime(l2path)))
+            # Index entries whose 'xx/xxxx' directory is gone altogether
+            with index.transaction() as conn:
+                for h, _ in list(index.query(conn, l1)):
+                    if h[0:4] not in l2s:
+                        index.delete(conn, h)
+                        index.journal(conn, 'delete', h)
+                        status['index_fixed'] += 1
+                c = conn.execute('''SELECT path FROM janitor_dirs
+                                    WHERE path >= ? AND path < ?''',
+                                 (l1, l1 + '\U0010ffff'))
+                for (l2,) in c.fetchall():
+                    if l2 not in l2s:
+                        conn.execute('DELETE FROM janitor_dirs WHERE path = ?',
+                                     (l2,))
+            status['position'] = l1
+            _save_status(status)
+        with index.transaction() as conn:
+            index.journal_trim(conn, JOURNAL_KEEP)
+        status['state'] = 'idle'
+        status['position'] = None
+        status.pop('error', None)
+        status['last_completed'] = int(time.time())
+    except Exception as e:
+        # Leave 'position' where it was, so the next run resumes from there
+        status['state'] = 'failed'
+        status['error'] = f"{e}"
+        print(f"WARNING: janitor failed: {e}", file = sys.stderr)
+    _save_status(status)
+    lockfp.close()
+
+# Start a janitor run in the background, unless one is already running. Either
+# way, returns the current status.
+def start(full = False):
+    lockfp = open(lockpath, 'a')
+    try:
+        fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockfp.close()
+        return get_status()
+    # If the last run failed, resume it rather than starting a new one
+    status = load_status()
+    if status.get('state') == 'failed' and status.get('position'):
+        status['state'] = 'running'
+        _save_status(status)
+    t = threading.Thread(target = _run, args = (lockfp, full), daemon = True)
+    t.start()
+    reaper.kick()
+    return get_status()
+
+def running():
+    with open(lockpath, 'a') as lockfp:
+        try:
+            fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+def get_status():
+    status = load_status()
+    status['running'] = running()
+    return status
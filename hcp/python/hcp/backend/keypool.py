@@ -0,0 +1,209 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import os
+import sys
+import json
+import fcntl
+import secrets
+import argparse
+import subprocess
+import threading
+from hcp.backend.common import backend_config, write_atomic, ProcessThread
+
+# Pools of pre-generated private keys, one per key type, so that issuing a
+# certificate is only a matter of signing it (hxtool's
+# '--certificate-private-key') rather than generating a key pair while the
+# attestation waits. The pools are on disk, so they're shared by all the
+# workers;
+#
+#     <root>/<keytype>/<random>.pem    a ready key
+#     <root>/.lock                     held by whichever worker is refilling
+#     <root>/.stats.json               the metrics, summed over the workers
+#
+# where the directories are 0700 and the files 0600. take() claims a key by
+# renaming it within the pool (which is atomic, so no two callers ever get the
+# same key, and no lock is needed), and a key is only ever used once. If the
+# pool is empty, that's a miss, and the caller generates the key itself (as it
+# would without a pool).
+#
+# Each worker has a background thread that tops up any pool that has fallen
+# below 'low' keys (the low watermark) to 'size' keys, every POLL seconds, or
+# straight away if a take() has just left a pool below 'low'. Only one worker
+# refills at a time, and the keys are generated by a subprocess, so that
+# doesn't hold up the worker's requests. The same thread adds the worker's
+# hits, misses and generated counts to the shared metrics, which
+# 'python3 -m hcp.backend.keypool' shows (along with the pool levels).
+
+# TODO: configure
+POLL = 10
+
+# The commands that generate a key of each type (PEM to stdout)
+KEY_TYPES = {
+    'rsa-2048': [ 'openssl', 'genpkey', '-algorithm', 'RSA',
+                  '-pkeyopt', 'rsa_keygen_bits:2048' ]
+}
+
+METRICS = [ 'hits', 'misses', 'generated' ]
+
+def debug(s):
+    sys.stderr.write(f"{s}\n")
+
+class KeyPool:
+    def __init__(self, root, size = 16, low = 4, keytypes = KEY_TYPES):
+        self.root = root
+        self.size = size
+        self.low = low
+        self.keytypes = keytypes
+        self.statspath = f"{root}/.stats.json"
+        # This worker's counts, not yet added to the shared metrics
+        self.counts = self._zero()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = ProcessThread(self._background, reset = self._reset)
+
+    def _zero(self):
+        return { keytype: dict.fromkeys(METRICS, 0)
+                 for keytype in self.keytypes }
+
+    def _count(self, keytype, metric):
+        with self.lock:
+            self.counts[keytype][metric] += 1
+
+    def _mkdir(self, path):
+        try:
+            os.mkdir(path, mode = 0o700)
+        except FileExistsError:
+            pass
+
+    def _ready(self, keytype):
+        try:
+            return [ name for name in os.listdir(f"{self.root}/{keytype}")
+                     if name.endswith('.pem') ]
+        except FileNotFoundError:
+            return []
+
+    # Writes a key of type 'keytype' to 'path' (0600) and returns True, or
+    # returns False if the pool is empty.
+    def take(self, keytype, path):
+        self.thread.started()
+        poolpath = f"{self.root}/{keytype}"
+        ready = self._ready(keytype)
+        for name in ready:
+            claimed = f"{poolpath}/.{secrets.token_hex(8)}.claimed"
+            try:
+                os.rename(f"{poolpath}/{name}", claimed)
+            except FileNotFoundError:
+                # Someone else got it
+                continue
+            try:
+                with open(claimed, 'rb') as fp:
+                    key = fp.read()
+            finally:
+                os.remove(claimed)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(key)
+            self._count(keytype, 'hits')
+            if len(ready) <= self.low:
+                self.wakeup.set()
+            return True
+        self._count(keytype, 'misses')
+        self.wakeup.set()
+        return False
+
+    # Tops up the pools that are below the low watermark. Only one worker does
+    # this at a time.
+    def refill(self):
+        self._mkdir(self.root)
+        with open(f"{self.root}/.lock", 'a') as lockfp:
+            try:
+                fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            for keytype, cmd in self.keytypes.items():
+                poolpath = f"{self.root}/{keytype}"
+                self._mkdir(poolpath)
+                n = len(self._ready(keytype))
+                if n >= self.low:
+                    continue
+                while n < self.size:
+                    c = subprocess.run(cmd, capture_output = True)
+                    if c.returncode != 0 or not c.stdout:
+                        raise Exception(f"key generation failed: {cmd}")
+                    write_atomic(f"{poolpath}/{secrets.token_hex(16)}.pem",
+                                 c.stdout)
+                    self._count(keytype, 'generated')
+                    n += 1
+
+    # Adds this worker's counts to the shared metrics.
+    def flush(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = self._zero()
+        if not any(v for c in counts.values() for v in c.values()):
+            return
+        self._mkdir(self.root)
+        with open(f"{self.root}/.stats.lock", 'a') as lockfp:
+            fcntl.flock(lockfp, fcntl.LOCK_EX)
+            stats = self.stats()
+            for keytype, c in counts.items():
+                s = stats.setdefault(keytype, dict.fromkeys(METRICS, 0))
+                for metric, v in c.items():
+                    s[metric] = s.get(metric, 0) + v
+            write_atomic(self.statspath, json.dumps(stats).encode())
+
+    # The shared metrics, as a dict from key type to a dict from metric to
+    # count.
+    def stats(self):
+        try:
+            with open(self.statspath, 'r') as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    # The shared metrics plus the number of keys ready in each pool.
+    def status(self):
+        stats = self.stats()
+        for keytype in self.keytypes:
+            s = stats.setdefault(keytype, dict.fromkeys(METRICS, 0))
+            s['ready'] = len(self._ready(keytype))
+        return stats
+
+    def _background(self):
+        while True:
+            self.wakeup.wait(POLL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                self.refill()
+            except Exception as e:
+                debug(f"WARNING: key pool refill failed: {e}")
+
+    # (Each worker's background thread is started on its first take().)
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.counts = self._zero()
+        self.wakeup.set()
+
+def pool_from_config():
+    root = backend_config('keypool', default = '/tmp/www-data-keypool')
+    if not root:
+        return None
+    return KeyPool(root, size = backend_config('keypool_size', default = 16),
+                   low = backend_config('keypool_low', default = 4))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Show (or refill) the attestsvc key pools')
+    parser.add_argument('--refill', action = 'store_true',
+                        help = 'top up the pools that are below the low watermark')
+    args = parser.parse_args()
+    pool = pool_from_config()
+    if not pool:
+        print('Key pool disabled', file = sys.stderr)
+        sys.exit(1)
+    if args.refill:
+        pool.refill()
+        pool.flush()
+    print(json.dumps(pool.status(), indent = 2))
@@ -0,0 +1,98 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import os
+import sys
+import json
+import shutil
+import argparse
+from hcp.backend.common import *
+import hcp.backend.index as index
+
+# Migrates an enrollment DB between the "dirs" and "packed" formats (see
+# entry_install()). The new format is recorded first, so that enrollments
+# added while the migration runs are already in it, then every existing
+# enrollment is converted. Each enrollment is converted under the index's
+# write lock, so adds and deletes (and the janitor) can't race with it, but
+# the enrollsvc and attestsvc can keep running. It's safe to interrupt and
+# rerun; an entry that is caught in both formats is resolved (by a rerun, or
+# by the janitor) in favour of the DB's format.
+#
+# Usage: python3 -m hcp.backend.migrate --to packed
+
+# (Durably, as it decides how every later add is stored.)
+def set_format(fmt):
+    write_atomic(formatpath, fmt.encode(), mode = 0o644, sync = True)
+    fsync_path(os.path.dirname(formatpath))
+
+def to_packed(enrollpath):
+    if os.path.isfile(record_path(enrollpath)):
+        # Interrupted after the record was written
+        shutil.rmtree(enrollpath)
+        return
+    # Bring the entry up to date before packing it
+    if not os.path.isfile(f"{enrollpath}/ek.tpm2b"):
+        ek_precompute(enrollpath)
+    profile_store(enrollpath)
+    entry_install(enrollpath, enrollpath, 'packed')
+    shutil.rmtree(enrollpath)
+
+def to_dirs(enrollpath):
+    if os.path.isdir(enrollpath):
+        # Interrupted after the directory was created
+        os.remove(record_path(enrollpath))
+        return
+    with open(record_path(enrollpath), 'rb') as fp:
+        files = record_unpack(fp.read())
+    stagedir = f"{enrollpath}.stage.tmp"
+    shutil.rmtree(stagedir, ignore_errors = True)
+    os.makedirs(stagedir)
+    for name, content in files.items():
+        with open(f"{stagedir}/{name}", 'wb') as fp:
+            fp.write(content)
+    entry_install(enrollpath, stagedir, 'dirs')
+    os.rmdir(stagedir)
+    os.remove(record_path(enrollpath))
+
+def migrate(fmt, verbose = False):
+    stats = { 'converted': 0, 'unchanged': 0, 'failed': 0 }
+    set_format(fmt)
+    lastl1 = None
+    for ekpubhash, enrollpath in index.walk_tree():
+        if verbose and ekpubhash[0:2] != lastl1:
+            lastl1 = ekpubhash[0:2]
+            print(f"Migrating {lastl1}: {stats}", file = sys.stderr)
+        with index.transaction() as conn:
+            isdir = os.path.isdir(enrollpath)
+            isrec = os.path.isfile(record_path(enrollpath))
+            if (fmt == 'packed' and not isdir) or \
+                    (fmt == 'dirs' and not isrec):
+                stats['unchanged'] += 1
+                continue
+            try:
+                if fmt == 'packed':
+                    to_packed(enrollpath)
+                else:
+                    to_dirs(enrollpath)
+            except (OSError, EntryError) as e:
+                print(f"WARNING: failed to migrate {ekpubhash}: {e}",
+                      file = sys.stderr)
+                stats['failed'] += 1
+                continue
+            stats['converted'] += 1
+            # Packing can change the entry's files (see to_packed())
+            files = entry_names(enrollpath)
+            current = index.lookup(conn, ekpubhash)
+            if current and current[0] != files:
+                attrs = index.attrs(conn, ekpubhash)
+                index.delete(conn, ekpubhash)
+                index.add(conn, ekpubhash, files, current[1], attrs)
+                index.journal(conn, 'add', ekpubhash)
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Migrate the enrollment DB format')
+    parser.add_argument('--to', choices = DB_FORMATS, required = True,
+                        help = 'format to migrate to')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+                        help = 'report progress')
+    args = parser.parse_args()
+    print(json.dumps(migrate(args.to, verbose = args.verbose)))
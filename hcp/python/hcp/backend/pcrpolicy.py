@@ -0,0 +1,260 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import tpm2.structures as tpm2s
+import tpm2.eventlog as tpm2e
+
+# PCR policies, for deciding whether the platform state in a (verified) quote
+# is acceptable. A policy is an OR of clauses, each of which is an AND across
+# PCRs of the values allowed for each;
+#
+#     {
+#         "bank": "sha256",
+#         "any": [
+#             { "golden": "fw-2024.1" },
+#             { "golden": [ "fw-2024.2", "fw-2024.3" ],
+#               "pcrs": { "7": [ "<hex>", "<hex>" ] } },
+#             { "pcrs": { "0": "<hex>", "2": [ "<hex>", "<hex>" ] } },
+#             { "golden": "fw-2024.3",
+#               "events": [ { "pcr": 4, "digest": "<hex>",
+#                             "type": "EV_EFI_BOOT_SERVICES_APPLICATION" } ] }
+#         ]
+#     }
+#
+# "bank" is optional (sha256 is the default), and a policy can be just the
+# list of clauses. A "golden" image is a named set of PCR values (measured
+# from a known-good build, say), which the clause requires all of; a list of
+# golden images means any one of them (so the clause is repeated for each).
+# "pcrs" gives the allowed value(s) for each PCR, and must also be satisfied.
+# A PCR that a clause mentions but the quote doesn't include fails the clause.
+# "events" requires each of the given events to be in the host's event log
+# (which must have been replayed against the quote, see
+# tpm2.quote.verify_eventlog()); "digest" is the event's digest in the
+# policy's bank, "type" (an EV_* name or number) is optional. A clause with
+# "events" fails if the host didn't send its event log.
+#
+# Policies are compiled once, into lookup tables; the clauses are grouped by
+# the set of PCRs they cover (their "shape"), and each clause is expanded into
+# the tuples of values it allows, so that evaluating a quote is one dict
+# lookup per shape, however many golden images and firmware combinations
+# there are. (A clause that would expand into more than EXPAND_MAX tuples is
+# instead checked one PCR at a time, which is still one set lookup per PCR.
+# Clauses with "events" are checked one at a time, after the tables.)
+
+class PolicyError(Exception):
+    pass
+
+# TODO: configure
+EXPAND_MAX = 4096
+INLINE_CACHE_SIZE = 1000
+
+banks = {
+    'sha1': (tpm2s.TPM2_ALG_SHA1, 20),
+    'sha256': (tpm2s.TPM2_ALG_SHA256, 32),
+    'sha384': (tpm2s.TPM2_ALG_SHA384, 48),
+    'sha512': (tpm2s.TPM2_ALG_SHA512, 64)
+}
+
+def _index(i):
+    try:
+        index = int(i)
+    except (TypeError, ValueError):
+        raise PolicyError(f"bad PCR index: {i}")
+    if index < 0 or index > 23:
+        raise PolicyError(f"bad PCR index: {i}")
+    return index
+
+def _value(v, size):
+    try:
+        value = bytes.fromhex(v)
+    except (TypeError, ValueError):
+        raise PolicyError(f"bad PCR value: {v}")
+    if len(value) != size:
+        raise PolicyError(f"PCR value is the wrong size: {v}")
+    return value
+
+# Events are { "pcr": <index>, "type": <EV_* name or number>,
+# "digest": "<hex>" } ("type" is optional), returns (index, type, digest)
+def _event(e, size):
+    if not isinstance(e, dict) or 'pcr' not in e or 'digest' not in e or \
+            not set(e).issubset({ 'pcr', 'type', 'digest' }):
+        raise PolicyError(f"bad policy event: {e}")
+    etype = e.get('type')
+    if isinstance(etype, str):
+        try:
+            etype = int(tpm2e.TCG_EventType[etype])
+        except KeyError:
+            raise PolicyError(f"unknown event type: {etype}")
+    elif etype is not None and \
+            (not isinstance(etype, int) or isinstance(etype, bool)):
+        raise PolicyError(f"bad event type: {etype}")
+    return (_index(e['pcr']), etype, _value(e['digest'], size))
+
+# Golden images are { "<index>": "<hex>", ... }, returns { index: value }
+def _golden(image, size):
+    if not isinstance(image, dict) or not image:
+        raise PolicyError('golden image should be a non-empty dict')
+    return { _index(i): _value(v, size) for i, v in image.items() }
+
+class Policy:
+    def __init__(self, name, policy, golden = {}):
+        self.name = name
+        bank = 'sha256'
+        clauses = policy
+        if isinstance(policy, dict):
+            bank = policy.get('bank', bank)
+            clauses = policy.get('any')
+        if not isinstance(bank, str) or bank not in banks:
+            raise PolicyError(f"unsupported PCR bank: {bank}")
+        self.alg, size = banks[bank]
+        if not isinstance(clauses, list):
+            raise PolicyError('policy should be a list of clauses')
+        # shape (sorted tuple of PCR indices) -> set of value tuples
+        self.shapes = {}
+        # (shape, [ set of values for each PCR in the shape ])
+        self.sets = []
+        # ({ PCR index: set of values }, set of required events)
+        self.event_clauses = []
+        for clause in clauses:
+            if not isinstance(clause, dict) or \
+                    not set(clause).issubset({ 'golden', 'pcrs',
+                                               'events' }) or \
+                    not clause:
+                raise PolicyError(f"bad policy clause: {clause}")
+            events = clause.get('events')
+            if events is not None:
+                if not isinstance(events, list) or not events:
+                    raise PolicyError(f"bad policy clause events: {events}")
+                events = frozenset(_event(e, size) for e in events)
+            pcrs = clause.get('pcrs', {})
+            if not isinstance(pcrs, dict):
+                raise PolicyError(f"bad policy clause pcrs: {pcrs}")
+            allowed = {}
+            for i, v in pcrs.items():
+                values = v if isinstance(v, list) else [ v ]
+                allowed[_index(i)] = { _value(x, size) for x in values }
+            names = clause.get('golden', [ None ])
+            if isinstance(names, str):
+                names = [ names ]
+            if not isinstance(names, list) or \
+                    not all(isinstance(n, str) or n is None for n in names):
+                raise PolicyError(f"bad policy clause golden: {names}")
+            for name in names:
+                required = dict(allowed)
+                if name is not None:
+                    if name not in golden:
+                        raise PolicyError(f"unknown golden image: {name}")
+                    alg, image = golden[name]
+                    if alg != self.alg:
+                        raise PolicyError(
+                            f"golden image {name} is for another bank")
+                    for i, value in image.items():
+                        required[i] = required.get(i, { value }) & { value }
+                if events is None:
+                    self._add(required)
+                elif all(required.values()):
+                    self.event_clauses.append((required, events))
+
+    def _add(self, required):
+        if not required or any(not s for s in required.values()):
+            # (Matches nothing, e.g. a golden image that contradicts 'pcrs')
+            return
+        shape = tuple(sorted(required))
+        combos = 1
+        for s in required.values():
+            combos *= len(s)
+        if combos > EXPAND_MAX:
+            self.sets.append((shape, [ frozenset(required[i])
+                                       for i in shape ]))
+            return
+        table = self.shapes.setdefault(shape, set())
+        keys = [ () ]
+        for i in shape:
+            keys = [ k + (v,) for k in keys for v in required[i] ]
+        table.update(keys)
+
+    # The events (as returned by tpm2.quote.verify_eventlog()), as a set of
+    # (index, type, digest) and (index, None, digest) for this policy's bank.
+    def _events(self, events):
+        result = set()
+        for event in events:
+            index = event[tpm2e.STR_PCRIndex]
+            etype = int(event[tpm2e.STR_eventType])
+            for ha in event[tpm2e.STR_digests][tpm2e.STR_digests]:
+                if ha[tpm2e.STR_algId] == self.alg:
+                    digest = bytes(ha[tpm2e.STR_digest])
+                    result.add((index, etype, digest))
+                    result.add((index, None, digest))
+        return result
+
+    # 'pcrs' is a dict from the hash algorithm to a dict from PCR index to
+    # value (as returned by tpm2.quote.verify()), 'events' is the verified
+    # event log (as returned by tpm2.quote.verify_eventlog()), or None if the
+    # host didn't send one.
+    def evaluate(self, pcrs, events = None):
+        bank = pcrs.get(self.alg, {})
+        for shape, table in self.shapes.items():
+            key = tuple(bank.get(i) for i in shape)
+            if key in table:
+                return True
+        for shape, allowed in self.sets:
+            if all(bank.get(i) in s for i, s in zip(shape, allowed)):
+                return True
+        if not self.event_clauses or events is None:
+            return False
+        seen = self._events(events)
+        for required, needed in self.event_clauses:
+            if all(bank.get(i) in s for i, s in required.items()) and \
+                    needed <= seen:
+                return True
+        return False
+
+# All the configured policies, compiled up front, plus a cache of compiled
+# inline policies (from profiles).
+class Policies:
+    def __init__(self, policies = {}, golden = {}, default = None):
+        self.golden = {}
+        for name, image in golden.items():
+            # { "bank": ..., "pcrs": { ... } } or just the PCRs (sha256)
+            bank = 'sha256'
+            if isinstance(image, dict) and 'pcrs' in image:
+                bank = image.get('bank', bank)
+                image = image['pcrs']
+            if not isinstance(bank, str) or bank not in banks:
+                raise PolicyError(f"unsupported PCR bank: {bank}")
+            alg, size = banks[bank]
+            self.golden[name] = (alg, _golden(image, size))
+        self.policies = { name: Policy(name, policy, self.golden)
+                          for name, policy in policies.items() }
+        if default is not None and default not in self.policies:
+            raise PolicyError(f"unknown default PCR policy: {default}")
+        self.default = default
+        self.inline = OrderedDict()
+        self.lock = threading.Lock()
+
+    # 'policy' is a policy name, an inline policy, or None (for the default).
+    # Returns the compiled policy, or None if there's no policy to apply.
+    def lookup(self, policy):
+        if policy is None:
+            policy = self.default
+            if policy is None:
+                return None
+        if isinstance(policy, str):
+            if policy not in self.policies:
+                raise PolicyError(f"unknown PCR policy: {policy}")
+            return self.policies[policy]
+        key = hashlib.sha256(json.dumps(policy, sort_keys = True,
+                                        separators = (',', ':')).encode()
+                             ).hexdigest()
+        with self.lock:
+            if key in self.inline:
+                self.inline.move_to_end(key)
+                return self.inline[key]
+        compiled = Policy(f"inline:{key[0:16]}", policy, self.golden)
+        with self.lock:
+            self.inline[key] = compiled
+            if len(self.inline) > INLINE_CACHE_SIZE:
+                self.inline.popitem(last = False)
+        return compiled
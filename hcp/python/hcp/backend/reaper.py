@@ -0,0 +1,95 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+import os
+import sys
+import time
+import fcntl
+import shutil
+import threading
+from hcp.backend.common import *
+
+# The enrollsvc reaper. Deleting an enrollment only renames it into the trash
+# directory (which is atomic, and cheap however big the delete is), and the
+# reaper reclaims the space afterwards, in a background thread. It is
+# throttled (pausing every REAP_BATCH entries) so that a big delete doesn't
+# saturate the disk that the attestsvc is serving from. A lock file ensures
+# there's only ever one running, across all uwsgi workers. The trash is
+# outside the 'xx/xxxx' tree, so nothing else (queries, the janitor, index
+# rebuilds) ever sees it.
+
+trashpath = f"{dbroot}/.trash"
+lockpath = f"{dbroot}/.reaper.lock"
+
+# TODO: configure
+REAP_BATCH = 100
+REAP_PAUSE = 0.1
+
+# Move the enrollment at 'enrollpath' (whichever format it's in) into the
+# trash. Raises FileNotFoundError if it's already gone, or whatever else
+# os.rename() raises.
+def trash(enrollpath):
+    path = entry_path(enrollpath)
+    if not path:
+        raise FileNotFoundError(2, 'No such enrollment', enrollpath)
+    os.makedirs(trashpath, exist_ok = True)
+    name = os.path.basename(path)
+    os.rename(path, f"{trashpath}/{name}.{time.time_ns()}")
+
+# Removes the trash entry at 'path', returns an error string if (any of) it
+# couldn't be removed.
+def _reap(path, is_dir):
+    errors = []
+    if is_dir:
+        shutil.rmtree(path, onerror = lambda fn, p, exc:
+                      errors.append(f"{p}: {exc[1]}"))
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            errors.append(f"{path}: {e}")
+    return errors[0] if errors else None
+
+def _run(lockfp):
+    # Entries that couldn't be (completely) removed are skipped for the rest
+    # of this run (they're retried the next time the reaper is kicked), so
+    # that they can't keep us spinning.
+    stuck = set()
+    try:
+        # Keep going until a pass removes nothing, as more may get added
+        # while we're reaping.
+        while True:
+            count = 0
+            with os.scandir(trashpath) as it:
+                for entry in it:
+                    if entry.name in stuck:
+                        continue
+                    error = _reap(entry.path,
+                                  entry.is_dir(follow_symlinks = False))
+                    if error:
+                        print(f"WARNING: reaper skipping {entry.name}: {error}",
+                              file = sys.stderr)
+                        stuck.add(entry.name)
+                        continue
+                    count += 1
+                    if count % REAP_BATCH == 0:
+                        time.sleep(REAP_PAUSE)
+            if count == 0:
+                break
+            time.sleep(REAP_PAUSE)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"WARNING: reaper failed: {e}", file = sys.stderr)
+    lockfp.close()
+
+# Start reaping in the background, unless it's already happening.
+def kick():
+    lockfp = open(lockpath, 'a')
+    try:
+        fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockfp.close()
+        return
+    t = threading.Thread(target = _run, args = (lockfp,), daemon = True)
+    t.start()
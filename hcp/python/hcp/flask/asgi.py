@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# ASGI serving for the HCP flask apps (enrollsvc, attestsvc, ...), the
+# alternative to uwsgi that hcp/svc/webapi.py uses when its config has
+# '"server": "asgi"'.
+#
+# The apps (and their backend hooks) are unchanged, they're still WSGI apps
+# whose handlers block on subprocesses (api_seal, hxtool, tpm2, ...) and HTTP
+# round-trips. What changes is how waiting is paid for; under uwsgi each
+# in-flight request holds one of a handful of (processes * threads) slots, so
+# a few slow attestations starve everything else, including the healthcheck.
+# Here, each worker process runs an asyncio event loop (uvicorn) that owns the
+# connections, and requests are handed to a large pool of threads, which cost
+# next to nothing while they're blocked. So hundreds of in-flight requests can
+# share a worker, and '/healthcheck' is answered on the event loop itself,
+# without waiting for a thread.
+#
+# Threads can't be killed, so, as with uwsgi's 'harakiri', a request that has
+# been running for longer than 'harakiri' seconds (a hung hxtool, api_seal or
+# KDC call) takes its whole worker down with it, and the master starts a new
+# one. And if every thread in a worker's pool is busy, its '/healthcheck'
+# fails (503), rather than claiming the worker can take requests that would
+# only queue.
+#
+# Request bodies are received (spooled to disk if they're big) before the app
+# is called, responses are streamed back as the app produces them.
+#
+# E.g.
+#     python3 -m hcp.flask.asgi --app /hcp/python/hcp/backend/enrollsvc.py \
+#             --uds /tmp/enrollsvc.asgi.sock --uid www-data --gid www-data
+
+import os
+import sys
+import grp
+import pwd
+import signal
+import socket
+import time
+import asyncio
+import logging
+import threading
+import argparse
+import tempfile
+import urllib.parse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+# TODO: configure
+THREADS = 256
+SPOOL_SIZE = 1024 * 1024
+HARAKIRI_POLL = 1
+HEALTHCHECK_BODY = b'''
+<h1>Healthcheck</h1>
+'''
+HEALTHCHECK_BUSY_BODY = b'Error: all request threads are busy'
+
+# When we're behind our own nginx (listening on a unix socket only it can
+# connect to), it passes the TLS and GSSAPI details that uwsgi_params would
+# have put in the WSGI environment as these headers. They're stripped from
+# any other request, so clients can't forge them. (The client certificate is
+# PEM, so nginx URL-escapes it to fit in a header.)
+PROXY_HEADERS = {
+    'HTTP_X_HCP_REMOTE_USER': 'REMOTE_USER',
+    'HTTP_X_HCP_HTTPS': 'HTTPS',
+    'HTTP_X_HCP_SSL_CLIENT_CERT': 'SSL_CLIENT_CERT',
+    'HTTP_X_HCP_SSL_CLIENT_S_DN': 'SSL_CLIENT_S_DN',
+    'HTTP_X_HCP_SSL_CLIENT_S_DN_LEGACY': 'SSL_CLIENT_S_DN_LEGACY'
+}
+
+# Loads the WSGI callable from a file, the same way uwsgi's 'wsgi-file' does.
+def load_wsgi(path, callable = 'app'):
+    spec = importlib.util.spec_from_file_location('hcp_asgi_app', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return getattr(module, callable)
+
+def _environ(scope, body, length, trust_proxy):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': f"{length}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # So that apps can tell they have threads to spare (see the
+        # enrollsvc's '/v1/changes' long-poll)
+        'hcp.asgi': True
+    }
+    server = scope.get('server')
+    if server and server[1] is not None:
+        environ['SERVER_NAME'], environ['SERVER_PORT'] = \
+            server[0], f"{server[1]}"
+    else:
+        environ['SERVER_NAME'], environ['SERVER_PORT'] = 'localhost', '80'
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = \
+            client[0], f"{client[1]}"
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH':
+            # (The body has already been received, see 'length'.)
+            continue
+        if name != 'CONTENT_TYPE':
+            name = f"HTTP_{name}"
+        value = value.decode('latin1')
+        if name in environ:
+            environ[name] = f"{environ[name]},{value}"
+        else:
+            environ[name] = value
+    for header, name in PROXY_HEADERS.items():
+        value = environ.pop(header, None)
+        if trust_proxy and value:
+            if name == 'SSL_CLIENT_CERT':
+                value = urllib.parse.unquote(value)
+            environ[name] = value
+    return environ
+
+class App:
+    def __init__(self, wsgi, threads = THREADS, trust_proxy = False,
+                 harakiri = None):
+        self.wsgi = wsgi
+        self.threads = threads
+        self.trust_proxy = trust_proxy
+        self.harakiri = harakiri
+        self.executor = None
+        # The requests running in the pool, as a dict from a request number
+        # to when it started
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.requests = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise Exception(f"unsupported ASGI scope: {scope['type']}")
+        if scope['path'] == '/healthcheck' and scope['method'] == 'GET':
+            status, body = 200, HEALTHCHECK_BODY
+            if len(self.running) >= self.threads:
+                status, body = 503, HEALTHCHECK_BUSY_BODY
+            await send({ 'type': 'http.response.start', 'status': status,
+                         'headers': [
+                            (b'content-type', b'text/html; charset=utf-8'),
+                            (b'content-length',
+                             f"{len(body)}".encode()) ] })
+            await send({ 'type': 'http.response.body', 'body': body })
+            return
+        await self.request(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.pool()
+                if self.harakiri:
+                    asyncio.get_running_loop().create_task(self.watchdog())
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor:
+                    self.executor.shutdown(wait = False)
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    # uwsgi's 'harakiri'; the worker exits (and the master replaces it) if a
+    # request has been running for too long.
+    async def watchdog(self):
+        while True:
+            await asyncio.sleep(HARAKIRI_POLL)
+            with self.running_lock:
+                oldest = min(self.running.values(), default = None)
+            if oldest is not None and \
+                    time.monotonic() - oldest > self.harakiri:
+                print(f"WARNING: request running for over {self.harakiri}s, " +
+                      f"harakiri (pid {os.getpid()})", file = sys.stderr)
+                sys.stderr.flush()
+                os._exit(1)
+
+    def pool(self):
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers = self.threads,
+                                               thread_name_prefix = 'hcp-asgi')
+        return self.executor
+
+    async def request(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size = SPOOL_SIZE)
+        length = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            chunk = message.get('body', b'')
+            body.write(chunk)
+            length += len(chunk)
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        environ = _environ(scope, body, length, self.trust_proxy)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.pool(), self.run, environ, loop,
+                                       send)
+        finally:
+            body.close()
+
+    # Runs in a pool thread. The response is handed to the event loop (and
+    # this thread waits for each part to be sent, so a slow client applies
+    # back-pressure to the app).
+    def run(self, environ, loop, send):
+        with self.running_lock:
+            self.requests += 1
+            request = self.requests
+            self.running[request] = time.monotonic()
+        try:
+            self._run(environ, loop, send)
+        finally:
+            with self.running_lock:
+                del self.running[request]
+
+    def _run(self, environ, loop, send):
+        response = {}
+        def _send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        def _start():
+            if 'sent' not in response:
+                response['sent'] = True
+                _send({ 'type': 'http.response.start',
+                        'status': response['status'],
+                        'headers': response['headers'] })
+        def start_response(status, headers, exc_info = None):
+            if exc_info and 'sent' in response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [ (k.lower().encode('latin1'),
+                                     v.encode('latin1')) for k, v in headers ]
+            def write(data):
+                _start()
+                _send({ 'type': 'http.response.body', 'body': data,
+                        'more_body': True })
+            return write
+        try:
+            result = self.wsgi(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        _start()
+                        _send({ 'type': 'http.response.body', 'body': chunk,
+                                'more_body': True })
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as e:
+            print(f"WARNING: request failed: {e}", file = sys.stderr)
+            if 'sent' in response:
+                # Too late for an error response, so just cut it short
+                return
+            response['status'] = 500
+            response['headers'] = [ (b'content-type', b'text/plain') ]
+            response['error'] = b'Error: internal server error'
+        _start()
+        _send({ 'type': 'http.response.body',
+                'body': response.get('error', b'') })
+
+# uvicorn logs every request, but (as with uwsgi's 'donotlog') the
+# healthchecks would drown out everything else
+class _NoHealthcheck(logging.Filter):
+    def filter(self, record):
+        return '/healthcheck' not in record.getMessage()
+
+def _listen(args):
+    if args.uds:
+        if os.path.exists(args.uds):
+            os.remove(args.uds)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(args.uds)
+    else:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('::', args.port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+def _drop_privileges(args):
+    if os.getuid() != 0:
+        return
+    uid = pwd.getpwnam(args.uid).pw_uid if args.uid else None
+    gid = grp.getgrnam(args.gid).gr_gid if args.gid else None
+    if args.uds:
+        os.chown(args.uds, uid if uid is not None else -1,
+                 gid if gid is not None else -1)
+        os.chmod(args.uds, 0o660)
+    if gid is not None:
+        os.setgroups([])
+        os.setgid(gid)
+    if uid is not None:
+        os.setuid(uid)
+
+def _serve(args, sock):
+    import uvicorn
+    app = App(load_wsgi(args.app, args.callable), threads = args.threads,
+              trust_proxy = args.trust_proxy, harakiri = args.harakiri)
+    config = uvicorn.Config(app, lifespan = 'on',
+                            timeout_keep_alive = args.client_timeout,
+                            log_level = 'info')
+    logging.getLogger('uvicorn.access').addFilter(_NoHealthcheck())
+    uvicorn.Server(config).run(sockets = [ sock ])
+
+# Like uwsgi's master; the socket is bound (before privileges are dropped),
+# the workers are forked, and any that die are replaced until we're told to
+# stop.
+def main(args):
+    sock = _listen(args)
+    _drop_privileges(args)
+    children = {}
+    stopping = False
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                _serve(args, sock)
+            finally:
+                os._exit(0)
+        children[pid] = slot
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for slot in range(args.processes):
+        spawn(slot)
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        if slot is not None and not stopping:
+            print(f"WARNING: ASGI worker {pid} died, respawning",
+                  file = sys.stderr)
+            spawn(slot)
+    if args.uds and os.path.exists(args.uds):
+        os.remove(args.uds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'ASGI server for HCP apps')
+    parser.add_argument('--app', required = True,
+                        help = 'path to the python file with the WSGI app')
+    parser.add_argument('--callable', default = 'app',
+                        help = 'name of the WSGI app in that file')
+    parser.add_argument('--uds', default = None,
+                        help = 'unix socket to listen on (for nginx)')
+    parser.add_argument('--port', type = int, default = None,
+                        help = 'TCP port to listen on (plain HTTP)')
+    parser.add_argument('--processes', type = int, default = 2,
+                        help = 'worker processes')
+    parser.add_argument('--threads', type = int, default = THREADS,
+                        help = 'threads per worker, for running requests')
+    parser.add_argument('--client-timeout', type = int, default = 5,
+                        help = 'seconds to keep idle connections open')
+    parser.add_argument('--harakiri', type = int, default = None,
+                        help = 'seconds after which a request kills its worker')
+    parser.add_argument('--trust-proxy', action = 'store_true',
+                        help = 'accept the X-HCP-* headers from nginx')
+    parser.add_argument('--uid', default = None,
+                        help = 'user to run as')
+    parser.add_argument('--gid', default = None,
+                        help = 'group to run as')
+    args = parser.parse_args()
+    if bool(args.uds) == bool(args.port):
+        parser.error('exactly one of --uds and --port is required')
+    main(args)
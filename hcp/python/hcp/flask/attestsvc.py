@@ -13,7 +13,11 @@ from pathlib import Path
 import tempfile
 import requests
 import time
-import yaml
+import hashlib
+import secrets
+from hcp.flask.tickets import KeyRing
+import tpm2.structures as tpm2s
+import tpm2.quote as tpm2q
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = False
@@ -33,6 +37,21 @@ app.config["DEBUG"] = False
 # (False).
 backend_get_assets = None
 
+# check_pcrs: the first argument is the ekpubhash of the host (or its TPM)
+# whose quote has been verified, and the second is the quoted PCR values, a
+# dict from the hash algorithm (TPM2_ALG_*) to a dict from PCR index to value
+# (bytes). The third is the list of events from the host's event log (as
+# parsed by tpm2/eventlog.py) that were verified against the quote, or None if
+# the host didn't send its event log. Only the events' digests are verified
+# by that, their payloads ('event') are untrusted input from the host, so
+# verify_eventlog() keeps a payload only if one of the event's verified
+# digests is the hash of it, and sets it to None otherwise. The return is
+# None if the platform state is acceptable (to the host's policy), otherwise
+# a string saying why it isn't, in which case we return a '403 Forbidden'.
+# This is called before 'get_assets', and may also raise
+# 'exception_unenrolled'.
+backend_check_pcrs = None
+
 # exception_unenrolled: this is an exception class that we can catch when
 # calling the backend's 'get_assets' handler. We'll detect this exception to
 # mean that the backend doesn't recognize the TPM and we'll return a '401
@@ -42,10 +61,39 @@ backend_exception_unenrolled = None
 # TODO: configure
 PCRs='0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16'
 MAX_TICKET_AGE=120
+TICKET_KEYFILE='/tmp/www-data-noncekey'
+TICKET_KEYRING='/tmp/www-data-noncekeys'
+# If set, the workers rotate the ticket key (in TICKET_KEYRING) this often
+TICKET_KEY_LIFETIME=None
+
+# The attributes the client gives the AK (see hcp/api/attest.py); it must be a
+# restricted signing key that never leaves the TPM.
+AK_ATTRIBUTES = tpm2s.TPMA_OBJECT_FIXEDTPM | tpm2s.TPMA_OBJECT_STCLEAR | \
+    tpm2s.TPMA_OBJECT_FIXEDPARENT | tpm2s.TPMA_OBJECT_SENSITIVEDATAORIGIN | \
+    tpm2s.TPMA_OBJECT_USERWITHAUTH | tpm2s.TPMA_OBJECT_RESTRICTED | \
+    tpm2s.TPMA_OBJECT_SIGN_ENCRYPT
+
+# Quotes are verified in-process (see tpm2/quote.py). If this is set, they're
+# also checked with 'tpm2 checkquote', and a disagreement fails the
+# attestation (and is logged), as a cross-check of the native verifier.
+CHECKQUOTE_CROSSCHECK=False
+
+# If the client includes its event log ('quote.eventlog') with the quote, it's
+# replayed and must match the quoted PCRs. If this is set, clients must send
+# it.
+EVENTLOG_REQUIRED=False
 
 def debug(s):
     sys.stderr.write(f"{s}\n")
 
+# The ticket keys, see hcp/flask/tickets.py. A key that's rotated out is still
+# accepted for long enough to cover any ticket issued before the rotation, and
+# so are legacy tickets issued by an attestsvc that ran before this one.
+tickets = KeyRing(TICKET_KEYFILE, TICKET_KEYRING,
+                  overlap = MAX_TICKET_AGE + 60,
+                  lifetime = TICKET_KEY_LIFETIME,
+                  legacy_until = time.time() + MAX_TICKET_AGE + 60)
+
 @app.route('/', methods=['GET'])
 def home():
     return '''
@@ -76,28 +124,15 @@ def my_initiate():
     result = {
         'ekpubhash': request.form['ekpubhash'],
         'PCRs': PCRs,
-        'nonce': subprocess.run(['openssl', 'rand', '-hex', '16'],
-                                capture_output = True,
-                                text = True).stdout.strip()
+        'nonce': secrets.token_hex(16)
     }
     ticket = result.copy()
     ticket['time'] = int(time.time())
-    with tempfile.TemporaryDirectory() as tempdir:
-        ticketjson = json.dumps(ticket)
-        with open(f"{tempdir}/json", 'w') as fp:
-            fp.write(ticketjson)
-        c = subprocess.run(['openssl', 'aes-256-cbc', '-salt', '-pbkdf2',
-                           '-e',
-                           '-kfile', '/tmp/www-data-noncekey',
-                           '-in', f"{tempdir}/json",
-                           '-out', f"{tempdir}/encrypted"])
-        if c.returncode != 0:
-            return make_response("Error: ticket-encryption failed", 400)
-        c = subprocess.run(['base64', '-w', '0', f"{tempdir}/encrypted"],
-                           text = True, capture_output = True)
-        if c.returncode != 0:
-            return make_response("Error: ticket-encoding failed", 400)
-        result['ticket'] = c.stdout.strip()
+    try:
+        result['ticket'] = tickets.seal(ticket)
+    except OSError as e:
+        debug(f"WARNING: ticket-encryption failed: {e}")
+        return make_response("Error: ticket-encryption failed", 400)
     resp = make_response(result, 200)
     resp.headers['Content-Type'] = 'application/json'
     return resp
@@ -115,30 +150,15 @@ def my_complete():
     # TBD: there's not a lot of error handling ...
     with tempfile.TemporaryDirectory() as tempdir:
         # First, parse the 'initial'
-        initial.save(f"{tempdir}/initial")
-        with open(f"{tempdir}/initial", 'r') as fp:
-            initialjson = fp.read()
-        initial = json.loads(initialjson)
-        ticket = initial['ticket']
-        with open(f"{tempdir}/ticket.b64", 'w') as fp:
-            fp.write(ticket)
-        c = subprocess.run(['base64', '-d', f"{tempdir}/ticket.b64"],
-                           capture_output = True)
-        if c.returncode != 0:
-            return make_response("Error: ticket-decoding failed", 400)
-        with open(f"{tempdir}/ticket.enc", 'wb') as fp:
-            fp.write(c.stdout)
-        c = subprocess.run(['openssl', 'aes-256-cbc', '-salt', '-pbkdf2',
-                           '-d',
-                           '-kfile', '/tmp/www-data-noncekey',
-                           '-in', f"{tempdir}/ticket.enc",
-                           '-out', f"{tempdir}/ticket"])
-        if c.returncode != 0:
+        initial = json.loads(initial.read())
+        try:
+            ticket = tickets.open(initial.get('ticket'))
+        except OSError as e:
+            debug(f"WARNING: ticket-decryption failed: {e}")
+            return make_response("Error: ticket-decryption failed", 400)
+        except ValueError:
             return make_response("Error: ticket-decryption failed", 400)
-        with open(f"{tempdir}/ticket", 'r') as fp:
-            ticketjson = fp.read()
-        ticket = json.loads(ticketjson)
-        if ticket['ekpubhash'] != initial['ekpubhash']:
+        if ticket.get('ekpubhash') != initial['ekpubhash']:
             return make_response("Error: ticket has bad ekpubhash", 400)
         if ticket['nonce'] != initial['nonce']:
             return make_response("Error: ticket has bad nonce", 400)
@@ -147,38 +167,54 @@ def my_complete():
         if now < tickettime or now > (tickettime + MAX_TICKET_AGE):
             return make_response("Error: ticket is too old", 400);
         nonce = ticket['nonce']
-        with open(f"{tempdir}/nonce", 'w') as fp:
-            fp.write(nonce)
-        nonce = f"{tempdir}/nonce"
         # Next, extract and verify the 'quote'
         quote.save(f"{tempdir}/quote")
         c = subprocess.run(['tar', '-zxf', f"{tempdir}/quote",
                             '-C', tempdir])
         if c.returncode != 0:
             return make_response("Error: quote-extraction failed", 400)
-        c = subprocess.run(['openssl', 'sha256', '-r', f"{tempdir}/ek.pub"],
-                           capture_output = True, text = True)
-        if c.returncode != 0:
+        try:
+            with open(f"{tempdir}/ek.pub", 'rb') as fp:
+                ekpubhash = hashlib.sha256(fp.read()).hexdigest()
+        except OSError:
             return make_response("Error: ekpub hashing failed", 400)
-        if ticket['ekpubhash'] != c.stdout[0:64]:
+        if ticket['ekpubhash'] != ekpubhash:
             return make_response("Error: ekpub doesn't match ticket", 400)
-        c = subprocess.run(['tpm2', 'print',
-                            '--type', 'TPMT_PUBLIC',
-                            f"{tempdir}/ak.pub"],
-                            text = True, capture_output = True)
-        if c.returncode != 0:
+        try:
+            with open(f"{tempdir}/ak.pub", 'rb') as fp:
+                akpubraw = fp.read()
+            akpub = tpm2s.tpmt_public(akpubraw)
+        except (OSError, tpm2s.StructureError):
             return make_response("Error: AK pub missing from quote", 400)
-        if c.stdout.find('value: fixedtpm|stclear|fixedparent|sensitivedataorigin|userwithauth|restricted|sign') < 0:
+        if akpub['objectAttributes'] != AK_ATTRIBUTES:
             return make_response("Error: AK pub has wrong attributes", 400)
-        c = subprocess.run(['tpm2', 'checkquote',
-                            '--qualification', nonce,
-                            '--message', f"{tempdir}/quote.out",
-                            '--signature', f"{tempdir}/quote.sig",
-                            '--pcr', f"{tempdir}/quote.pcr",
-                            #'--eventlog', f"{tempdir}/quote.eventlog",
-                            '--public', f"{tempdir}/ak.pub"],
-                           capture_output = True)
-        if c.returncode != 0:
+        try:
+            quoteparts = []
+            for name in [ 'quote.out', 'quote.sig', 'quote.pcr' ]:
+                with open(f"{tempdir}/{name}", 'rb') as fp:
+                    quoteparts.append(fp.read())
+            parsedquote, pcrs = tpm2q.verify(akpubraw, *quoteparts,
+                                             nonce.encode())
+            verified = True
+        except (OSError, tpm2q.QuoteError, tpm2s.StructureError) as e:
+            sys.stderr.write(f"WARNING: quote verification failed: {e}\n")
+            verified = False
+        if CHECKQUOTE_CROSSCHECK:
+            with open(f"{tempdir}/nonce", 'w') as fp:
+                fp.write(nonce)
+            c = subprocess.run(['tpm2', 'checkquote',
+                                '--qualification', f"{tempdir}/nonce",
+                                '--message', f"{tempdir}/quote.out",
+                                '--signature', f"{tempdir}/quote.sig",
+                                '--pcr', f"{tempdir}/quote.pcr",
+                                '--public', f"{tempdir}/ak.pub"],
+                               capture_output = True)
+            if (c.returncode == 0) != verified:
+                sys.stderr.write('WARNING: tpm2 checkquote disagrees with ' +
+                                 f"the native verifier ({verified}) for " +
+                                 f"{initial['ekpubhash']}\n")
+                verified = False
+        if not verified:
             # DEBUG: uncomment the following to cause the first passage through
             # this code to create a tarball for examination
             #if not os.path.isfile('/tmp/out.checkquote.tar.gz'):
@@ -186,23 +222,41 @@ def my_complete():
             sys.stderr.write(f"WARNING: failed attestation from {initial['ekpubhash']}\n")
             return make_response("Error: unable to verify quote", 400)
 
-        # TODO: hooks here to backend to evaluate the PCRs...
-        c = subprocess.run(['tpm2', 'print',
-                            '--type', 'TPMS_ATTEST',
-                            f"{tempdir}/quote.out"],
-                           capture_output = True, text = True)
-        if c.returncode != 0:
-            sys.stderr.write(f"WARNING: failed to parse quote\n")
-            return make_response("Error: failed to parse quote", 400)
-        with open(f"{tempdir}/quote.yaml", 'w') as fp:
-            fp.write(c.stdout)
-        with open(f"{tempdir}/quote.yaml", 'r') as fp:
-            parsedquote = yaml.safe_load(fp)
+        # And the event log, if we have one
+        events = None
+        try:
+            with open(f"{tempdir}/quote.eventlog", 'rb') as fp:
+                eventlog = fp.read()
+        except FileNotFoundError:
+            eventlog = None
+        if eventlog is not None:
+            try:
+                events = tpm2q.verify_eventlog(eventlog, pcrs)
+            except tpm2q.QuoteError as e:
+                sys.stderr.write(f"WARNING: event log verification failed for {initial['ekpubhash']}: {e}\n")
+                return make_response("Error: unable to verify event log", 400)
+        elif EVENTLOG_REQUIRED:
+            return make_response("Error: eventlog not in quote", 400)
+
         with open(f"{tempdir}/quote.json", 'w') as fp:
-            json.dump(parsedquote, fp)
+            json.dump(parsedquote, fp, cls = tpm2s.JSONEncoder)
         if not os.path.isfile('/tmp/out.checkquote.tar.gz'):
             subprocess.run(['tar', 'zcf', '/tmp/out.checkquote.tar.gz', tempdir])
 
+        # Is the platform state acceptable?
+        if backend_check_pcrs:
+            try:
+                rejected = backend_check_pcrs(ticket['ekpubhash'], pcrs,
+                                              events)
+            except Exception as e:
+                if backend_exception_unenrolled and \
+                        isinstance(e, backend_exception_unenrolled):
+                    return make_response("Error: unrecognized TPM", 401)
+                raise
+            if rejected:
+                sys.stderr.write(f"WARNING: PCRs rejected for {ticket['ekpubhash']}: {rejected}\n")
+                return make_response("Error: PCR policy not satisfied", 403)
+
         # Now, produce the assets
         with tempfile.TemporaryDirectory() as outdir:
             manifest = []
@@ -4,12 +4,21 @@ from flask import request, abort, send_file, Response, make_response
 import subprocess
 import json
 import os, sys
+import shutil
 from stat import *
 from markupsafe import escape
 from werkzeug.utils import secure_filename
 from pathlib import Path
 import tempfile
 import requests
+import re
+import base64
+import hashlib
+import time
+import io
+import tarfile
+import threading
+from collections import OrderedDict
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = False
@@ -24,6 +33,14 @@ app.config["DEBUG"] = False
 # a JSON-serializable object and an http status code.
 backend_add = None
 
+# add_batch: the sole argument is a list of 'tempdir's, each one prepared as
+# for the 'add' API. The backend should enroll all of them in one pass. The
+# return value is a 2-tuple as with 'add', with a 'results' array holding,
+# for each tempdir (in the same order), the object that 'add' would have
+# returned plus a 'status' field with the http status code 'add' would have
+# returned.
+backend_add_batch = None
+
 # query/delete/reenroll: the first argument is the 'ekpubhash' prefix to
 # identify the TPM(s) to operate on, and the second argument is a 'nofiles'
 # boolean. The return value should be a 2-tuple as with the 'add' API. The
@@ -31,14 +48,64 @@ backend_add = None
 # is an object containing an 'ekpubhash' string, and optionally (if 'nofiles'
 # was False) a 'files' array containing the files registered with the
 # enrollment.
+#
+# query/delete also take optional 'limit' and 'cursor' keyword arguments, for
+# pagination. If 'limit' is set, no more than that many entries are returned,
+# and if more remain, the JSON object will also have a 'next' string that can
+# be passed back as the 'cursor' to get the next page.
 backend_query = None
 backend_delete = None
 backend_reenroll = None
 
-# janitor: called whenever the enrollsvc /v1/janitor endpoint is hit. No
-# arguments are provided, the return value is a 2-tuple.
+# generation: no arguments, returns a number that changes whenever the
+# enrolled entries change (any add or delete), and only then. Query responses
+# are cached (and given ETags) based on it.
+backend_generation = None
+
+# find: the first argument is a regex to search for in enrolled hostnames, or
+# None, in which case the second argument is a hostname prefix to match. The
+# return value is a 2-tuple as with the 'add' API, with an 'entries' array
+# whose items are objects containing 'hostname' and 'ekpubhash' strings.
+backend_find = None
+
+# select: the first argument is a list of (field, value) 2-tuples, the
+# second is a 'limit' and the third is a 'cursor' (or None), as with
+# query/delete. Selects the entries whose profiles match all of the
+# conditions, using the backend's indexes on profile fields (a field that
+# isn't indexed gets a 400). The return value is a 2-tuple as with 'find'
+# (plus a 'next' cursor if there are more entries).
+backend_select = None
+
+# changes: the first argument is a sequence number, 'since', and the second
+# is a 'limit'. The return value is a 2-tuple as with the 'add' API, the JSON
+# object having a 'changes' array of up to 'limit' objects, each with 'seq',
+# 'op' ('add', 'delete' or 'reenroll'), 'ekpubhash' and 'time' fields, for
+# changes to the DB after 'since' (in order), a 'next' value to pass as
+# 'since' next time, and a 'last' value for the most recent change. It should
+# also have 'reset' set to true if changes after 'since' are no longer
+# available, meaning the caller should resynchronize from scratch.
+backend_changes = None
+
+# export: the sole argument is an 'ekpubhash' prefix (possibly empty). The
+# return value is a 2-tuple of the sequence number of the last change (see
+# 'changes') reflected in the export, and a generator of (ekpubhash, files)
+# 2-tuples, one per entry matching the prefix, 'files' being a list of
+# (filename, bytes) 2-tuples. The generator should yield a consistent
+# snapshot of the DB, as of that sequence number.
+backend_export = None
+
+# janitor: called whenever the enrollsvc /v1/janitor endpoint is hit. The
+# sole argument is a 'full' boolean, requesting that the janitor check
+# everything rather than only what has changed since it last ran. The janitor
+# should run in the background, the return value is a 2-tuple whose JSON
+# object reports the janitor's status.
 backend_janitor = None
 
+# janitor_status: called whenever the enrollsvc /v1/janitor/status endpoint
+# is hit. No arguments are provided, the return value is a 2-tuple whose JSON
+# object reports the janitor's status (and progress, if it's running).
+backend_janitor_status = None
+
 @app.route('/', methods=['GET'])
 def home():
     return '''
@@ -86,12 +153,31 @@ def home():
 <input type="submit" value="Find">
 </form>
 
+<h2>To export host entries (as a .tar.gz);</h2>
+<form method="get" action="/v1/export">
+<table>
+<tr><td>ekpubhash prefix</td><td><input type=text name=ekpubhash></td></tr>
+</table>
+<input type="submit" value="Export">
+</form>
+
+<h2>To select host entries by profile field;</h2>
+<form method="get" action="/v1/select">
+<table>
+<tr><td>realm</td><td><input type=text name=realm></td></tr>
+</table>
+<input type="submit" value="Select">
+</form>
+
 <h2>To trigger the janitor (looks for known issues, regenerates the
 hn2ek table, etc);</h2>
 <form method="get" action="/v1/janitor">
 <input type="submit" value="Janitor">
 </form>
 
+<h2>To see the janitor's status and progress;</h2>
+<a href="/v1/janitor/status">Click here</a>
+
 <h2>To retrieve the asset-signing trust anchor;</h2>
 <a href="/v1/get-asset-signer">Click here</a>
 '''
@@ -101,6 +187,41 @@ def healthcheck():
 <h1>Healthcheck</h1>
 '''
 
+# TODO: configure
+MAX_BATCH=1000
+STREAM_PAGE=1000
+MAX_CHANGES=1000
+MAX_SELECT=1000
+# A '/v1/changes' long-poll holds its worker thread for the whole wait. Under
+# uwsgi there are only a handful of those (processes * threads, see
+# hcp/svc/webapi.py), so a few followers would starve add, query and delete;
+# the wait is capped at MAX_CHANGES_WAIT_UWSGI there (followers just poll more
+# often), and only under ASGI, where idle threads are cheap, is it allowed up
+# to MAX_CHANGES_WAIT.
+MAX_CHANGES_WAIT=60
+MAX_CHANGES_WAIT_UWSGI=1
+CHANGES_POLL=0.25
+IMPORT_BATCH=100
+QUERY_CACHE_SIZE=1000
+QUERY_CACHE_MAX_BODY=1024*1024
+MAX_IMPORT_FILE=1024*1024
+MAX_IMPORT_ERRORS=100
+
+# Write an enrollment (the ek.pub, its hash, and the profile if there is one)
+# into 'tempdir', in the form that the backend's 'add' expects.
+def stage_enrollment(tempdir, ekpub, profile):
+    # Here's the ek.pub
+    with open(f"{tempdir}/ek.pub", 'wb') as fp:
+        fp.write(ekpub)
+    # Here's the ekpubhash
+    ekpubhash = hashlib.sha256(ekpub).hexdigest()
+    with open(f"{tempdir}/ekpubhash", 'w') as fp:
+        fp.write(ekpubhash)
+    # Here's the profile
+    if profile:
+        with open(f"{tempdir}/profile", 'w') as fp:
+            fp.write(profile)
+
 @app.route('/v1/add', methods=['POST'])
 def my_add():
     if 'ekpub' not in request.files:
@@ -111,18 +232,7 @@ def my_add():
     # TBD: there's not a lot of error handling ...
     result = {}
     with tempfile.TemporaryDirectory() as tempdir:
-        # Here's the ek.pub
-        form_ekpub.save(f"{tempdir}/ek.pub")
-        # Here's the ekpubhash
-        c = subprocess.run(['openssl', 'sha256', '-r', f"{tempdir}/ek.pub"],
-                           stdout = subprocess.PIPE, text = True)
-        ekpubhash = c.stdout[0:64]
-        with open(f"{tempdir}/ekpubhash", 'w') as fp:
-            fp.write(ekpubhash)
-        # Here's the profile
-        if form_profile:
-            with open(f"{tempdir}/profile", 'w') as fp:
-                fp.write(form_profile)
+        stage_enrollment(tempdir, form_ekpub.read(), form_profile)
 
         # Invoke backend logic
         result, resultcode = backend_add(tempdir)
@@ -131,17 +241,164 @@ def my_add():
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+# The batch can be sent in either of two forms;
+# - multipart/form-data, like '/v1/add' but with any number of 'ekpub' files
+#   and either no 'profile' fields or one per 'ekpub' (matched up by order, an
+#   empty string meaning "no profile"),
+# - application/x-ndjson, one JSON object per line, each with an 'ekpub'
+#   field (base64) and optionally a 'profile' field (a JSON string or object).
+@app.route('/v1/add_batch', methods=['POST'])
+def my_add_batch():
+    items = []
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            for line in request.get_data().splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                profile = item.get('profile')
+                if profile is not None and not isinstance(profile, str):
+                    profile = json.dumps(profile)
+                items.append((base64.b64decode(item['ekpub'], validate = True),
+                              profile))
+        except Exception as e:
+            return make_response(f"Error: malformed batch: {e}", 400)
+    else:
+        form_ekpubs = request.files.getlist('ekpub')
+        form_profiles = request.form.getlist('profile')
+        if len(form_profiles) == 0:
+            form_profiles = [ None ] * len(form_ekpubs)
+        if len(form_profiles) != len(form_ekpubs):
+            return make_response("Error: ekpub/profile count mismatch", 400)
+        for form_ekpub, form_profile in zip(form_ekpubs, form_profiles):
+            items.append((form_ekpub.read(), form_profile))
+    if len(items) == 0:
+        return make_response("Error: ekpub not in request", 400)
+    if len(items) > MAX_BATCH:
+        return make_response(f"Error: batch larger than {MAX_BATCH}", 400)
+
+    result = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        tempdirs = []
+        for i, (ekpub, profile) in enumerate(items):
+            os.mkdir(f"{tempdir}/{i}")
+            stage_enrollment(f"{tempdir}/{i}", ekpub, profile)
+            tempdirs.append(f"{tempdir}/{i}")
+
+        # Invoke backend logic
+        result, resultcode = backend_add_batch(tempdirs)
+
+    resp = make_response(result, resultcode)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+# Common handling of the pagination parameters for query and delete. With
+# 'limit' and/or 'cursor', a single page is returned as a JSON document (with
+# a 'next' cursor if there are more). With 'stream', all the pages are
+# returned as one NDJSON response, one entry per line, fetched from the
+# backend a page at a time so that the worker never holds more than a page.
+# (The http status comes from the first page. Should a later page fail, an
+# object with an 'error' field is streamed in place of its entries.)
+def qd_response(backend_fn, ekpubhash, nofiles, args, cache = None):
+    limit = args.get('limit')
+    cursor = args.get('cursor')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return make_response("Error: bad limit", 400)
+    if 'stream' not in args and cache is not None:
+        return cached_response(cache, backend_fn, ekpubhash, nofiles,
+                               limit, cursor)
+    if 'stream' not in args:
+        # Invoke backend logic
+        result, resultcode = backend_fn(ekpubhash, nofiles,
+                                        limit = limit, cursor = cursor)
+        resp = make_response(result, resultcode)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+    limit = limit if limit else STREAM_PAGE
+    result, resultcode = backend_fn(ekpubhash, nofiles,
+                                    limit = limit, cursor = cursor)
+    def generate(result, resultcode):
+        while True:
+            for entry in result['entries']:
+                yield json.dumps(entry) + '\n'
+            if resultcode >= 300:
+                if 'error' in result:
+                    yield json.dumps({ 'error': result['error'] }) + '\n'
+                return
+            if 'next' not in result:
+                return
+            result, resultcode = backend_fn(ekpubhash, nofiles, limit = limit,
+                                            cursor = result['next'])
+            if resultcode == 404:
+                return
+    return Response(generate(result, resultcode), resultcode,
+                    mimetype = 'application/x-ndjson')
+
+# Query results only change when the DB's generation does, so each response
+# gets an ETag derived from the generation and the query parameters, and a
+# client that already has it (If-None-Match) gets a 304. The rendered
+# responses are also kept in an in-process LRU, so repeating a query doesn't
+# hit the backend at all until the generation changes (an add or delete).
+class QueryCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+    def get(self, key, etag):
+        with self.lock:
+            cached = self.entries.get(key)
+            if not cached or cached[0] != etag:
+                return None
+            self.entries.move_to_end(key)
+            return cached[1:]
+    def put(self, key, etag, body, resultcode):
+        with self.lock:
+            self.entries[key] = (etag, body, resultcode)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+query_cache = QueryCache(QUERY_CACHE_SIZE)
+
+def cached_response(cache, backend_fn, ekpubhash, nofiles, limit, cursor):
+    key = (ekpubhash, nofiles, limit, cursor)
+    generation = backend_generation()
+    etag = hashlib.sha256(json.dumps([generation, *key]).encode()).hexdigest()
+    if etag in request.if_none_match:
+        resp = make_response('', 304)
+    else:
+        cached = cache.get(key, etag)
+        if cached:
+            body, resultcode = cached
+        else:
+            # Invoke backend logic
+            result, resultcode = backend_fn(ekpubhash, nofiles,
+                                            limit = limit, cursor = cursor)
+            body = json.dumps(result)
+            # If the DB changed while we were querying it, the response may
+            # be newer than 'etag', so don't keep it.
+            if len(body) <= QUERY_CACHE_MAX_BODY and \
+                    backend_generation() == generation:
+                cache.put(key, etag, body, resultcode)
+        resp = make_response(body, resultcode)
+        resp.headers['Content-Type'] = 'application/json'
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 @app.route('/v1/query', methods=['GET'])
 def my_query():
     if 'ekpubhash' not in request.args:
         return make_response("Error: ekpubhash not in request", 400)
     ekpubhash = request.args['ekpubhash']
     nofiles = 'nofiles' in request.args
-    # Invoke backend logic
-    result, resultcode = backend_query(ekpubhash, nofiles)
-    resp = make_response(result, resultcode)
-    resp.headers['Content-Type'] = 'application/json'
-    return resp
+    return qd_response(backend_query, ekpubhash, nofiles, request.args,
+                       cache = query_cache)
 
 @app.route('/v1/delete', methods=['POST'])
 def my_delete():
@@ -149,11 +406,7 @@ def my_delete():
         return make_response("Error: ekpubhash not in request", 400)
     ekpubhash = request.form['ekpubhash']
     nofiles = 'nofiles' in request.args
-    # Invoke backend logic
-    result, resultcode = backend_delete(ekpubhash, nofiles)
-    resp = make_response(result, resultcode)
-    resp.headers['Content-Type'] = 'application/json'
-    return resp
+    return qd_response(backend_delete, ekpubhash, nofiles, request.values)
 
 @app.route('/v1/reenroll', methods=['POST'])
 def my_reenroll():
@@ -167,10 +420,245 @@ def my_reenroll():
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+@app.route('/v1/find', methods=['GET'])
+def my_find():
+    hostname_regex = request.args.get('hostname_regex')
+    hostname_prefix = request.args.get('hostname_prefix', '')
+    if hostname_regex is not None:
+        try:
+            re.compile(hostname_regex)
+        except re.error as e:
+            return make_response(f"Error: bad hostname_regex: {e}", 400)
+    # Invoke backend logic
+    result, resultcode = backend_find(hostname_regex, hostname_prefix)
+    resp = make_response(result, resultcode)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+# The conditions are the query parameters other than 'limit' and 'cursor',
+# e.g. '/v1/select?realm=HCPHACKING.XYZ&certgen=pkinit-kdc'. A field can be
+# given more than once.
+@app.route('/v1/select', methods=['GET'])
+def my_select():
+    try:
+        limit = min(int(request.args.get('limit', MAX_SELECT)), MAX_SELECT)
+    except ValueError:
+        return make_response("Error: bad limit", 400)
+    if limit < 1:
+        return make_response("Error: bad limit", 400)
+    cursor = request.args.get('cursor')
+    conditions = [ (field, value)
+                   for field, values in request.args.lists()
+                   if field not in [ 'limit', 'cursor' ]
+                   for value in values ]
+    if len(conditions) == 0:
+        return make_response("Error: no conditions in request", 400)
+    # Invoke backend logic
+    result, resultcode = backend_select(conditions, limit, cursor)
+    resp = make_response(result, resultcode)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+# With 'wait', this is a long-poll; if there are no changes after 'since',
+# the response is held back until there are (or until 'wait' seconds pass).
+@app.route('/v1/changes', methods=['GET'])
+def my_changes():
+    try:
+        since = max(int(request.args.get('since', 0)), 0)
+        limit = min(int(request.args.get('limit', MAX_CHANGES)), MAX_CHANGES)
+        wait = min(float(request.args.get('wait', 0)),
+                   MAX_CHANGES_WAIT if request.environ.get('hcp.asgi') else
+                   MAX_CHANGES_WAIT_UWSGI)
+    except ValueError:
+        return make_response("Error: bad since/limit/wait", 400)
+    if limit < 1:
+        return make_response("Error: bad limit", 400)
+    deadline = time.monotonic() + wait
+    # Invoke backend logic
+    result, resultcode = backend_changes(since, limit)
+    while resultcode == 200 and not result['changes'] and \
+            'reset' not in result and time.monotonic() < deadline:
+        time.sleep(CHANGES_POLL)
+        result, resultcode = backend_changes(since, limit)
+    resp = make_response(result, resultcode)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+# The export archive is a gzipped tarball, with a 'SNAPSHOT' member (a JSON
+# object whose 'seq' is the change journal sequence number that the export
+# is consistent with, so that a replica can catch up by following
+# '/v1/changes' from there) followed by an '<ekpubhash>/<filename>' member
+# for each file of each entry. It is generated as it's sent, so memory use
+# doesn't depend on the size of the DB.
+class ChunkWriter:
+    def __init__(self):
+        self.chunks = []
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+    def take(self):
+        b = b''.join(self.chunks)
+        self.chunks = []
+        return b
+
+def tar_add(tar, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+@app.route('/v1/export', methods=['GET'])
+def my_export():
+    ekpubhash = request.args.get('ekpubhash', '')
+    if len(ekpubhash) > 64 or not re.fullmatch('[0-9a-f]*', ekpubhash):
+        return make_response("Error: bad ekpubhash", 400)
+    # Invoke backend logic
+    seq, entries = backend_export(ekpubhash)
+    now = int(time.time())
+    def generate():
+        out = ChunkWriter()
+        with tarfile.open(fileobj = out, mode = 'w|gz') as tar:
+            tar_add(tar, 'SNAPSHOT',
+                    json.dumps({ 'seq': seq, 'time': now,
+                                 'ekpubhash': ekpubhash }).encode(), now)
+            for h, files in entries:
+                for name, data in files:
+                    tar_add(tar, f"{h}/{name}", data, now)
+                chunk = out.take()
+                if chunk:
+                    yield chunk
+        yield out.take()
+    resp = Response(generate(), 200, mimetype = 'application/gzip')
+    resp.headers['Content-Disposition'] = \
+        f"attachment; filename=enrollsvc-{seq}.tar.gz"
+    return resp
+
+# Ingests an archive produced by '/v1/export', streamed as the request body.
+# Entries are staged and handed to the backend 'add_batch' handler
+# IMPORT_BATCH at a time, so memory (and temp space) use doesn't depend on
+# the size of the archive. Entries that are already enrolled are left alone.
+# Each entry is checked for consistency (its name must be the hash of its
+# 'ek.pub'), the others are rejected. The response reports counts, and the
+# 'SNAPSHOT' object from the archive.
+#
+# Files that the backend derives from 'ek.pub' (IMPORT_DERIVED) are dropped
+# rather than imported, so they're always recomputed from the 'ek.pub' whose
+# hash was checked (an archive's 'ek.tpm2b' could be for some other key).
+# The export always turns a 'profile.ref' back into a self-contained 'profile'
+# (which the add stores content-addressed again, see profile_store()), so an
+# entry with a 'profile.ref' (that would refer to a profile blob that we may
+# not have) is rejected.
+IMPORT_DERIVED = [ 'ek.tpm2b', 'ek.name' ]
+
+@app.route('/v1/import', methods=['POST'])
+def my_import():
+    result = { 'added': 0, 'exists': 0, 'rejected': 0, 'errors': [] }
+    def reject(h, error):
+        result['rejected'] += 1
+        if len(result['errors']) < MAX_IMPORT_ERRORS:
+            result['errors'].append({ 'ekpubhash': h, 'error': error })
+    def flush(tempdir, staged):
+        if not staged:
+            return
+        # Invoke backend logic
+        batchresult, batchcode = backend_add_batch(
+            [ f"{tempdir}/{h}" for h in staged ])
+        if batchcode != 200:
+            raise Exception(f"add_batch failed: {batchcode}")
+        for h, r in zip(staged, batchresult['results']):
+            if r['status'] == 201:
+                result['added'] += 1
+            elif r['status'] == 409:
+                result['exists'] += 1
+            else:
+                reject(h, r.get('error', f"status {r['status']}"))
+        for h in staged:
+            shutil.rmtree(f"{tempdir}/{h}")
+        staged.clear()
+    def stage(tempdir, h, staged):
+        try:
+            with open(f"{tempdir}/{h}/ek.pub", 'rb') as fp:
+                ekpub = fp.read()
+        except FileNotFoundError:
+            reject(h, 'no ek.pub')
+            return
+        if hashlib.sha256(ekpub).hexdigest() != h:
+            reject(h, 'ek.pub hash mismatch')
+            return
+        if os.path.exists(f"{tempdir}/{h}/profile.ref"):
+            reject(h, 'unexpected profile.ref')
+            return
+        for name in IMPORT_DERIVED:
+            try:
+                os.remove(f"{tempdir}/{h}/{name}")
+            except FileNotFoundError:
+                pass
+        with open(f"{tempdir}/{h}/ekpubhash", 'w') as fp:
+            fp.write(h)
+        staged.append(h)
+        if len(staged) >= IMPORT_BATCH:
+            flush(tempdir, staged)
+    try:
+        with tempfile.TemporaryDirectory() as tempdir:
+            staged = []
+            current = None
+            tar = tarfile.open(fileobj = request.stream, mode = 'r|*')
+            for member in tar:
+                if member.name == 'SNAPSHOT':
+                    if member.size <= MAX_IMPORT_FILE:
+                        result['snapshot'] = json.loads(
+                            tar.extractfile(member).read())
+                    continue
+                parts = member.name.split('/')
+                if not member.isfile() or len(parts) != 2 or \
+                        not re.fullmatch('[0-9a-f]{64}', parts[0]) or \
+                        parts[1] != secure_filename(parts[1]):
+                    return make_response(
+                        f"Error: unexpected archive member: {member.name}",
+                        400)
+                h, name = parts
+                if h != current:
+                    if current and os.path.isdir(f"{tempdir}/{current}"):
+                        stage(tempdir, current, staged)
+                    current = h
+                    if os.path.exists(f"{tempdir}/{h}"):
+                        return make_response(
+                            f"Error: archive entries out of order: {h}", 400)
+                    os.mkdir(f"{tempdir}/{h}")
+                if member.size > MAX_IMPORT_FILE:
+                    shutil.rmtree(f"{tempdir}/{h}")
+                    reject(h, f"file too large: {name}")
+                    continue
+                if not os.path.isdir(f"{tempdir}/{h}"):
+                    continue
+                with open(f"{tempdir}/{h}/{name}", 'wb') as fp:
+                    shutil.copyfileobj(tar.extractfile(member), fp)
+            if current and os.path.isdir(f"{tempdir}/{current}"):
+                stage(tempdir, current, staged)
+            flush(tempdir, staged)
+    except (tarfile.TarError, EOFError, OSError, ValueError) as e:
+        result['error'] = f"{e}"
+        resp = make_response(result, 400)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+    resp = make_response(result, 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
 @app.route('/v1/janitor', methods=['GET'])
 def my_janitor():
     # Invoke backend logic
-    result, resultcode = backend_janitor(ekpubhash, nofiles)
+    full = 'full' in request.args
+    result, resultcode = backend_janitor(full)
+    resp = make_response(result, resultcode)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+@app.route('/v1/janitor/status', methods=['GET'])
+def my_janitor_status():
+    # Invoke backend logic
+    result, resultcode = backend_janitor_status()
     resp = make_response(result, resultcode)
     resp.headers['Content-Type'] = 'application/json'
     return resp
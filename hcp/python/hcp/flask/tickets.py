@@ -0,0 +1,281 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# The attestsvc's ticket keys. A ticket is the server's state for an
+# attestation, held by the client between initiate and complete. It's the
+# JSON of the ticket fields sealed with AES-256-GCM (so it's both secret and
+# tamper-proof), under one of the keys in a key ring, and encoded as;
+#     'v2.' + <kid> + '.' + base64url(iv || ciphertext || tag)
+# where 'kid' identifies the key (and is authenticated along with the fields).
+#
+# The keys are the provisioned key file plus any files in the key ring
+# directory. Each file holds a secret on its first line (as 'openssl -kfile'
+# uses it), and a key's ID is derived from that secret, so every worker (on
+# any host) agrees on the IDs without coordinating. The newest key (by file
+# mtime) is used to seal tickets, and all of them are accepted.
+#
+# A background thread in each worker rescans the files every POLL seconds,
+# deriving the AES key for any new secret (with PBKDF2, once per key, so that
+# cost is never paid per-request). A secret whose file disappears (or is
+# overwritten) is still accepted for 'overlap' seconds (at least the maximum
+# ticket age), so rotating keys never breaks a ticket that was issued before
+# the rotation. A ticket naming a key we don't have (yet) causes an immediate
+# rescan, at most once per second, in case it was sealed by another worker
+# that saw a new key first.
+#
+# Rotation is either done by an operator (add the new key file to the ring,
+# remove the old one whenever convenient) or, if 'lifetime' is set, by the
+# workers; the first to notice that the newest key in the ring is older than
+# 'lifetime' adds a new one, and ring keys are removed once a newer key has
+# been in use for long enough that no ticket can still need them. (That only
+# works when the workers share the key ring directory, which is why it's
+# optional.)
+#
+# Tickets issued in the original format ('openssl aes-256-cbc -pbkdf2'
+# output, base64 encoded) by an older attestsvc are still accepted until
+# 'legacy_until' (the caller sets that to just over the maximum ticket age
+# after startup, by which time they've all expired), and only with the
+# provisioned key file, which is what the older attestsvc used. Opening one
+# costs a PBKDF2 derivation, which is why it's bounded like that; after
+# 'legacy_until' they're rejected without one.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import base64
+import hashlib
+import secrets
+import binascii
+import threading
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives import padding
+from cryptography.exceptions import InvalidTag
+from hcp.backend.common import write_atomic, ProcessThread
+
+# TODO: configure
+POLL = 10
+KDF_ITERATIONS = 100000
+
+PREFIX = 'v2.'
+AAD = b'hcp-attestsvc-ticket-v2'
+
+def debug(s):
+    sys.stderr.write(f"{s}\n")
+
+def _b64decode(s):
+    return base64.b64decode(s, altchars = b'-_', validate = True)
+
+def _kid(password):
+    return hashlib.sha256(b'hcp-attestsvc-kid\0' + password).hexdigest()[0:16]
+
+# One key of the ring. 'mtime' is of the file it came from, 'retired' is when
+# that file disappeared (None while it's still there).
+class Key:
+    def __init__(self, password, mtime):
+        self.password = password
+        self.kid = _kid(password)
+        self.aead = AESGCM(hashlib.pbkdf2_hmac('sha256', password,
+                                               AAD + b'\0' + self.kid.encode(),
+                                               KDF_ITERATIONS, 32))
+        self.mtime = mtime
+        self.retired = None
+
+class KeyRing:
+    def __init__(self, keyfile, keyring, overlap, lifetime = None,
+                 legacy_until = None):
+        self.keyfile = keyfile
+        self.keyring = keyring
+        self.overlap = overlap
+        self.lifetime = lifetime
+        self.legacy_until = legacy_until
+        self.keys = {}
+        self.current = None
+        # The key from the provisioned key file, for legacy tickets
+        self.legacy = None
+        self.lock = threading.Lock()
+        self.last_scan = 0
+        self.thread = ProcessThread(self._background, reset = self._reset)
+        try:
+            self.scan()
+        except OSError:
+            # Not there yet, we'll try again when the first ticket is needed
+            pass
+
+    # The files that hold keys, as (path, mtime) 2-tuples
+    def _files(self):
+        paths = [ self.keyfile ]
+        if self.keyring and os.path.isdir(self.keyring):
+            paths += [ f"{self.keyring}/{name}"
+                       for name in sorted(os.listdir(self.keyring))
+                       if not name.startswith('.') ]
+        result = []
+        for path in paths:
+            try:
+                result.append((path, os.stat(path).st_mtime))
+            except FileNotFoundError:
+                pass
+        return result
+
+    # Reloads the key files. The key dict is replaced rather than modified, so
+    # seal() and open() don't need the lock.
+    def scan(self):
+        with self.lock:
+            now = time.time()
+            self.last_scan = now
+            keys = dict(self.keys)
+            seen = {}
+            for path, mtime in self._files():
+                try:
+                    with open(path, 'rb') as fp:
+                        password = fp.readline().rstrip(b'\r\n')
+                except FileNotFoundError:
+                    continue
+                if not password:
+                    continue
+                kid = _kid(password)
+                if kid not in keys:
+                    keys[kid] = Key(password, mtime)
+                if path == self.keyfile:
+                    self.legacy = keys[kid]
+                seen[kid] = max(mtime, seen.get(kid, mtime))
+            for kid, key in list(keys.items()):
+                if kid in seen:
+                    key.mtime = seen[kid]
+                    key.retired = None
+                    continue
+                if key.retired is None:
+                    key.retired = now
+                elif now > key.retired + self.overlap:
+                    del keys[kid]
+            active = [ k for k in keys.values() if k.retired is None ]
+            self.keys = keys
+            self.current = max(active, key = lambda k: (k.mtime, k.kid)) \
+                if active else None
+            if not keys:
+                raise FileNotFoundError(
+                    f"no ticket keys in {self.keyfile} or {self.keyring}")
+
+    # Adds a new key to the ring if the newest is older than 'lifetime', and
+    # removes those that no ticket can need any more. Only one worker does
+    # this at a time.
+    def rotate(self):
+        if not self.lifetime or not self.keyring:
+            return
+        os.makedirs(self.keyring, mode = 0o700, exist_ok = True)
+        with open(f"{self.keyring}/.lock", 'a') as lockfp:
+            try:
+                fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            now = time.time()
+            ring = [ (mtime, path) for path, mtime in self._files()
+                     if path != self.keyfile ]
+            ring.sort()
+            if not ring or now - ring[-1][0] >= self.lifetime:
+                path = f"{self.keyring}/{int(now)}-{secrets.token_hex(4)}"
+                write_atomic(path, f"{secrets.token_hex(32)}\n".encode())
+                ring.append((os.stat(path).st_mtime, path))
+            # A key can go once its successor has been sealing tickets for
+            # long enough that every worker switched to it and the tickets
+            # sealed with it before that have expired.
+            for (_, path), (successor, _) in zip(ring, ring[1:]):
+                if now - successor > self.overlap + 2 * POLL:
+                    os.remove(path)
+
+    def _background(self):
+        while True:
+            time.sleep(POLL)
+            try:
+                self.rotate()
+                self.scan()
+            except Exception as e:
+                debug(f"WARNING: ticket key scan failed: {e}")
+
+    # (Each worker's background thread is started on its first seal() or
+    # open().)
+    def _reset(self):
+        self.lock = threading.Lock()
+        try:
+            self.rotate()
+        except OSError as e:
+            debug(f"WARNING: ticket key rotation failed: {e}")
+
+    def _rescan(self):
+        if time.time() - self.last_scan >= 1:
+            try:
+                self.scan()
+            except OSError:
+                pass
+
+    # Raises OSError if there's no key to seal with. (The keys we have may all
+    # be retired, i.e. only kept for opening tickets sealed before their files
+    # disappeared.)
+    def seal(self, fields):
+        self.thread.started()
+        if not self.current:
+            self.scan()
+        key = self.current
+        if not key:
+            raise FileNotFoundError(
+                f"no active ticket keys in {self.keyfile} or {self.keyring}")
+        iv = secrets.token_bytes(12)
+        sealed = key.aead.encrypt(iv, json.dumps(fields).encode(),
+                                  AAD + key.kid.encode())
+        return f"{PREFIX}{key.kid}." + \
+            base64.urlsafe_b64encode(iv + sealed).decode()
+
+    # openssl's 'enc' format; 'Salted__' || salt || AES-256-CBC(PKCS#7
+    # padded), with the key and IV from PBKDF2-HMAC-SHA256 (10000 iterations).
+    def _open_openssl(self, raw):
+        if not self.legacy_until or time.time() > self.legacy_until:
+            raise ValueError('legacy tickets are no longer accepted')
+        key = self.legacy
+        if not key:
+            raise ValueError('no key for legacy tickets')
+        if len(raw) < 32 or not raw.startswith(b'Salted__'):
+            raise ValueError('bad legacy ticket')
+        keyiv = hashlib.pbkdf2_hmac('sha256', key.password, raw[8:16],
+                                    10000, 48)
+        decryptor = Cipher(algorithms.AES(keyiv[0:32]),
+                           modes.CBC(keyiv[32:48])).decryptor()
+        padded = decryptor.update(raw[16:]) + decryptor.finalize()
+        unpadder = padding.PKCS7(128).unpadder()
+        try:
+            plain = unpadder.update(padded) + unpadder.finalize()
+            return plain.decode()
+        except (ValueError, UnicodeDecodeError):
+            raise InvalidTag()
+
+    # Returns the ticket fields, or raises ValueError (or a subclass) if the
+    # ticket wasn't issued by us (or can't be decoded).
+    def open(self, ticket):
+        self.thread.started()
+        if not isinstance(ticket, str):
+            raise ValueError('ticket is not a string')
+        try:
+            if ticket.startswith(PREFIX):
+                kid, _, sealed = ticket[len(PREFIX):].partition('.')
+                key = self.keys.get(kid)
+                if not key:
+                    self._rescan()
+                    key = self.keys.get(kid)
+                if not key:
+                    raise ValueError('ticket key unknown or expired')
+                raw = _b64decode(sealed)
+                if len(raw) < 12:
+                    raise ValueError('ticket too short')
+                plain = key.aead.decrypt(raw[0:12], raw[12:],
+                                         AAD + kid.encode())
+            else:
+                plain = self._open_openssl(base64.b64decode(ticket,
+                                                            validate = True))
+            result = json.loads(plain)
+        except InvalidTag:
+            raise ValueError('ticket authentication failed')
+        except (binascii.Error, UnicodeDecodeError) as e:
+            raise ValueError(f"{e}")
+        if not isinstance(result, dict):
+            raise ValueError('ticket is not an object')
+        return result
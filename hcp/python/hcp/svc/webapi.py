@@ -62,6 +62,12 @@ myclienttimeout = webapi_param('clienttimeout', int, default = 600)
 myenv = webapi_param('uwsgi_env', dict, default = {})
 myuid = webapi_param('uwsgi_uid', str, default = 'www-data')
 mygid = webapi_param('uwsgi_gid', str, default = 'www-data')
+# "uwsgi" (the default) or "asgi" (see hcp/flask/asgi.py). The 'uwsgi_*'
+# settings apply to either.
+myserver = webapi_param('server', str, default = 'uwsgi')
+myasgithreads = webapi_param('asgi_threads', int, default = 256)
+if myserver not in [ 'uwsgi', 'asgi' ]:
+    h.bail(f"Unrecognized 'server' value: {myserver}")
 
 if myhttps:
     def https_param(field, _type, required = True, default = None):
@@ -116,6 +122,7 @@ etcjson = f"{myetc}/json"
 myvarlog = f"/var/log/{myservername}"
 lognginx = f"{myvarlog}/nginx"
 myuwsgisock = f"/tmp/{myservername}.uwsgi.sock"
+myasgisock = f"/tmp/{myservername}.asgi.sock"
 
 try:
     verbosity = int(os.environ['VERBOSE'])
@@ -157,9 +164,29 @@ os.makedirs(myetc)
 if myhttps:
     h.hlog(1, f"Converting template nginx config: {etcnginx}")
     shutil.copytree('/usecase/conf/nginx', etcnginx)
+    if myserver == 'asgi':
+        # The equivalent of uwsgi_params is passed as headers, which
+        # hcp/flask/asgi.py trusts (only) from this socket.
+        upstream = '''\t\t\tproxy_read_timeout\t20;
+\t\t\tproxy_send_timeout\t20;
+\t\t\tproxy_http_version\t1.1;
+\t\t\tproxy_set_header\tConnection "";
+\t\t\tproxy_set_header\tHost $host;
+\t\t\tproxy_set_header\tX-HCP-Remote-User $remote_user;
+\t\t\tproxy_set_header\tX-HCP-HTTPS $https;
+\t\t\tproxy_set_header\tX-HCP-SSL-Client-Cert $ssl_client_escaped_cert;
+\t\t\tproxy_set_header\tX-HCP-SSL-Client-S-DN $ssl_client_s_dn;
+\t\t\tproxy_set_header\tX-HCP-SSL-Client-S-DN-Legacy $ssl_client_s_dn_legacy;
+\t\t\tproxy_pass\t\thttp://unix:{asgisock}:;'''.format(asgisock = myasgisock)
+    else:
+        upstream = '''\t\t\tinclude\t\t\t{etcdir}/uwsgi_params;
+\t\t\tuwsgi_read_timeout\t20;
+\t\t\tuwsgi_send_timeout\t20;
+\t\t\tuwsgi_pass\t\tunix:{uwsgisock};'''
     with open(f"{etcnginx}/nginx.conf.template", "r") as _input:
         with open(f"{etcnginx}/nginx.conf", "w") as _output:
             while _output.write(_input.read().replace(
+                    "{upstream}", upstream).replace(
                     "{etcdir}", etcnginx).replace(
                     "{varlogdir}", lognginx).replace(
                     "{varrunpid}", f"/run/{myservername}/nginx.pid").replace(
@@ -207,6 +234,27 @@ with open(hcpcfg_new, 'w') as fp:
 os.chmod(hcpcfg_new, 0o444)
 os.environ['HCP_CONFIG_FILE'] = hcpcfg_new
 
+if myserver == 'asgi':
+    h.hlog(1, f"Starting ASGI server")
+    asgienv = os.environ.copy()
+    asgienv['PYTHONPATH'] = '/hcp/python'
+    for k in myenv:
+        asgienv[k] = f"{myenv[k]}"
+    cmd = [ sys.executable, '-m', 'hcp.flask.asgi',
+            '--app', myapp,
+            '--processes', '2',
+            '--threads', f"{myasgithreads}",
+            '--client-timeout', f"{myclienttimeout}",
+            '--harakiri', f"{myharakiri}",
+            '--uid', myuid,
+            '--gid', mygid ]
+    if myhttps:
+        cmd += [ '--uds', myasgisock, '--trust-proxy' ]
+    else:
+        cmd += [ '--port', f"{myport}" ]
+    subprocess.run(cmd, env = asgienv)
+    sys.exit(0)
+
 # Produce the uwsgi config
 h.hlog(1, f"Converting template uwsgi config: {etcuwsgi}")
 with open(etcuwsgi, 'w') as fp:
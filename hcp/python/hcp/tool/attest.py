@@ -15,6 +15,7 @@ assetdir = hcp_config_extract('.attester.assetdir', must_exist = True)
 cacert = hcp_config_extract('.attester.cacert', must_exist = True)
 callback = hcp_config_extract('.attester.callback', or_default = True)
 dl = hcp_config_extract('.attester.dictionarylockout', or_default = True, default = True)
+eventlog = hcp_config_extract('.attester.eventlog', or_default = True)
 
 print("""
             Running attestclient:
@@ -23,7 +24,8 @@ print("""
       (asset-signature key) verifkey: {verifkey}
 (base directory for output) assetdir: {assetdir}
     (clear TPM DA) dictionarylockout: {dl}
-""".format(API = API, verifkey = verifkey, dl = dl,
+   (TPM event log, if sent) eventlog: {eventlog}
+""".format(API = API, verifkey = verifkey, dl = dl, eventlog = eventlog,
 	   assetdir = assetdir, cacert = cacert))
 
 def check_result(result, s):
@@ -40,7 +42,8 @@ with tempfile.TemporaryDirectory() as tempdir:
                  "Failed to get 'initial' from attestsvc")
 
     print('Producing quote from TPM...')
-    check_result(api.quote(pinitial, pquote, dictionarylockout = dl),
+    check_result(api.quote(pinitial, pquote, dictionarylockout = dl,
+                           eventlog = eventlog),
                  "Failed to product 'quote'")
 
     print('Completing attestation with server...')
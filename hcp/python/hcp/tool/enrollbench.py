@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Load-generation and scaling benchmark for the enrollsvc. This runs the
+# enrollsvc (hcp.flask.enrollsvc with the hcp.backend.enrollsvc hooks) against
+# a scratch enrollment DB, either in-process (via the flask test client, to
+# measure the app itself) or under uwsgi (to measure it as deployed, minus
+# the nginx front-end). The DB is grown to each of the requested sizes (using
+# /v1/add_batch) and at each size the latency of add, query (by ekpubhash
+# prefix), reenroll and delete is measured. The results are output as JSON,
+# so that runs against different backends can be compared.
+#
+# E.g.
+#     python3 -m hcp.tool.enrollbench --sizes 1000,100000 --output before.json
+#
+# '--ops' limits the operations measured, and '--app-path' runs the enrollsvc
+# from another tree (a checkout of an older commit, say) so that before/after
+# numbers can be taken with the same benchmark. E.g. for the add/delete
+# throughput on an empty DB;
+#     git worktree add /tmp/before <commit>^
+#     python3 -m hcp.tool.enrollbench --sizes 0 --samples 300 \
+#         --ops add,delete --app-path /tmp/before/hcp/python
+#     python3 -m hcp.tool.enrollbench --sizes 0 --samples 300 \
+#         --ops add,delete
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import struct
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+import tpm2.ekpub as ekpub
+
+loglevel = 0
+def set_loglevel(v):
+    global loglevel
+    loglevel = v
+
+def _log(level, s):
+    if level <= loglevel:
+        print(f"{s}", file = sys.stderr)
+def err(s):
+    _log(0, s)
+def log(s):
+    _log(1, s)
+def debug(s):
+    _log(2, s)
+
+# A synthetic EKpub; the TPM2B_PUBLIC of an RSA 2048 EK (as a swtpm would
+# produce) with a random modulus.
+def synthetic_ekpub():
+    modulus = b'\x80' + os.urandom(255)
+    tpmt = struct.pack('>HHIH', ekpub.TPM2_ALG_RSA, ekpub.TPM2_ALG_SHA256,
+                       ekpub.EK_ATTRIBUTES, len(ekpub.EK_POLICY)) + \
+        ekpub.EK_POLICY + \
+        struct.pack('>HHHHHI', ekpub.TPM2_ALG_AES, 128, ekpub.TPM2_ALG_CFB,
+                    ekpub.TPM2_ALG_NULL, 2048, 0) + \
+        struct.pack('>H', len(modulus)) + modulus
+    return struct.pack('>H', len(tpmt)) + tpmt
+
+def synthetic_profile(n):
+    return json.dumps({ 'hostname': f"bench{n}.hcphacking.xyz" })
+
+# The two ways of driving the enrollsvc. Both have the same get()/post()
+# methods, which return the http status code.
+
+OPS = [ 'add', 'query', 'reenroll', 'delete' ]
+
+class InProcess:
+    def __init__(self, dbroot, apppath = None):
+        # hcp.backend.common picks up the DB root when first imported
+        os.environ['HCP_BACKEND_DBROOT'] = dbroot
+        if apppath:
+            sys.path.insert(0, apppath)
+            for name in [ n for n in sys.modules
+                          if n == 'hcp' or n.startswith('hcp.') ]:
+                del sys.modules[name]
+        import hcp.backend.enrollsvc as enrollsvc
+        self.client = enrollsvc.app.test_client()
+    def get(self, path, params):
+        return self.client.get(path, query_string = params).status_code
+    def post(self, path, form = {}, files = {}, body = None,
+             content_type = None):
+        if body is not None:
+            return self.client.post(path, data = body,
+                                    content_type = content_type).status_code
+        data = dict(form)
+        for k, v in files.items():
+            data[k] = (io.BytesIO(v), 'ek.pub')
+        return self.client.post(path, data = data).status_code
+    def close(self):
+        pass
+
+class Uwsgi:
+    def __init__(self, dbroot, port, processes, threads, apppath = None):
+        import requests
+        binary = None
+        for b in [ 'uwsgi_python3', 'uwsgi_python312', 'uwsgi_python37',
+                   'uwsgi' ]:
+            binary = shutil.which(b)
+            if binary:
+                break
+        if not binary:
+            raise Exception('no uwsgi binary found')
+        pythonpath = apppath or os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+        app = f"{pythonpath}/hcp/backend/enrollsvc.py"
+        # Same settings as hcp/svc/webapi.py, other than the socket
+        cmd = [ binary, '--master', '--plugin', 'http',
+                '--http', f"127.0.0.1:{port}",
+                '--processes', f"{processes}", '--threads', f"{threads}",
+                '--wsgi-file', app, '--callable', 'app',
+                '--harakiri', '600', '--die-on-term', '--disable-logging',
+                '--env', f"PYTHONPATH={pythonpath}",
+                '--env', f"HCP_BACKEND_DBROOT={dbroot}" ]
+        log(f"Starting: {' '.join(cmd)}")
+        self.proc = subprocess.Popen(cmd, stdout = subprocess.DEVNULL,
+                                     stderr = subprocess.DEVNULL)
+        self.url = f"http://127.0.0.1:{port}"
+        self.session = requests.Session()
+        for _ in range(100):
+            try:
+                if self.session.get(f"{self.url}/healthcheck").ok:
+                    return
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.1)
+        self.close()
+        raise Exception('uwsgi did not come up')
+    def get(self, path, params):
+        return self.session.get(f"{self.url}{path}",
+                                params = params).status_code
+    def post(self, path, form = {}, files = {}, body = None,
+             content_type = None):
+        if body is not None:
+            return self.session.post(f"{self.url}{path}", data = body,
+                    headers = { 'Content-Type': content_type }).status_code
+        files = { k: ('ek.pub', v) for k, v in files.items() }
+        return self.session.post(f"{self.url}{path}", data = form,
+                                 files = files).status_code
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+def percentile(ordered, p):
+    return ordered[int(round(p / 100 * (len(ordered) - 1)))]
+
+# Runs 'fn' on each of 'inputs', timing each call. Returns the latency
+# statistics, in milliseconds.
+def measure(name, fn, inputs, expect):
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+    for i in inputs:
+        t = time.perf_counter()
+        code = fn(i)
+        latencies.append((time.perf_counter() - t) * 1000)
+        if code != expect:
+            failures += 1
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    stats = {
+        'count': len(latencies),
+        'failures': failures,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+        'ops_per_sec': len(latencies) / elapsed
+    }
+    log(f"  {name}: {stats}")
+    return stats
+
+class Bench:
+    def __init__(self, driver, samples, prefix_len, batch, ops = OPS):
+        self.driver = driver
+        self.ops = ops
+        self.samples = samples
+        self.prefix_len = prefix_len
+        self.batch = batch
+        self.count = 0
+        # A (reservoir) sample of the enrolled ekpubhashes, to pick query and
+        # reenroll targets from, without holding all of them.
+        self.known = []
+
+    def remember(self, ekpubhash):
+        self.count += 1
+        if len(self.known) < 10 * self.samples:
+            self.known.append(ekpubhash)
+        else:
+            i = random.randrange(self.count)
+            if i < len(self.known):
+                self.known[i] = ekpubhash
+
+    def populate(self, size):
+        added = 0
+        started = time.perf_counter()
+        while self.count < size:
+            n = min(self.batch, size - self.count)
+            lines = []
+            hashes = []
+            for i in range(n):
+                ek = synthetic_ekpub()
+                hashes.append(hashlib.sha256(ek).hexdigest())
+                lines.append(json.dumps({
+                    'ekpub': base64.b64encode(ek).decode(),
+                    'profile': synthetic_profile(self.count + i) }))
+            code = self.driver.post('/v1/add_batch',
+                                    body = '\n'.join(lines),
+                                    content_type = 'application/x-ndjson')
+            if code != 200:
+                raise Exception(f"add_batch failed: {code}")
+            for h in hashes:
+                self.remember(h)
+            added += n
+        elapsed = time.perf_counter() - started
+        return {
+            'added': added,
+            'seconds': elapsed,
+            'per_sec': added / elapsed if elapsed else None
+        }
+
+    def run(self, size):
+        log(f"Populating to {size} entries")
+        result = { 'entries': size, 'populate': self.populate(size) }
+        log(f"  populate: {result['populate']}")
+        eks = [ synthetic_ekpub() for _ in range(self.samples) ]
+        # (Query and reenroll need something enrolled, at size 0 they target
+        # what 'add' adds.)
+        known = self.known or [ hashlib.sha256(ek).hexdigest() for ek in eks ]
+        targets = [ random.choice(known) for _ in range(self.samples) ]
+        ops = {}
+        if 'add' in self.ops:
+            ops['add'] = measure('add',
+                lambda ek: self.driver.post('/v1/add', files = { 'ekpub': ek },
+                    form = { 'profile': synthetic_profile(size) }),
+                eks, 201)
+        if 'query' in self.ops:
+            ops['query'] = measure('query',
+                lambda h: self.driver.get('/v1/query', {
+                    'ekpubhash': h[0:self.prefix_len], 'nofiles': True }),
+                targets, 200)
+        if 'reenroll' in self.ops:
+            ops['reenroll'] = measure('reenroll',
+                lambda h: self.driver.post('/v1/reenroll',
+                                           form = { 'ekpubhash': h }),
+                targets, 200)
+        # Delete what 'add' added, so the DB is back to 'size' entries
+        if 'delete' in self.ops:
+            ops['delete'] = measure('delete',
+                lambda ek: self.driver.post('/v1/delete', form = {
+                    'ekpubhash': hashlib.sha256(ek).hexdigest() }),
+                eks, 200)
+        result['ops'] = ops
+        return result
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'enrollsvc benchmark')
+    parser.add_argument('--mode', choices = [ 'inprocess', 'uwsgi' ],
+                        default = 'inprocess',
+                        help = 'run the app in-process, or under uwsgi')
+    parser.add_argument('--sizes', default = '1000,100000,1000000',
+                        help = 'comma-separated DB sizes to measure at')
+    parser.add_argument('--ops', default = ','.join(OPS),
+                        help = 'comma-separated operations to measure')
+    parser.add_argument('--app-path', default = None,
+                        help = 'python path of the enrollsvc to run (default: this tree)')
+    parser.add_argument('--samples', type = int, default = 200,
+                        help = 'number of each operation to time, per size')
+    parser.add_argument('--prefix-len', type = int, default = 4,
+                        help = 'length of the ekpubhash prefix to query')
+    parser.add_argument('--batch', type = int, default = 1000,
+                        help = 'entries per add_batch when populating')
+    parser.add_argument('--dbroot', default = None,
+                        help = 'DB root to use (must be empty), default is a temp dir')
+    parser.add_argument('--keep', action = 'store_true',
+                        help = 'don\'t remove the DB afterwards')
+    parser.add_argument('--port', type = int, default = 9180,
+                        help = 'port for uwsgi to listen on')
+    parser.add_argument('--processes', type = int, default = 2,
+                        help = 'uwsgi processes')
+    parser.add_argument('--threads', type = int, default = 2,
+                        help = 'uwsgi threads per process')
+    parser.add_argument('--output', default = None,
+                        help = 'file to write the JSON results to (default: stdout)')
+    parser.add_argument('--seed', type = int, default = None,
+                        help = 'random seed, for repeatable query targets')
+    parser.add_argument('-v', '--verbose', default = 1, action = 'count',
+                        help = 'increase output verbosity')
+    args = parser.parse_args()
+    set_loglevel(args.verbose)
+    random.seed(args.seed)
+
+    sizes = sorted(int(x) for x in args.sizes.split(','))
+    ops = args.ops.split(',')
+    for op in ops:
+        if op not in OPS:
+            err(f"Error, unknown operation '{op}'")
+            sys.exit(1)
+    dbroot = args.dbroot
+    if dbroot:
+        os.makedirs(dbroot, exist_ok = True)
+        if os.listdir(dbroot):
+            err(f"Error, DB root '{dbroot}' isn't empty")
+            sys.exit(1)
+    else:
+        dbroot = tempfile.mkdtemp(prefix = 'enrollbench.')
+    log(f"Using DB root: {dbroot}")
+
+    if args.mode == 'uwsgi':
+        driver = Uwsgi(dbroot, args.port, args.processes, args.threads,
+                       apppath = args.app_path)
+    else:
+        driver = InProcess(dbroot, apppath = args.app_path)
+    output = {
+        'mode': args.mode,
+        'started': int(time.time()),
+        'samples': args.samples,
+        'prefix_len': args.prefix_len,
+        'ops': ops,
+        'results': []
+    }
+    if args.mode == 'uwsgi':
+        output['processes'] = args.processes
+        output['threads'] = args.threads
+    try:
+        bench = Bench(driver, args.samples, args.prefix_len, args.batch,
+                      ops = ops)
+        for size in sizes:
+            output['results'].append(bench.run(size))
+    finally:
+        driver.close()
+        if not args.keep:
+            shutil.rmtree(dbroot, ignore_errors = True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent = 2)
+    else:
+        print(json.dumps(output, indent = 2))
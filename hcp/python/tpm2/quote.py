@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import sys
+import json
+import struct
+import hashlib
+
+import tpm2.structures as tpm2s
+import tpm2.eventlog as tpm2e
+
+# In-process verification of a TPM quote, doing what 'tpm2 checkquote' does;
+# - the signature (TPMT_SIGNATURE, 'quote.sig') over the TPMS_ATTEST
+#   ('quote.out') is verified against the AK's public key (TPMT_PUBLIC,
+#   'ak.pub'),
+# - the quote's extraData must be the qualification (the attestation nonce),
+# - the PCR values that accompany the quote ('quote.pcr', as written by 'tpm2
+#   quote --pcr') must be for the PCRs the quote selects and must hash to the
+#   quote's pcrDigest.
+# verify() raises QuoteError (or tpm2s.StructureError) if any of that isn't
+# so, otherwise it returns the decoded TPMS_ATTEST and the (now trustworthy)
+# PCR values.
+
+class QuoteError(Exception):
+    pass
+
+TPM2_ECC_NIST_P256 = 0x0003
+TPM2_ECC_NIST_P384 = 0x0004
+TPM2_ECC_NIST_P521 = 0x0005
+
+hashAlgs = {
+    tpm2s.TPM2_ALG_SHA1: hashlib.sha1,
+    tpm2s.TPM2_ALG_SHA256: hashlib.sha256,
+    tpm2s.TPM2_ALG_SHA384: hashlib.sha384,
+    tpm2s.TPM2_ALG_SHA512: hashlib.sha512
+}
+
+# The sizes of the (C) structures that 'tpm2 quote --pcr' writes out as-is
+TPM2_NUM_PCR_BANKS = 16
+TPM2_PCR_SELECT_MAX = 4
+SIZEOF_TPMS_PCR_SELECTION = 8 # (2 + 1 + TPM2_PCR_SELECT_MAX, padded)
+SIZEOF_TPML_PCR_SELECTION = 4 + TPM2_NUM_PCR_BANKS * SIZEOF_TPMS_PCR_SELECTION
+TPML_DIGEST_MAX = 8
+SIZEOF_TPM2B_DIGEST = 2 + 64
+SIZEOF_TPML_DIGEST = 4 + TPML_DIGEST_MAX * SIZEOF_TPM2B_DIGEST
+
+# Decodes a 'quote.pcr'; the TPML_PCR_SELECTION, then a count of TPML_DIGESTs
+# and the TPML_DIGESTs themselves, each written as the in-memory C structure.
+# Older tpm2-tools wrote the integers in host order (little-endian), newer
+# ones in big-endian, so we go by whichever makes sense of the selection
+# count. Returns (selection, values), where 'selection' is like the output of
+# tpm2s.tpml_pcr_selection() and 'values' is the list of PCR values, in the
+# selection's order.
+def pcr_file(b):
+    if len(b) < SIZEOF_TPML_PCR_SELECTION + 4:
+        raise QuoteError('PCR file truncated')
+    for order in [ '>', '<' ]:
+        (count,) = struct.unpack(f"{order}I", b[0:4])
+        if 0 < count <= TPM2_NUM_PCR_BANKS:
+            break
+    else:
+        raise QuoteError('PCR file has a bad selection count')
+    selections = []
+    for i in range(count):
+        off = 4 + i * SIZEOF_TPMS_PCR_SELECTION
+        (_hash, sizeofSelect) = struct.unpack(f"{order}HB", b[off:off + 3])
+        if sizeofSelect > TPM2_PCR_SELECT_MAX:
+            raise QuoteError('PCR file has a bad sizeofSelect')
+        selections.append({
+            'hash': _hash,
+            'sizeofSelect': sizeofSelect,
+            'pcrSelect': bytes(b[off + 3:off + 3 + sizeofSelect])
+        })
+    selection = { 'count': count, 'pcrSelections': selections }
+    off = SIZEOF_TPML_PCR_SELECTION
+    (ndigests,) = struct.unpack(f"{order}I", b[off:off + 4])
+    off += 4
+    if len(b) != off + ndigests * SIZEOF_TPML_DIGEST:
+        raise QuoteError('PCR file has the wrong size')
+    values = []
+    for _ in range(ndigests):
+        (n,) = struct.unpack(f"{order}I", b[off:off + 4])
+        if n > TPML_DIGEST_MAX:
+            raise QuoteError('PCR file has a bad digest count')
+        for i in range(n):
+            d = off + 4 + i * SIZEOF_TPM2B_DIGEST
+            (size,) = struct.unpack(f"{order}H", b[d:d + 2])
+            if size > SIZEOF_TPM2B_DIGEST - 2:
+                raise QuoteError('PCR file has a bad digest size')
+            values.append(bytes(b[d + 2:d + 2 + size]))
+        off += SIZEOF_TPML_DIGEST
+    return selection, values
+
+def _public_key(akpub):
+    # Deferred, as with tpm2/ekpub.py
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    if akpub['type'] == tpm2s.TPM2_ALG_ECC:
+        curves = {
+            TPM2_ECC_NIST_P256: ec.SECP256R1,
+            TPM2_ECC_NIST_P384: ec.SECP384R1,
+            TPM2_ECC_NIST_P521: ec.SECP521R1
+        }
+        curveID = akpub['parameters']['curveID']
+        if curveID not in curves:
+            raise QuoteError(f"unsupported AK curve: {curveID:#06x}")
+        try:
+            return ec.EllipticCurvePublicNumbers(
+                int.from_bytes(akpub['unique']['x'], 'big'),
+                int.from_bytes(akpub['unique']['y'], 'big'),
+                curves[curveID]()).public_key()
+        except ValueError as e:
+            raise QuoteError(f"bad AK public key: {e}")
+    if akpub['type'] == tpm2s.TPM2_ALG_RSA:
+        # An exponent of zero means the default (65537)
+        exponent = akpub['parameters']['exponent'] or 65537
+        try:
+            return rsa.RSAPublicNumbers(
+                exponent, int.from_bytes(akpub['unique'], 'big')).public_key()
+        except ValueError as e:
+            raise QuoteError(f"bad AK public key: {e}")
+    raise QuoteError(f"unsupported AK type: {akpub['type']:#06x}")
+
+def _verify_signature(akpub, signature, message):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding
+    from cryptography.hazmat.primitives.asymmetric.utils import \
+        encode_dss_signature
+    from cryptography.exceptions import InvalidSignature
+    algs = {
+        tpm2s.TPM2_ALG_SHA1: hashes.SHA1,
+        tpm2s.TPM2_ALG_SHA256: hashes.SHA256,
+        tpm2s.TPM2_ALG_SHA384: hashes.SHA384,
+        tpm2s.TPM2_ALG_SHA512: hashes.SHA512
+    }
+    sigAlg = signature['sigAlg']
+    if 'signature' not in signature or \
+            signature['signature'].get('hash') not in algs:
+        raise QuoteError(f"unsupported quote signature: {sigAlg:#06x}")
+    alg = algs[signature['signature']['hash']]()
+    key = _public_key(akpub)
+    try:
+        if sigAlg == tpm2s.TPM2_ALG_ECDSA and \
+                isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(encode_dss_signature(
+                int.from_bytes(signature['signature']['signatureR'], 'big'),
+                int.from_bytes(signature['signature']['signatureS'], 'big')),
+                message, ec.ECDSA(alg))
+        elif sigAlg == tpm2s.TPM2_ALG_RSASSA and \
+                not isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(signature['signature']['sig'], message,
+                       padding.PKCS1v15(), alg)
+        elif sigAlg == tpm2s.TPM2_ALG_RSAPSS and \
+                not isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(signature['signature']['sig'], message,
+                       padding.PSS(mgf = padding.MGF1(alg),
+                                   salt_length = padding.PSS.AUTO), alg)
+        else:
+            raise QuoteError(f"quote signature ({sigAlg:#06x}) doesn't " +
+                             'match the AK')
+    except InvalidSignature:
+        raise QuoteError('quote signature is invalid')
+
+# 'akpub', 'message', 'signature' and 'pcrs' are the contents of 'ak.pub',
+# 'quote.out', 'quote.sig' and 'quote.pcr' respectively, and 'qualification'
+# is what the quote's extraData should be. Returns (attest, pcrs), where
+# 'attest' is the decoded TPMS_ATTEST and 'pcrs' is a dict from the hash
+# algorithm to a dict from PCR index to value.
+def verify(akpub, message, signature, pcrs, qualification):
+    akpub = tpm2s.tpmt_public(akpub)
+    attest = tpm2s.tpms_attest(message)
+    signature = tpm2s.tpmt_signature(signature)
+    if attest['type'] != tpm2s.TPM2_ST_ATTEST_QUOTE:
+        raise QuoteError('not a quote')
+    _verify_signature(akpub, signature, message)
+    if attest['extraData'] != qualification:
+        raise QuoteError('quote has the wrong qualification (nonce)')
+    quoted = tpm2s.pcr_selection_indices(attest['attested']['pcrSelect'])
+    selection, values = pcr_file(pcrs)
+    if tpm2s.pcr_selection_indices(selection) != quoted:
+        raise QuoteError("PCR values don't match the quote's selection")
+    # The pcrDigest is over the selected PCRs, in selection order (and by
+    # index within each bank), with the hash of the signing scheme
+    h = hashAlgs[signature['signature']['hash']]()
+    result = {}
+    i = 0
+    for s in attest['attested']['pcrSelect']['pcrSelections']:
+        bank = result.setdefault(s['hash'], {})
+        for index in tpm2s.pcr_selection_indices(
+                { 'pcrSelections': [ s ] })[s['hash']]:
+            if i >= len(values):
+                raise QuoteError('too few PCR values')
+            bank[index] = values[i]
+            h.update(values[i])
+            i += 1
+    if i != len(values):
+        raise QuoteError('too many PCR values')
+    if h.digest() != attest['attested']['pcrDigest']:
+        raise QuoteError("PCR values don't match the quote's digest")
+    return attest, result
+
+# 'eventlog' is the binary (TCG) event log and 'pcrs' the PCR values as
+# returned by verify(). The log is replayed and the result must match the
+# quote for every PCR that both cover (and there must be at least one). PCRs
+# that aren't quoted can't be checked, so the events for those are dropped
+# (as are the EV_NO_ACTION ones, which aren't measured); returns the list of
+# the remaining (parsed) events.
+#
+# That proves the events' digests, but not their payloads (the 'event' field),
+# which the host could have changed without affecting the replay. Where the
+# digests are the hash of the payload itself (as they are for EV_SEPARATOR,
+# EV_EFI_ACTION, EV_EFI_VARIABLE_DRIVER_CONFIG, etc), that proves the payload
+# too. For the others (where the digest is of something else, such as the
+# image that was loaded), the payload is replaced with None, so that nobody
+# can mistake it for something that was measured.
+def verify_eventlog(eventlog, pcrs):
+    try:
+        log = tpm2e.TCG_EventLog(eventlog)
+    except (AssertionError, struct.error, ValueError) as e:
+        raise QuoteError(f"bad event log: {e}")
+    replayed = tpm2e.replay(log)
+    checked = set()
+    for alg, bank in replayed.items():
+        for index, value in bank.items():
+            if index not in pcrs.get(alg, {}):
+                continue
+            if pcrs[alg][index] != value:
+                raise QuoteError(f"event log doesn't match PCR {index} " +
+                                 f"(bank {alg:#06x})")
+            checked.add((alg, index))
+    if not checked:
+        raise QuoteError('event log has no PCRs in common with the quote')
+    events = [ event for event in log
+               if not event.isFirst and
+               event[tpm2e.STR_eventType] != tpm2e.TCG_EventType.EV_NO_ACTION and
+               any((ha[tpm2e.STR_algId], event[tpm2e.STR_PCRIndex]) in checked
+                   for ha in event[tpm2e.STR_digests][tpm2e.STR_digests]) ]
+    for event in events:
+        if not _payload_measured(event, checked):
+            event[tpm2e.STR_event] = None
+    return events
+
+# True if one of the event's checked digests is the hash of its payload.
+def _payload_measured(event, checked):
+    for ha in event[tpm2e.STR_digests][tpm2e.STR_digests]:
+        alg = ha[tpm2e.STR_algId]
+        if (alg, event[tpm2e.STR_PCRIndex]) not in checked or \
+                alg not in tpm2e.replayAlgs:
+            continue
+        if tpm2e.replayAlgs[alg](event[tpm2e.STR_event]).digest() == \
+                ha[tpm2e.STR_digest]:
+            return True
+    return False
+
+if __name__ == '__main__':
+
+    sys.argv.pop(0)
+
+    if len(sys.argv) not in (5, 6):
+        print('Usage: quote.py <ak.pub> <quote.out> <quote.sig> <quote.pcr> ' +
+              '<qualification-file> [<eventlog>]', file = sys.stderr)
+        sys.exit(1)
+
+    inputs = [ open(path, 'rb').read() for path in sys.argv ]
+    try:
+        attest, pcrs = verify(*inputs[0:5])
+        events = verify_eventlog(inputs[5], pcrs) if len(inputs) > 5 else None
+    except (QuoteError, tpm2s.StructureError) as e:
+        print(f"Error: {e}", file = sys.stderr)
+        sys.exit(1)
+    output = { 'attest': attest,
+               'pcrs': { f"{alg:#06x}": { f"{i}": v.hex()
+                                          for i, v in bank.items() }
+                         for alg, bank in pcrs.items() } }
+    if events is not None:
+        output['events'] = events
+    print(json.dumps(output, cls = tpm2s.JSONEncoder, indent = 2))
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import sys
+import json
+import struct
+
+# Decoders for the (marshaled, i.e. big-endian) TPM 2.0 structures that come
+# back from an attestation; the AK's TPMT_PUBLIC ('tpm2 readpublic --format
+# tpmt'), the TPMS_ATTEST of a quote ('tpm2 quote --message') and the
+# TPML_PCR_SELECTION within it, and the quote's TPMT_SIGNATURE ('tpm2 quote
+# --signature'). These replace 'tpm2 print' (and parsing its
+# YAML output). The results are dicts, keyed by the field names in the TPM 2.0
+# spec (Part 2), with integers for the integer fields and bytes for the
+# TPM2B/byte-array fields. Anything malformed raises StructureError.
+
+class StructureError(Exception):
+    pass
+
+TPM2_ALG_RSA = 0x0001
+TPM2_ALG_KEYEDHASH = 0x0008
+TPM2_ALG_NULL = 0x0010
+TPM2_ALG_ECDAA = 0x001a
+TPM2_ALG_SHA1 = 0x0004
+TPM2_ALG_HMAC = 0x0005
+TPM2_ALG_XOR = 0x000a
+TPM2_ALG_SHA256 = 0x000b
+TPM2_ALG_SHA384 = 0x000c
+TPM2_ALG_SHA512 = 0x000d
+TPM2_ALG_RSASSA = 0x0014
+TPM2_ALG_RSAES = 0x0015
+TPM2_ALG_RSAPSS = 0x0016
+TPM2_ALG_ECDSA = 0x0018
+TPM2_ALG_ECC = 0x0023
+TPM2_ALG_SYMCIPHER = 0x0025
+
+TPM2_GENERATED_VALUE = 0xff544347
+
+TPM2_ST_ATTEST_CERTIFY = 0x8017
+TPM2_ST_ATTEST_QUOTE = 0x8018
+
+# TPMA_OBJECT
+TPMA_OBJECT_FIXEDTPM = 0x00000002
+TPMA_OBJECT_STCLEAR = 0x00000004
+TPMA_OBJECT_FIXEDPARENT = 0x00000010
+TPMA_OBJECT_SENSITIVEDATAORIGIN = 0x00000020
+TPMA_OBJECT_USERWITHAUTH = 0x00000040
+TPMA_OBJECT_ADMINWITHPOLICY = 0x00000080
+TPMA_OBJECT_NODA = 0x00000400
+TPMA_OBJECT_ENCRYPTEDDUPLICATION = 0x00000800
+TPMA_OBJECT_RESTRICTED = 0x00010000
+TPMA_OBJECT_DECRYPT = 0x00020000
+TPMA_OBJECT_SIGN_ENCRYPT = 0x00040000
+TPMA_OBJECT_X509SIGN = 0x00080000
+
+# A cursor over the blob being decoded
+class Unmarshal:
+    def __init__(self, b):
+        self.b = memoryview(b)
+        self.pos = 0
+
+    def take(self, n):
+        if self.pos + n > len(self.b):
+            raise StructureError(f"truncated at offset {self.pos} " +
+                                 f"(wanted {n} bytes)")
+        v = self.b[self.pos:self.pos + n]
+        self.pos += n
+        return v
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.take(struct.calcsize(fmt)))
+
+    def u8(self):
+        return self.unpack('>B')[0]
+
+    def u16(self):
+        return self.unpack('>H')[0]
+
+    def u32(self):
+        return self.unpack('>I')[0]
+
+    def u64(self):
+        return self.unpack('>Q')[0]
+
+    # Any TPM2B_*; a 2-byte size then that many bytes
+    def tpm2b(self):
+        return bytes(self.take(self.u16()))
+
+    def done(self):
+        if self.pos != len(self.b):
+            raise StructureError(f"{len(self.b) - self.pos} trailing bytes")
+
+def _scheme(u):
+    scheme = { 'scheme': u.u16() }
+    if scheme['scheme'] != TPM2_ALG_NULL:
+        scheme['details'] = { 'hashAlg': u.u16() }
+        if scheme['scheme'] == TPM2_ALG_ECDAA:
+            scheme['details']['count'] = u.u16()
+    return scheme
+
+def _rsa_scheme(u):
+    scheme = { 'scheme': u.u16() }
+    # (RSAES has no details, the signing schemes and OAEP have a hashAlg)
+    if scheme['scheme'] not in (TPM2_ALG_NULL, TPM2_ALG_RSAES):
+        scheme['details'] = { 'hashAlg': u.u16() }
+    return scheme
+
+def _keyedhash_scheme(u):
+    scheme = { 'scheme': u.u16() }
+    if scheme['scheme'] != TPM2_ALG_NULL:
+        scheme['details'] = { 'hashAlg': u.u16() }
+        if scheme['scheme'] == TPM2_ALG_XOR:
+            scheme['details']['kdf'] = u.u16()
+    return scheme
+
+def _sym_def_object(u):
+    sym = { 'algorithm': u.u16() }
+    if sym['algorithm'] != TPM2_ALG_NULL:
+        sym['keyBits'] = u.u16()
+        sym['mode'] = u.u16()
+    return sym
+
+def _kdf_scheme(u):
+    kdf = { 'scheme': u.u16() }
+    if kdf['scheme'] != TPM2_ALG_NULL:
+        kdf['details'] = { 'hashAlg': u.u16() }
+    return kdf
+
+def _tpmt_public(u):
+    result = {
+        'type': u.u16(),
+        'nameAlg': u.u16(),
+        'objectAttributes': u.u32(),
+        'authPolicy': u.tpm2b()
+    }
+    _type = result['type']
+    if _type == TPM2_ALG_RSA:
+        result['parameters'] = {
+            'symmetric': _sym_def_object(u),
+            'scheme': _rsa_scheme(u),
+            'keyBits': u.u16(),
+            'exponent': u.u32()
+        }
+        result['unique'] = u.tpm2b()
+    elif _type == TPM2_ALG_ECC:
+        result['parameters'] = {
+            'symmetric': _sym_def_object(u),
+            'scheme': _scheme(u),
+            'curveID': u.u16(),
+            'kdf': _kdf_scheme(u)
+        }
+        result['unique'] = { 'x': u.tpm2b(), 'y': u.tpm2b() }
+    elif _type == TPM2_ALG_KEYEDHASH:
+        result['parameters'] = { 'scheme': _keyedhash_scheme(u) }
+        result['unique'] = u.tpm2b()
+    elif _type == TPM2_ALG_SYMCIPHER:
+        result['parameters'] = { 'sym': _sym_def_object(u) }
+        result['unique'] = u.tpm2b()
+    else:
+        raise StructureError(f"unsupported TPMT_PUBLIC type: {_type:#06x}")
+    return result
+
+def _tpml_pcr_selection(u):
+    count = u.u32()
+    # (There's one per hash algorithm, so more than a handful is bogus.)
+    if count > 16:
+        raise StructureError(f"TPML_PCR_SELECTION count too big: {count}")
+    selections = []
+    for _ in range(count):
+        _hash = u.u16()
+        sizeofSelect = u.u8()
+        selections.append({
+            'hash': _hash,
+            'sizeofSelect': sizeofSelect,
+            'pcrSelect': bytes(u.take(sizeofSelect))
+        })
+    return { 'count': count, 'pcrSelections': selections }
+
+def _tpms_attest(u):
+    result = {
+        'magic': u.u32(),
+        'type': u.u16(),
+        'qualifiedSigner': u.tpm2b(),
+        'extraData': u.tpm2b(),
+        'clockInfo': {
+            'clock': u.u64(),
+            'resetCount': u.u32(),
+            'restartCount': u.u32(),
+            'safe': u.u8()
+        },
+        'firmwareVersion': u.u64()
+    }
+    if result['magic'] != TPM2_GENERATED_VALUE:
+        raise StructureError(f"bad TPMS_ATTEST magic: {result['magic']:#x}")
+    if result['type'] == TPM2_ST_ATTEST_QUOTE:
+        result['attested'] = {
+            'pcrSelect': _tpml_pcr_selection(u),
+            'pcrDigest': u.tpm2b()
+        }
+    elif result['type'] == TPM2_ST_ATTEST_CERTIFY:
+        result['attested'] = {
+            'name': u.tpm2b(),
+            'qualifiedName': u.tpm2b()
+        }
+    else:
+        # Left undecoded
+        result['attested'] = bytes(u.take(len(u.b) - u.pos))
+    return result
+
+def _tpmt_signature(u):
+    result = { 'sigAlg': u.u16() }
+    sigAlg = result['sigAlg']
+    if sigAlg in (TPM2_ALG_RSASSA, TPM2_ALG_RSAPSS):
+        result['signature'] = { 'hash': u.u16(), 'sig': u.tpm2b() }
+    elif sigAlg == TPM2_ALG_ECDSA:
+        result['signature'] = {
+            'hash': u.u16(),
+            'signatureR': u.tpm2b(),
+            'signatureS': u.tpm2b()
+        }
+    elif sigAlg == TPM2_ALG_HMAC:
+        # A TPMT_HA
+        _hash = u.u16()
+        result['signature'] = { 'hashAlg': _hash,
+                                'digest': bytes(u.take(len(u.b) - u.pos)) }
+    elif sigAlg != TPM2_ALG_NULL:
+        raise StructureError(f"unsupported signature algorithm: {sigAlg:#06x}")
+    return result
+
+def _decoder(fn):
+    def decode(b):
+        u = Unmarshal(b)
+        result = fn(u)
+        u.done()
+        return result
+    return decode
+
+tpmt_public = _decoder(_tpmt_public)
+tpms_attest = _decoder(_tpms_attest)
+tpml_pcr_selection = _decoder(_tpml_pcr_selection)
+tpmt_signature = _decoder(_tpmt_signature)
+
+# TPM2B_PUBLIC is TPMT_PUBLIC with a 2-byte size in front
+def tpm2b_public(b):
+    u = Unmarshal(b)
+    inner = u.tpm2b()
+    u.done()
+    return tpmt_public(inner)
+
+# The PCRs selected by a TPML_PCR_SELECTION (decoded), as a dict from the hash
+# algorithm to the sorted list of PCR indices.
+def pcr_selection_indices(selection):
+    result = {}
+    for s in selection['pcrSelections']:
+        result[s['hash']] = [ i * 8 + bit
+                              for i, byte in enumerate(s['pcrSelect'])
+                              for bit in range(8) if byte & (1 << bit) ]
+    return result
+
+# For JSON output; bytes become hex-strings
+class JSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, bytes):
+            return f"hex:{obj.hex()}"
+        return json.JSONEncoder.default(self, obj)
+
+if __name__ == '__main__':
+
+    sys.argv.pop(0)
+
+    decoders = {
+        'TPMT_PUBLIC': tpmt_public,
+        'TPM2B_PUBLIC': tpm2b_public,
+        'TPMS_ATTEST': tpms_attest,
+        'TPML_PCR_SELECTION': tpml_pcr_selection,
+        'TPMT_SIGNATURE': tpmt_signature
+    }
+    if len(sys.argv) != 2 or sys.argv[0] not in decoders:
+        print(f"Usage: structures.py <{'|'.join(decoders)}> <file>",
+              file = sys.stderr)
+        sys.exit(1)
+
+    inputbuf = open(sys.argv[1], 'rb').read()
+    print(json.dumps(decoders[sys.argv[0]](inputbuf), cls = JSONEncoder,
+                     indent = 2))